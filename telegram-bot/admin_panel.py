@@ -144,7 +144,7 @@ async def admin_generate_prompt(update: Update, context: ContextTypes.DEFAULT_TY
     text = (
         f"➕ *Generate License Key*\n\n"
         f"Command format:\n"
-        f"`/generate <plan> <days> [activations]`\n\n"
+        f"`/generate <plan> <days> [activations] [count]`\n\n"
         f"*Plans:*\n"
         f"• `standard` - 5 channels ($9.99)\n"
         f"• `premium` - 15 channels ($19.99)\n"
@@ -153,7 +153,8 @@ async def admin_generate_prompt(update: Update, context: ContextTypes.DEFAULT_TY
         f"`/generate standard 30` - 30 days\n"
         f"`/generate premium 90` - 90 days\n"
         f"`/generate lifetime 0` - Lifetime\n"
-        f"`/generate standard 30 3` - 3 activations"
+        f"`/generate standard 30 3` - 3 activations\n"
+        f"`/generate premium 30 1 500` - 500 keys as CSV"
     )
 
     keyboard = [
@@ -249,6 +250,9 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         f"🔥 Lifetime: {lifetime_count}\n\n"
         f"💰 *Estimated Revenue:* ${estimated_revenue:.2f}\n\n"
         f"*Total Licenses:* {len(db.get_all_licenses())}\n"
+        f"📜 History: `/licensehistory`\n"
+        f"🔻 Funnel: `/funnel`\n"
+        f"🎯 Retarget: `/retarget`\n"
         f"Last updated: {datetime.now().strftime('%Y-%m-%d %H:%M')}"
     )
 
@@ -272,6 +276,8 @@ async def admin_revoke_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE
         f"`/revoke <key>`\n\n"
         f"This will immediately deactivate the license\n"
         f"and prevent further use.\n\n"
+        f"To revoke many keys at once:\n"
+        f"`/bulk revoke <filters>`\n\n"
         f"⚠️ *Warning:* This action cannot be undone!"
     )
 
@@ -0,0 +1,102 @@
+"""Online snapshots of the bot databases.
+
+Copying bot_database.db while the bots are writing can capture a torn
+file. Snapshots here use SQLite's online backup API instead, copying
+the whole file in a single step. The databases are in WAL mode, so that
+step only holds a read snapshot and the writers carry on meanwhile; a
+backup taken in small steps restarts every time another connection
+writes, and under steady traffic may never finish. Every snapshot is
+integrity checked before it replaces an older one.
+"""
+
+import glob
+import os
+import sqlite3
+from dataclasses import dataclass
+from datetime import datetime
+
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+
+# Seconds to wait for a lock when starting the read snapshot
+BACKUP_BUSY_TIMEOUT = 30
+
+_STAMP = '%Y%m%d-%H%M%S'
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    """One snapshot file on disk."""
+    __slots__ = ('path', 'created_at', 'size_bytes')
+
+    path: str
+    created_at: datetime
+    size_bytes: int
+
+    @property
+    def age(self):
+        return datetime.utcnow() - self.created_at
+
+
+def _prefix(db_path):
+    return os.path.splitext(os.path.basename(db_path))[0] + '-'
+
+
+def create_snapshot(db_path, backup_dir=BACKUP_DIR, keep=BACKUP_KEEP):
+    """Back up `db_path` into `backup_dir` and prune old snapshots.
+
+    The copy is written to a temporary name, checked with
+    PRAGMA integrity_check and only then renamed into place. Raises
+    RuntimeError if the check fails. Blocks for the whole copy, so call
+    it from a worker thread in the bots.
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    created_at = datetime.utcnow()
+    final_path = os.path.join(backup_dir, f"{_prefix(db_path)}{created_at.strftime(_STAMP)}.db")
+    temp_path = final_path + '.part'
+
+    source = sqlite3.connect(db_path, timeout=BACKUP_BUSY_TIMEOUT)
+    target = sqlite3.connect(temp_path)
+    try:
+        # One step (pages=-1): a read snapshot of the whole file, which writers do not restart
+        source.backup(target, pages=-1)
+        result = target.execute('PRAGMA integrity_check').fetchone()[0]
+        # Snapshots are read as a single file, so fold the WAL back in
+        target.execute('PRAGMA journal_mode=DELETE')
+    finally:
+        target.close()
+        source.close()
+
+    if result != 'ok':
+        os.remove(temp_path)
+        raise RuntimeError(f"Snapshot of {db_path} failed integrity check: {result}")
+
+    os.replace(temp_path, final_path)
+    prune_snapshots(db_path, backup_dir, keep)
+    return Snapshot(final_path, created_at, os.path.getsize(final_path))
+
+
+def list_snapshots(db_path, backup_dir=BACKUP_DIR):
+    """Snapshots of `db_path`, newest first."""
+    prefix = _prefix(db_path)
+    snapshots = []
+    for path in glob.glob(os.path.join(backup_dir, f"{prefix}*.db")):
+        stamp = os.path.basename(path)[len(prefix):-len('.db')]
+        try:
+            created_at = datetime.strptime(stamp, _STAMP)
+        except ValueError:
+            continue
+        snapshots.append(Snapshot(path, created_at, os.path.getsize(path)))
+    return sorted(snapshots, key=lambda snapshot: snapshot.created_at, reverse=True)
+
+
+def prune_snapshots(db_path, backup_dir=BACKUP_DIR, keep=BACKUP_KEEP):
+    """Delete all but the newest `keep` snapshots of `db_path`."""
+    for snapshot in list_snapshots(db_path, backup_dir)[keep:]:
+        os.remove(snapshot.path)
+
+
+def latest_snapshot(db_path, backup_dir=BACKUP_DIR):
+    """Newest snapshot of `db_path`, or None."""
+    snapshots = list_snapshots(db_path, backup_dir)
+    return snapshots[0] if snapshots else None
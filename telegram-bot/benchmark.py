@@ -0,0 +1,275 @@
+"""Benchmarks for database.py at production-like data sizes.
+
+    python benchmark.py                                    # every method at 1k and 10k users
+    python benchmark.py --sizes 1000,100000 --output after.json
+    python benchmark.py --compare before.json after.json   # exit 1 on regressions
+    python benchmark.py --hot-reads [iterations]
+
+For each size a scratch SQLite file is filled by synthetic.py (100k users
+gives 200k licenses and 10M user_logs), then every public Database method
+is called with the arguments of the query plan check (query_plans.CASES)
+until it has run --calls times or for --seconds, whichever comes first.
+The entity cache is cleared before each call, outside the timed part, so
+every call reaches the database. The activation limiter is cleared there
+too, and cases in query_plans.SETUP get new arguments (activate_license
+a newly generated key), so repeated calls take the same path as the
+first. Results are per-call p50/p95/p99 in
+milliseconds and calls per second; --output writes them as JSON that
+--compare reads back.
+
+--hot-reads compares the per-call cost of the prebuilt statements in
+database.py with building the same query on every call, both as an ORM
+session.query() and as a fresh Core select().
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+from functools import partial
+import sqlalchemy
+from sqlalchemy import select
+from database import (Database, License, LicenseRecord, PaymentCredential, CredentialRecord, LICENSE_BY_HASH,
+                      ACTIVE_LICENSE_BY_USER, CREDENTIALS_BY_USER, _columns)
+from query_plans import CASES, SETUP, sample_arguments
+from synthetic import populate
+
+USER_ID = 4_200_000_000
+
+DEFAULT_SIZES = (1000, 10000)
+DEFAULT_CALLS = 200
+DEFAULT_SECONDS = 2.0
+
+# --compare flags a method whose p50 or p95 grew by more than this factor...
+REGRESSION_RATIO = 1.25
+# ...unless it is still faster than this (timer noise)
+NOISE_FLOOR_MS = 0.05
+
+
+def time_per_call(fn, iterations):
+    """Mean microseconds per call of `fn` over `iterations` calls."""
+    fn()  # Warm SQLAlchemy's compiled cache first
+    started = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+def _percentile(ordered, fraction):
+    """Nearest-rank percentile of an ascending list."""
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+def time_calls(fn, before, max_calls, max_seconds):
+    """Call `fn` until max_calls or max_seconds; returns latency stats in ms.
+
+    `before` runs ahead of every call and is not timed.
+    """
+    samples = []
+    deadline = time.perf_counter() + max_seconds
+    while len(samples) < max_calls and (not samples or time.perf_counter() < deadline):
+        before()
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+
+    ordered = sorted(samples)
+    total = sum(samples)
+    return {
+        'calls': len(samples),
+        'p50_ms': round(_percentile(ordered, 0.50), 4),
+        'p95_ms': round(_percentile(ordered, 0.95), 4),
+        'p99_ms': round(_percentile(ordered, 0.99), 4),
+        'mean_ms': round(total / len(samples), 4),
+        'per_second': round(len(samples) / total * 1000, 1) if total else None,
+    }
+
+
+def bench_methods(db, users, max_calls, max_seconds):
+    """{method: stats} for every case in query_plans.CASES."""
+    arguments = sample_arguments(db, users)
+
+    def fresh(name):
+        db.cache.clear()
+        db._shared['revoked_at'] = None
+        # A blocked user would turn every later activation into an early rejection
+        db.activation_limiter.clear()
+        if name in SETUP:
+            SETUP[name](db, arguments)
+
+    results = {}
+    for name, (call, _) in CASES.items():
+        results[name] = time_calls(lambda: call(db, arguments), partial(fresh, name), max_calls, max_seconds)
+    return results
+
+
+def bench_size(workdir, users, max_calls, max_seconds, progress=print):
+    """Populate a scratch database with `users` users and time every method on it."""
+    db = Database(url=f"sqlite:///{os.path.join(workdir, f'bench_{users}.db')}",
+                  signing_key='benchmark')
+    started = time.perf_counter()
+    rows = populate(db, users)
+    populate_s = time.perf_counter() - started
+    progress(f"{users} users: populated in {populate_s:.1f} s ({rows['logs']} logs), timing methods")
+
+    methods = bench_methods(db, users, max_calls, max_seconds)
+    db.close()
+    return {'users': users, 'rows': rows, 'populate_s': round(populate_s, 1), 'methods': methods}
+
+
+def run(sizes, max_calls=DEFAULT_CALLS, max_seconds=DEFAULT_SECONDS):
+    """Benchmark every size; returns the JSON-ready report."""
+    report = {
+        'created_at': datetime.utcnow().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'sqlalchemy': sqlalchemy.__version__,
+        'machine': platform.machine(),
+        'calls': max_calls,
+        'seconds': max_seconds,
+        'sizes': []
+    }
+    with tempfile.TemporaryDirectory() as workdir:
+        for users in sizes:
+            report['sizes'].append(bench_size(workdir, users, max_calls, max_seconds))
+    return report
+
+
+def print_report(report):
+    for size in report['sizes']:
+        print(f"\n{size['users']} users, {size['rows']['licenses']} licenses, {size['rows']['logs']} logs")
+        print(f"{'method':<34}{'calls':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'calls/s':>10}")
+        for name, stats in size['methods'].items():
+            print(f"{name:<34}{stats['calls']:>7}{stats['p50_ms']:>10.3f}{stats['p95_ms']:>10.3f}"
+                  f"{stats['p99_ms']:>10.3f}{stats['per_second'] or 0:>10.0f}")
+
+
+def compare(before, after, ratio=REGRESSION_RATIO):
+    """(users, method, metric, before_ms, after_ms) for every regression beyond `ratio`."""
+    regressions = []
+    old_sizes = {size['users']: size['methods'] for size in before['sizes']}
+    for size in after['sizes']:
+        old_methods = old_sizes.get(size['users'], {})
+        for name, stats in size['methods'].items():
+            old = old_methods.get(name)
+            if old is None:
+                continue
+            for metric in ('p50_ms', 'p95_ms'):
+                if stats[metric] > NOISE_FLOOR_MS and stats[metric] > old[metric] * ratio:
+                    regressions.append((size['users'], name, metric, old[metric], stats[metric]))
+    return regressions
+
+
+def bench_hot_reads(db, iterations):
+    """Per-call microseconds for each hot read, as (name, orm, rebuilt, prebuilt) rows."""
+    session = db.session
+    key_hash = _seed(db)
+
+    def license_orm():
+        return session.query(License).filter_by(key_hash=key_hash).first()
+
+    def license_rebuilt():
+        stmt = select(*_columns(LicenseRecord, License)).where(License.key_hash == key_hash).limit(1)
+        return session.execute(stmt).first()
+
+    def active_orm():
+        return session.query(License).filter_by(user_id=USER_ID, status='active').first()
+
+    def active_rebuilt():
+        stmt = select(*_columns(LicenseRecord, License)).where(
+            License.user_id == USER_ID, License.status == 'active'
+        ).limit(1)
+        return session.execute(stmt).first()
+
+    def credentials_orm():
+        return session.query(PaymentCredential).filter_by(user_id=USER_ID).order_by(PaymentCredential.id).all()
+
+    def credentials_rebuilt():
+        stmt = select(*_columns(CredentialRecord, PaymentCredential)).where(
+            PaymentCredential.user_id == USER_ID
+        ).order_by(PaymentCredential.id)
+        return session.execute(stmt).all()
+
+    cases = [
+        ('license by key hash', license_orm, license_rebuilt,
+         lambda: db._fetch_one(LicenseRecord, LICENSE_BY_HASH, key_hash=key_hash)),
+        ('active license by user', active_orm, active_rebuilt,
+         lambda: db._fetch_one(LicenseRecord, ACTIVE_LICENSE_BY_USER, user_id=USER_ID)),
+        ('credentials by user', credentials_orm, credentials_rebuilt,
+         lambda: db._fetch_all(CredentialRecord, CREDENTIALS_BY_USER, user_id=USER_ID)),
+    ]
+    return [
+        (name, *(time_per_call(fn, iterations) for fn in variants))
+        for name, *variants in cases
+    ]
+
+
+def _seed(db):
+    key = db.generate_license_key('premium', duration_days=30)
+    db.generate_license_keys(1000, 'standard')
+    db.activate_license(key, USER_ID, 'bench')
+    db.get_or_create_user(USER_ID, 'bench', 'Bench')
+    db.save_payment_credential(USER_ID, 'btc', btc_address='bc1qbench')
+    db.save_payment_credential(USER_ID, 'eth', eth_address='0xbench')
+    return db._key_hash(key)
+
+
+def hot_reads(iterations):
+    with tempfile.TemporaryDirectory() as workdir:
+        db = Database(url=f"sqlite:///{os.path.join(workdir, 'benchmark.db')}")
+        rows = bench_hot_reads(db, iterations)
+        db.close()
+
+    print(f"{'query':<26}{'session.query':>15}{'select() per call':>20}{'prebuilt':>12}  (us/call)")
+    for name, orm, rebuilt, prebuilt in rows:
+        print(f"{name:<26}{orm:>15.1f}{rebuilt:>20.1f}{prebuilt:>12.1f}")
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark database.py at several data sizes.")
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help="comma-separated user counts (default: %(default)s)")
+    parser.add_argument('--calls', type=int, default=DEFAULT_CALLS, help="max calls per method")
+    parser.add_argument('--seconds', type=float, default=DEFAULT_SECONDS, help="max seconds per method")
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help="compare two JSON results")
+    parser.add_argument('--hot-reads', nargs='?', type=int, const=5000, metavar='ITERATIONS',
+                        help="prebuilt vs per-call statements for the hot reads")
+    args = parser.parse_args(argv)
+
+    # Populating and the bulk methods would flood the slow query log
+    logging.getLogger('slow_queries').setLevel(logging.ERROR)
+
+    if args.hot_reads:
+        hot_reads(args.hot_reads)
+        return 0
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            before = json.load(f)
+        with open(args.compare[1]) as f:
+            after = json.load(f)
+        regressions = compare(before, after)
+        for users, name, metric, old, new in regressions:
+            print(f"{users} users  {name:<34}{metric:<8}{old:>10.3f} -> {new:.3f} ms ({new / old:.2f}x)")
+        print(f"{len(regressions)} regressions over {REGRESSION_RATIO}x")
+        return 1 if regressions else 0
+
+    report = run([int(size) for size in args.sizes.split(',')], args.calls, args.seconds)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+        print(f"\nWrote {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
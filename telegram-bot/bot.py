@@ -8,13 +8,19 @@ import logging
 import random
 import asyncio
 import secrets
-from datetime import datetime, timedelta
+import csv
+import io
+from datetime import datetime, timedelta, time as dtime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, TypeHandler
 from dotenv import load_dotenv
 
 # Import panels
-from database import Database
+from database import Database, LAST_ACTIVE_FLUSH_SECONDS, MAX_KEY_BATCH, FUNNEL_STAGES, FUNNEL_UNKNOWN
+from license_tokens import is_license_token
+from backup import BACKUP_DIR, create_snapshot, latest_snapshot, list_snapshots
+from maintenance import run_maintenance
+from instrumentation import N_PLUS_ONE_THRESHOLD, SLOW_QUERY_MS, stats as sql_stats, track_update
 from user_panel import show_user_menu, handle_user_callback
 from admin_panel import show_admin_menu, handle_admin_callback, is_admin
 
@@ -41,6 +47,39 @@ MAX_DELAY = 8
 COOLDOWN_MINUTES = 5
 last_share_time = {}
 
+# Renewal reminders
+REMINDER_DAYS = int(os.getenv("REMINDER_DAYS", "3"))  # Remind this many days before expiry
+REMINDER_HOUR = int(os.getenv("REMINDER_HOUR", "10"))  # UTC hour of the daily run
+REMINDER_BATCH_SIZE = 50
+
+# Nightly archival of old logs and proofs
+ARCHIVE_HOUR = int(os.getenv("ARCHIVE_HOUR", "3"))  # UTC hour of the daily run
+
+# Online database snapshots
+BACKUP_INTERVAL_HOURS = float(os.getenv("BACKUP_INTERVAL_HOURS", "6"))
+
+# Database maintenance (checkpoint, incremental vacuum, optional ANALYZE)
+MAINTENANCE_HOUR = int(os.getenv("MAINTENANCE_HOUR", "4"))  # UTC hour of the daily run
+ANALYZE_EVERY_DAYS = 7
+
+# License history (expiry sweep plus daily count snapshot)
+LICENSE_SNAPSHOT_HOUR = int(os.getenv("LICENSE_SNAPSHOT_HOUR", "0"))  # UTC hour of the daily run
+LICENSE_TREND_DAYS = 14
+
+# Conversion funnel rollup (user_logs and payment_proofs into funnel_daily)
+FUNNEL_ROLLUP_MINUTES = float(os.getenv("FUNNEL_ROLLUP_MINUTES", "15"))
+FUNNEL_DAYS = 30  # Default /funnel period
+FUNNEL_STAGE_LABELS = {
+    'intent': 'Purchase intent',
+    'method': 'Method chosen',
+    'proof': 'Proof submitted',
+    'verified': 'Verified'
+}
+
+# /retarget: users with purchase intent but no active license
+RETARGET_DAYS = 30  # Default period
+RETARGET_PREVIEW = 10  # Users listed in the reply; all of them go into the CSV
+
 # Messages for sharing
 X_MESSAGES = [
     "🐦 Check out my X profile!\n\n{link}\n\nFollow for tech updates! 👆\n\n#X #Tech #Follow",
@@ -84,19 +123,52 @@ async def random_delay():
     await asyncio.sleep(random.uniform(MIN_DELAY, MAX_DELAY))
 
 
-async def safe_send_message(bot, chat_id: str, text: str, parse_mode: str = None) -> bool:
+async def safe_send_message(bot, chat_id: str, text: str, parse_mode: str = None, reply_markup=None) -> bool:
     """Send message with safety measures."""
     try:
         await random_delay()
         await bot.send_chat_action(chat_id=chat_id, action='typing')
         await asyncio.sleep(random.uniform(1, 2))
-        await bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode, disable_web_page_preview=False)
+        await bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode, disable_web_page_preview=False,
+                               reply_markup=reply_markup)
         return True
     except Exception as e:
         logger.error(f"Failed to send to {chat_id}: {e}")
         return False
 
 
+async def send_expiry_reminders(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Daily job: remind users whose license expires within REMINDER_DAYS."""
+    renew_markup = InlineKeyboardMarkup([[
+        InlineKeyboardButton("🔄 Renew License", callback_data='user_renew')
+    ]])
+
+    sent = 0
+    undelivered = []
+    while True:
+        # Claimed before sending, so other bot hosts never pick the same licenses
+        batch = await db.claim_license_reminders.submit(REMINDER_DAYS, limit=REMINDER_BATCH_SIZE)
+        if not batch:
+            break
+
+        for license in batch:
+            text = (
+                f"⏰ *License Expiring Soon*\n\n"
+                f"Your {license.plan_type.title()} license expires on "
+                f"{license.expires_at.strftime('%Y-%m-%d')} "
+                f"({max(license.days_left, 0)} days left).\n\n"
+                f"Renew now to keep your channels posting."
+            )
+            if await safe_send_message(context.bot, license.user_id, text, 'Markdown', renew_markup):
+                sent += 1
+            else:
+                undelivered.append(license)
+
+    # Released only after the run, so tomorrow's run retries them instead of this loop
+    await db.release_license_reminders.submit(undelivered)
+    logger.info(f"Expiry reminders: {sent} sent, {len(undelivered)} failed")
+
+
 # ==================== MAIN ENTRY POINTS ====================
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -104,7 +176,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
 
     # Register/update user in database
-    db.get_or_create_user(user.id, user.username, user.first_name)
+    await db.get_or_create_user.submit(user.id, user.username, user.first_name)
 
     # Check if admin
     if is_admin(user.id):
@@ -206,7 +278,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         )
         return
 
-    if data == 'back_to_purchase':
+    if data in ('back_to_purchase', 'user_renew'):
         await show_purchase_menu(update, context)
         return
 
@@ -294,8 +366,8 @@ async def activate_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 
     key = context.args[0].upper()
 
-    # Validate format
-    if len(key.replace('-', '')) != 16:
+    # Validate format (signed PS1- tokens carry their own layout)
+    if not is_license_token(key) and len(key.replace('-', '')) != 16:
         await update.message.reply_text(
             "❌ Invalid key format. Use: `XXXX-XXXX-XXXX-XXXX`",
             parse_mode='Markdown'
@@ -303,11 +375,11 @@ async def activate_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         return
 
     # Add dashes if missing
-    if '-' not in key:
+    if not is_license_token(key) and '-' not in key:
         key = '-'.join([key[i:i+4] for i in range(0, 16, 4)])
 
     # Activate
-    success, message = db.activate_license(key, user.id, user.username)
+    success, message = await db.activate_license.submit(key, user.id, user.username)
 
     if success:
         await update.message.reply_text(
@@ -334,10 +406,12 @@ async def generate_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 
     if len(context.args) < 2:
         await update.message.reply_text(
-            "Usage: `/generate <plan> <days> [activations]`\n\n"
+            "Usage: `/generate <plan> <days> [activations] [count]`\n\n"
             "Plans: standard, premium, lifetime\n"
-            "Days: 30, 90, 365, 0 (lifetime)\n\n"
-            "Example: `/generate standard 30`",
+            "Days: 30, 90, 365, 0 (lifetime)\n"
+            f"Count: 1-{MAX_KEY_BATCH}, more than 1 returns a CSV file\n\n"
+            "Example: `/generate standard 30`\n"
+            "Example: `/generate premium 30 1 500`",
             parse_mode='Markdown'
         )
         return
@@ -345,12 +419,26 @@ async def generate_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     plan = context.args[0].lower()
     days = int(context.args[1])
     activations = int(context.args[2]) if len(context.args) > 2 else 1
+    count = int(context.args[3]) if len(context.args) > 3 else 1
 
     if plan not in ['standard', 'premium', 'lifetime']:
         await update.message.reply_text("❌ Invalid plan.")
         return
 
-    key = db.generate_license_key(plan, days if days > 0 else None, activations)
+    if not 1 <= count <= MAX_KEY_BATCH:
+        await update.message.reply_text(f"❌ Count must be between 1 and {MAX_KEY_BATCH}.")
+        return
+
+    try:
+        if count > 1:
+            await send_key_batch(update, plan, days, activations, count)
+            return
+
+        key = await db.generate_license_key.submit(plan, days if days > 0 else None, activations)
+    except ValueError as e:
+        # e.g. more activations than a signed token can carry
+        await update.message.reply_text(f"❌ {e}")
+        return
 
     await update.message.reply_text(
         f"✅ *License Key Generated*\n\n"
@@ -363,6 +451,28 @@ async def generate_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     )
 
 
+async def send_key_batch(update: Update, plan: str, days: int, activations: int, count: int) -> None:
+    """Generate a batch of keys and send them back as a CSV document."""
+    keys = await db.generate_license_keys.submit(count, plan, days if days > 0 else None, activations)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['license_key', 'plan', 'expires_at', 'max_activations'])
+    for key, expires_at in keys:
+        writer.writerow([key, plan, expires_at.strftime('%Y-%m-%d') if expires_at else 'lifetime', activations])
+
+    filename = f"licenses_{plan}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+    await update.message.reply_document(
+        document=io.BytesIO(buffer.getvalue().encode()),
+        filename=filename,
+        caption=(
+            f"✅ {len(keys)} {plan.title()} keys generated\n"
+            f"Duration: {days if days > 0 else 'Lifetime'} days\n"
+            f"Activations: {activations}"
+        )
+    )
+
+
 async def revoke_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Revoke license key (admin only)."""
     user = update.effective_user
@@ -376,12 +486,451 @@ async def revoke_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
 
     key = context.args[0].upper()
-    if db.revoke_license(key):
+    if await db.revoke_license.submit(key):
         await update.message.reply_text(f"✅ License `{key}` has been revoked.", parse_mode='Markdown')
     else:
         await update.message.reply_text("❌ License not found.")
 
 
+BULK_USAGE = (
+    "🧰 *Bulk License Update*\n\n"
+    "Usage: `/bulk <action> <filters> [confirm]`\n\n"
+    "*Actions:*\n"
+    "`extend <days>` - Push expiry back\n"
+    "`revoke` - Revoke all matches\n"
+    "`replan <plan>` - Change plan\n\n"
+    "*Filters:*\n"
+    "`plan=premium` `status=active`\n"
+    "`expires_in=<days>` - Expiring within N days\n"
+    "`created_after=YYYY-MM-DD` `created_before=YYYY-MM-DD`\n\n"
+    "Without `confirm` only the number of matches is shown.\n\n"
+    "Example: `/bulk extend 7 plan=premium status=active confirm`"
+)
+
+
+def parse_bulk_filters(args):
+    """Turn `key=value` arguments into Database bulk filters."""
+    filters = {}
+    for arg in args:
+        name, _, value = arg.partition('=')
+        name = name.lower()
+        if name in ('plan', 'status'):
+            filters[name] = value.lower()
+        elif name == 'expires_in':
+            filters['expires_after'] = datetime.utcnow()
+            filters['expires_before'] = datetime.utcnow() + timedelta(days=int(value))
+        elif name in ('created_after', 'created_before'):
+            filters[name] = datetime.strptime(value, '%Y-%m-%d')
+        else:
+            raise ValueError(f"Unknown filter: {arg}")
+    return filters
+
+
+async def bulk_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Extend, revoke or re-plan every license matching a filter (admin only)."""
+    user = update.effective_user
+
+    if not is_admin(user.id):
+        await update.message.reply_text("❌ Admin only.")
+        return
+
+    args = list(context.args)
+    confirm = 'confirm' in [arg.lower() for arg in args]
+    args = [arg for arg in args if arg.lower() != 'confirm']
+
+    if not args or args[0].lower() not in ('extend', 'revoke', 'replan'):
+        await update.message.reply_text(BULK_USAGE, parse_mode='Markdown')
+        return
+
+    action = args[0].lower()
+    try:
+        if action == 'revoke':
+            value, filter_args = None, args[1:]
+        else:
+            value, filter_args = args[1], args[2:]
+            value = int(value) if action == 'extend' else value.lower()
+        filters = parse_bulk_filters(filter_args)
+        matches = db.count_licenses(**filters)
+    except (IndexError, ValueError) as e:
+        await update.message.reply_text(f"❌ {e or 'Missing value.'}\n\n{BULK_USAGE}", parse_mode='Markdown')
+        return
+
+    summary = {
+        'extend': f"extend by {value} days",
+        'revoke': "revoke",
+        'replan': f"move to {value}"
+    }[action]
+    filter_text = ' '.join(filter_args)
+
+    if not confirm:
+        await update.message.reply_text(
+            f"🧰 *Dry run*\n\n"
+            f"Action: {summary}\n"
+            f"Filter: `{filter_text}`\n"
+            f"Matching licenses: {matches}\n\n"
+            f"Repeat the command with `confirm` to apply.",
+            parse_mode='Markdown'
+        )
+        return
+
+    try:
+        if action == 'extend':
+            affected = await db.extend_licenses.submit(value, **filters)
+        elif action == 'revoke':
+            affected = await db.revoke_licenses.submit(**filters)
+        else:
+            affected = await db.change_license_plan.submit(value, **filters)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}")
+        return
+
+    logger.info(f"Admin {user.id} bulk {action} {value or ''} [{filter_text}]: {affected} licenses")
+    await update.message.reply_text(
+        f"✅ *Bulk update applied*\n\n"
+        f"Action: {summary}\n"
+        f"Filter: `{filter_text}`\n"
+        f"Licenses updated: {affected}",
+        parse_mode='Markdown'
+    )
+
+
+async def archive_old_rows(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Daily job: move old logs and reviewed proofs into monthly archives."""
+    # Archived logs are out of the funnel's reach, so count them first.
+    # Both scan and move many rows, so keep them off the event loop.
+    await asyncio.to_thread(db.roll_up_funnel)
+    moved = await asyncio.to_thread(db.archive_old_rows)
+    logger.info(f"Archived {moved['logs']} logs and {moved['proofs']} proofs")
+
+
+async def backup_databases(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Scheduled job: snapshot the main and analytics databases."""
+    for path in (db.db_path, db.analytics_path):
+        try:
+            # Copying the whole file takes a while, so keep it off the event loop
+            snapshot = await asyncio.to_thread(create_snapshot, path)
+            logger.info(f"Snapshot {snapshot.path} ({snapshot.size_bytes / 1024:.0f} KB)")
+        except Exception as e:
+            logger.error(f"Snapshot of {path} failed: {e}")
+
+
+async def maintain_databases(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Daily job: tidy both database files and record before/after metrics."""
+    for path in (db.db_path, db.analytics_path):
+        last_analyze = db.last_analyze_at(os.path.basename(path))
+        analyze = not last_analyze or datetime.utcnow() - last_analyze >= timedelta(days=ANALYZE_EVERY_DAYS)
+        try:
+            metrics = await asyncio.to_thread(run_maintenance, path, analyze)
+        except Exception as e:
+            logger.error(f"Maintenance of {path} failed: {e}")
+            continue
+
+        await db.record_maintenance_run.submit(**metrics)
+        logger.info(
+            f"Maintenance {metrics['db_file']}: {metrics['size_before'] / 1024:.0f} KB -> "
+            f"{metrics['size_after'] / 1024:.0f} KB in {metrics['duration_ms']} ms"
+            f"{' (analyzed)' if metrics['analyzed'] else ''}"
+        )
+
+
+async def snapshot_licenses(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Daily job: expire overdue licenses, then store license counts for /licensehistory."""
+    expired = await db.expire_licenses.submit()
+    counts = await db.take_license_snapshot.submit()
+    logger.info(f"Expired {expired} licenses; snapshot of {sum(counts.values())} licenses")
+
+
+async def roll_up_funnel(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Scheduled job: add new logs and proofs to the funnel rollup for /funnel."""
+    counted = await asyncio.to_thread(db.roll_up_funnel)
+    if any(counted.values()):
+        logger.info("Funnel rollup: " + ', '.join(f"{stage} +{count}" for stage, count in counted.items()))
+
+
+async def flush_last_active(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Repeating job: write queued last_active values even when no new update arrives."""
+    await db.flush_last_active.submit()
+
+
+async def backupstatus_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show the age and size of the latest snapshots (admin only)."""
+    user = update.effective_user
+
+    if not is_admin(user.id):
+        await update.message.reply_text("❌ Admin only.")
+        return
+
+    if not db.is_sqlite:
+        await update.message.reply_text("💾 Snapshots are only taken for SQLite. Use the database server's backups.")
+        return
+
+    text = f"💾 *Backup Status*\n\nDirectory: `{BACKUP_DIR}`\n\n"
+    for label, path in (('Main', db.db_path), ('Analytics', db.analytics_path)):
+        snapshot = latest_snapshot(path)
+        if not snapshot:
+            text += f"*{label}:* no snapshot yet\n\n"
+            continue
+        hours = snapshot.age.total_seconds() / 3600
+        text += (
+            f"*{label}:*\n"
+            f"Last: {snapshot.created_at.strftime('%Y-%m-%d %H:%M')} UTC ({hours:.1f}h ago)\n"
+            f"Size: {snapshot.size_bytes / 1024 / 1024:.2f} MB\n"
+            f"Kept: {len(list_snapshots(path))}\n\n"
+        )
+    text += f"Snapshots run every {BACKUP_INTERVAL_HOURS:g}h."
+    await update.message.reply_text(text, parse_mode='Markdown')
+
+
+async def sqlstats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show where this process spends its database time (admin only)."""
+    user = update.effective_user
+
+    if not is_admin(user.id):
+        await update.message.reply_text("❌ Admin only.")
+        return
+
+    if context.args and context.args[0].lower() == 'reset':
+        sql_stats.reset()
+        await update.message.reply_text("✅ SQL statistics reset.")
+        return
+
+    rows = sql_stats.top_operations(10)
+    if not rows:
+        await update.message.reply_text("📊 No SQL statements recorded yet.")
+        return
+
+    text = "📊 *SQL Time by Method*\n\n"
+    for name, count, total_ms, max_ms in rows:
+        text += f"`{name}`: {count} queries, {total_ms:.0f} ms total, {max_ms:.1f} ms max\n"
+
+    text += f"\n🐢 Slow queries (≥{SLOW_QUERY_MS:g} ms): {len(sql_stats.slow)}\n"
+    if sql_stats.n_plus_one:
+        text += f"\n⚠️ *Updates over {N_PLUS_ONE_THRESHOLD} queries:*\n"
+        for label, times in sql_stats.n_plus_one.most_common(5):
+            text += f"`{label}`: {times}x\n"
+    await update.message.reply_text(text, parse_mode='Markdown')
+
+
+async def licensehistory_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """License counts on a past date, or the recent trend of active licenses (admin only)."""
+    user = update.effective_user
+
+    if not is_admin(user.id):
+        await update.message.reply_text("❌ Admin only.")
+        return
+
+    args = context.args
+
+    if args and args[0].lower() == 'snapshot':
+        expired = await db.expire_licenses.submit()
+        counts = await db.take_license_snapshot.submit()
+        await update.message.reply_text(
+            f"✅ Snapshot taken: {sum(counts.values())} licenses ({expired} newly expired)."
+        )
+        return
+
+    if args:
+        try:
+            day = datetime.strptime(args[0], '%Y-%m-%d')
+        except ValueError:
+            await update.message.reply_text(
+                "❌ Use `/licensehistory [YYYY-MM-DD]` or `/licensehistory snapshot`", parse_mode='Markdown'
+            )
+            return
+
+        counts = db.license_counts_at(min(day + timedelta(days=1), datetime.utcnow()))
+        if not counts:
+            await update.message.reply_text(f"No licenses on {args[0]}.")
+            return
+
+        text = f"📜 *Licenses at end of {args[0]}*\n\n"
+        for plan in sorted({plan for plan, _ in counts}):
+            states = ', '.join(
+                f"{status} {count}" for (plan_type, status), count in sorted(counts.items()) if plan_type == plan
+            )
+            text += f"*{plan.title()}:* {states}\n"
+        await update.message.reply_text(text, parse_mode='Markdown')
+        return
+
+    trend = db.license_trend(LICENSE_TREND_DAYS)
+    plans = sorted({plan for _, counts in trend for plan in counts})
+    text = f"📈 *Active Licenses, last {LICENSE_TREND_DAYS} days*\n\n"
+    if not plans:
+        text += "No active licenses in this period.\n"
+    else:
+        text += "`date       " + ''.join(f"{plan[:8]:>9}" for plan in plans) + "`\n"
+        for day, counts in trend:
+            text += f"`{day:%Y-%m-%d} " + ''.join(f"{counts.get(plan, 0):>9}" for plan in plans) + "`\n"
+    text += (
+        "\nUsage:\n"
+        "`/licensehistory YYYY-MM-DD` - Counts on a date\n"
+        "`/licensehistory snapshot` - Snapshot now"
+    )
+    await update.message.reply_text(text, parse_mode='Markdown')
+
+
+async def funnel_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Conversion funnel by stage, plan and payment method from the daily rollup (admin only)."""
+    user = update.effective_user
+
+    if not is_admin(user.id):
+        await update.message.reply_text("❌ Admin only.")
+        return
+
+    days = FUNNEL_DAYS
+    if context.args:
+        try:
+            days = int(context.args[0])
+            if days < 1:
+                raise ValueError
+        except ValueError:
+            await update.message.reply_text("❌ Use `/funnel [days]`", parse_mode='Markdown')
+            return
+
+    rows = db.get_funnel(days)
+    rolled_up_at = db.funnel_rolled_up_at()
+    if not rows:
+        await update.message.reply_text(
+            f"🔻 No funnel data for the last {days} days."
+            + ("" if rolled_up_at else f"\nThe first rollup runs within {FUNNEL_ROLLUP_MINUTES:g} min.")
+        )
+        return
+
+    totals = dict.fromkeys(FUNNEL_STAGES, 0)
+    by_plan, by_method = {}, {}
+    for stage, plan, method, count in rows:
+        totals[stage] += count
+        by_plan.setdefault(plan, dict.fromkeys(FUNNEL_STAGES, 0))[stage] += count
+        by_method.setdefault(method, dict.fromkeys(FUNNEL_STAGES, 0))[stage] += count
+
+    text = f"🔻 *Conversion Funnel, last {days} days*\n\n"
+    previous = None
+    for stage in FUNNEL_STAGES:
+        rate = f" ({totals[stage] / previous:.0%})" if previous else ""
+        text += f"{FUNNEL_STAGE_LABELS[stage]}: {totals[stage]}{rate}\n"
+        previous = totals[stage]
+
+    text += "\n*By plan* (intent, method, proof, verified):\n"
+    for plan, counts in sorted(by_plan.items(), key=lambda item: -sum(item[1].values())):
+        text += f"`{plan[:10]:<10}" + ''.join(f"{counts[stage]:>7}" for stage in FUNNEL_STAGES) + "`\n"
+
+    text += "\n*By payment method* (method, proof, verified):\n"
+    for method, counts in sorted(by_method.items(), key=lambda item: -sum(item[1].values())):
+        if method == FUNNEL_UNKNOWN:
+            continue  # Intents, which come before a method is chosen
+        text += f"`{method[:10]:<10}" + ''.join(f"{counts[stage]:>7}" for stage in FUNNEL_STAGES[1:]) + "`\n"
+
+    minutes = (datetime.utcnow() - rolled_up_at).total_seconds() / 60
+    text += f"\nRolled up {minutes:.0f} min ago (every {FUNNEL_ROLLUP_MINUTES:g} min)."
+    await update.message.reply_text(text, parse_mode='Markdown')
+
+
+async def retarget_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Users with recent purchase intent and no active license, as a list and a CSV (admin only)."""
+    user = update.effective_user
+
+    if not is_admin(user.id):
+        await update.message.reply_text("❌ Admin only.")
+        return
+
+    days = RETARGET_DAYS
+    if context.args:
+        try:
+            days = int(context.args[0])
+            if days < 1:
+                raise ValueError
+        except ValueError:
+            await update.message.reply_text("❌ Use `/retarget [days]`", parse_mode='Markdown')
+            return
+
+    # One aggregate over the whole window; it can take seconds, so off the event loop
+    records = await asyncio.to_thread(db.export_users_with_purchase_intent, days)
+
+    if not records:
+        await update.message.reply_text(f"🎯 No unconverted purchase intent in the last {days} days.")
+        return
+
+    # Plain text: usernames often contain Markdown characters
+    text = f"🎯 Retargeting, last {days} days\n\n{len(records)} users showed intent without a license.\n\n"
+    for record in records[:RETARGET_PREVIEW]:
+        name = f"@{record.username}" if record.username else (record.first_name or 'N/A')
+        text += (
+            f"{record.user_id} {name}: {record.plan_type or '?'} / {record.payment_method or '?'}, "
+            f"{record.last_intent_at.strftime('%m-%d %H:%M')}\n"
+        )
+    await update.message.reply_text(text)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['user_id', 'username', 'first_name', 'last_intent_at', 'plan_type', 'payment_method'])
+    for record in records:
+        writer.writerow([record.user_id, record.username or '', record.first_name or '',
+                         record.last_intent_at.strftime('%Y-%m-%d %H:%M:%S'),
+                         record.plan_type or '', record.payment_method or ''])
+    await update.message.reply_document(
+        document=io.BytesIO(buffer.getvalue().encode()),
+        filename=f"retarget_{days}d_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
+        caption=f"🎯 {len(records)} users to retarget"
+    )
+
+
+async def archive_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Browse monthly archives of logs and proofs (admin only)."""
+    user = update.effective_user
+
+    if not is_admin(user.id):
+        await update.message.reply_text("❌ Admin only.")
+        return
+
+    args = context.args
+
+    if args and args[0].lower() == 'run':
+        moved = await asyncio.to_thread(db.archive_old_rows)
+        await update.message.reply_text(
+            f"✅ Archived {moved['logs']} logs and {moved['proofs']} proofs."
+        )
+        return
+
+    if len(args) >= 2 and args[0].lower() in ('logs', 'proofs'):
+        kind, month = args[0].lower(), args[1]
+        try:
+            user_id = int(args[2]) if len(args) > 2 else None
+            rows = db.query_archive(kind, month, user_id=user_id, limit=20)
+        except ValueError:
+            await update.message.reply_text("❌ Use `/archive <logs|proofs> YYYY_MM [user_id]`", parse_mode='Markdown')
+            return
+
+        if not rows:
+            await update.message.reply_text("No archived rows found.")
+            return
+
+        text = f"🗄 *{kind.title()} {month}* (latest {len(rows)})\n\n"
+        for row in rows:
+            created = row.created_at.strftime('%Y-%m-%d %H:%M') if row.created_at else '-'
+            if kind == 'logs':
+                text += f"`{created}` {row.user_id} - {row.action}\n"
+            else:
+                text += f"`{created}` {row.user_id} - {row.payment_method} {row.status}\n"
+        await update.message.reply_text(text, parse_mode='Markdown')
+        return
+
+    text = "🗄 *Archives*\n\n"
+    for kind in ('logs', 'proofs'):
+        archives = db.list_archives(kind)
+        text += f"*{kind.title()}:*\n"
+        if archives:
+            text += ''.join(f"• `{month}` - {count} rows\n" for month, count in archives[:12])
+        else:
+            text += "• none yet\n"
+        text += "\n"
+    text += (
+        "Usage:\n"
+        "`/archive <logs|proofs> YYYY_MM [user_id]`\n"
+        "`/archive run` - Archive old rows now"
+    )
+    await update.message.reply_text(text, parse_mode='Markdown')
+
+
 async def lookup_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Look up user by ID, username, or license key (admin only)."""
     user = update.effective_user
@@ -408,26 +957,32 @@ async def lookup_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     # Search by user ID
     if search_term.isdigit():
         user_id = int(search_term)
-        user_data = db.get_or_create_user(user_id, None, None)
-        license_info = db.get_license_info(user_id)
+        snapshot = db.load_user_aggregate(user_id)
+        user_data = snapshot.user
+        license = snapshot.license
 
-        if license_info:
+        if license:
             found = True
             text = (
                 f"👤 *User Found*\n\n"
                 f"ID: `{user_id}`\n"
-                f"Username: @{user_data.username or 'N/A'}\n"
-                f"Name: {user_data.first_name or 'N/A'}\n\n"
+                f"Username: @{(user_data and user_data.username) or 'N/A'}\n"
+                f"Name: {(user_data and user_data.first_name) or 'N/A'}\n\n"
                 f"🔐 *License Info*\n"
-                f"Plan: {license_info['plan'].title()}\n"
-                f"Status: {license_info['status'].title()}\n"
-                f"Max Channels: {license_info['max_channels']}\n"
+                f"Plan: {license.plan_type.title()}\n"
+                f"Status: {license.status.title()}\n"
+                f"Max Channels: {license.max_channels}\n"
             )
-            if license_info['days_left'] is not None:
-                text += f"Days Left: {license_info['days_left']}\n"
-                text += f"Expires: {license_info['expires_at'].strftime('%Y-%m-%d')}\n"
+            if license.days_left is not None:
+                text += f"Days Left: {license.days_left}\n"
+                text += f"Expires: {license.expires_at.strftime('%Y-%m-%d')}\n"
             else:
                 text += "Type: Lifetime 🔥\n"
+            if snapshot.default_credential:
+                text += f"Default Payment: {snapshot.default_credential.payment_method.upper()}\n"
+            if snapshot.recent_proofs:
+                latest = snapshot.recent_proofs[0]
+                text += f"Last Proof: #{latest.id} ({latest.status})\n"
 
             await update.message.reply_text(text, parse_mode='Markdown')
 
@@ -440,14 +995,14 @@ async def lookup_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         license = db.get_license_by_key(key)
         if license:
             found = True
-            user_data = db.get_or_create_user(license.user_id, None, None) if license.user_id else None
+            user_data = db.get_user(license.user_id) if license.user_id else None
 
             text = (
                 f"🔐 *License Found*\n\n"
                 f"Key: `{key[:12]}****`\n"
                 f"Plan: {license.plan_type.title()}\n"
                 f"Status: {license.status.title()}\n"
-                f"Activations: {license.activations_used}/{license.max_activations}\n"
+                f"Activations: {license.used_activation_count}/{license.max_activations}\n"
             )
 
             if license.user_id:
@@ -505,6 +1060,11 @@ async def lookup_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 # ==================== MAIN ====================
 
+async def post_shutdown(application: Application) -> None:
+    """Write the last queued last_active values before the process exits."""
+    db.close()
+
+
 def main() -> None:
     """Start the bot."""
     token = os.getenv("ADMIN_BOT_TOKEN")
@@ -512,7 +1072,10 @@ def main() -> None:
         logger.error("ADMIN_BOT_TOKEN not found in .env!")
         return
 
-    application = Application.builder().token(token).build()
+    application = Application.builder().token(token).post_shutdown(post_shutdown).build()
+
+    # Opens a fresh SQL statement scope for every update (see instrumentation.py)
+    application.add_handler(TypeHandler(Update, track_update), group=-1)
 
     # Command handlers
     application.add_handler(CommandHandler("start", start))
@@ -520,11 +1083,44 @@ def main() -> None:
     application.add_handler(CommandHandler("activate", activate_command))
     application.add_handler(CommandHandler("generate", generate_command))
     application.add_handler(CommandHandler("revoke", revoke_command))
+    application.add_handler(CommandHandler("bulk", bulk_command))
+    application.add_handler(CommandHandler("archive", archive_command))
+    application.add_handler(CommandHandler("backupstatus", backupstatus_command))
+    application.add_handler(CommandHandler("sqlstats", sqlstats_command))
+    application.add_handler(CommandHandler("licensehistory", licensehistory_command))
+    application.add_handler(CommandHandler("funnel", funnel_command))
+    application.add_handler(CommandHandler("retarget", retarget_command))
     application.add_handler(CommandHandler("lookup", lookup_command))
 
     # Callback handler
     application.add_handler(CallbackQueryHandler(button_handler))
 
+    # Scheduled jobs (need python-telegram-bot[job-queue])
+    if application.job_queue:
+        application.job_queue.run_daily(send_expiry_reminders, time=dtime(hour=REMINDER_HOUR))
+        application.job_queue.run_daily(archive_old_rows, time=dtime(hour=ARCHIVE_HOUR))
+        application.job_queue.run_daily(snapshot_licenses, time=dtime(hour=LICENSE_SNAPSHOT_HOUR))
+        application.job_queue.run_repeating(roll_up_funnel, interval=FUNNEL_ROLLUP_MINUTES * 60, first=30)
+        application.job_queue.run_repeating(flush_last_active, interval=LAST_ACTIVE_FLUSH_SECONDS,
+                                            first=LAST_ACTIVE_FLUSH_SECONDS)
+        # Snapshots and file maintenance only apply to SQLite; servers have their own
+        if db.is_sqlite:
+            application.job_queue.run_repeating(backup_databases, interval=BACKUP_INTERVAL_HOURS * 3600, first=60)
+            application.job_queue.run_daily(maintain_databases, time=dtime(hour=MAINTENANCE_HOUR))
+    else:
+        logger.warning("JobQueue not available, reminders, archival, license snapshots, funnel rollups, backups, "
+                       "maintenance and periodic last_active flushes are disabled")
+
+    # Drop cached license/credential reads when another bot changes them
+    db.start_change_feed()
+
+    # Fill the license cache before the first burst of /start traffic
+    stats = db.warm_up()
+    logger.info(
+        f"Warm-up cached {stats['licenses']} active licenses for {stats['users']} users "
+        f"({stats['cached']} cache entries) in {stats['seconds']:.2f}s using {stats['memory_kb']:.0f} KB"
+    )
+
     logger.info("Bot started with User and Admin panels!")
     application.run_polling()
 
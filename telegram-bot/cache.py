@@ -0,0 +1,246 @@
+"""Process-wide read cache kept coherent across the bot processes.
+
+Every Database write that affects a cached entity appends a row to
+change_log and bumps that entity's row in entity_versions inside the same
+transaction. ChangeFeedPoller watches SQLite's PRAGMA data_version on its
+own connection and, when another connection has committed, reads only the
+new change_log rows and drops the matching cache entries. On a database
+server, EngineChangeFeedPoller does the same over a pooled connection.
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+
+logger = logging.getLogger(__name__)
+
+# Returned by EntityCache.get on a miss (None is a valid cached value)
+MISSING = object()
+
+
+class EntityCache:
+    """Cache of read records keyed by (entity, key).
+
+    Entries also expire after `ttl` seconds as a safety net in case a change
+    notification is ever missed. Past `max_entries` the least recently used
+    entry is evicted.
+
+    A read-through caller takes generation() before loading and passes it
+    to set(): if the entity was invalidated while the load ran, the value
+    may predate the change and is not stored.
+    """
+
+    def __init__(self, max_entries=200000, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generations = {}  # entity -> invalidations so far
+        self._clears = 0
+
+    def get(self, entity, key):
+        """Cached value, or MISSING."""
+        cache_key = (entity, key)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is None:
+                return MISSING
+            self._entries.move_to_end(cache_key)
+        value, stored_at = entry
+        if time.monotonic() - stored_at > self.ttl:
+            return MISSING
+        return value
+
+    def generation(self, entity):
+        """Token that changes whenever an entry of `entity` is invalidated."""
+        return self._clears, self._generations.get(entity, 0)
+
+    def set(self, entity, key, value, generation=None):
+        """Store a value, evicting the least recently used entry when full.
+
+        With a `generation` from before the value was loaded, nothing is
+        stored if the entity has been invalidated since.
+        """
+        cache_key = (entity, key)
+        with self._lock:
+            if generation is not None and generation != (self._clears, self._generations.get(entity, 0)):
+                return
+            if cache_key in self._entries:
+                self._entries.move_to_end(cache_key)
+            elif len(self._entries) >= self.max_entries:
+                self._entries.popitem(last=False)
+            self._entries[cache_key] = (value, time.monotonic())
+
+    def invalidate(self, entity, key):
+        """Drop one entry, or every entry of the entity when key is '*'."""
+        if key == '*':
+            self.invalidate_entity(entity)
+            return
+        with self._lock:
+            self._generations[entity] = self._generations.get(entity, 0) + 1
+            self._entries.pop((entity, key), None)
+
+    def invalidate_entity(self, entity):
+        """Drop every entry of one entity type."""
+        with self._lock:
+            self._generations[entity] = self._generations.get(entity, 0) + 1
+            for cache_key in [k for k in self._entries if k[0] == entity]:
+                del self._entries[cache_key]
+
+    def clear(self):
+        with self._lock:
+            self._clears += 1
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ChangeFeedPoller(threading.Thread):
+    """Background thread applying other processes' changes to the cache."""
+
+    # Errors a poll may raise without stopping the thread
+    errors = (sqlite3.Error,)
+
+    def __init__(self, db_path, cache, on_change=None, interval=1.0, retention=timedelta(hours=1)):
+        super().__init__(name='change-feed', daemon=True)
+        self.db_path = db_path
+        self.cache = cache
+        self.on_change = on_change
+        self.interval = interval
+        self.retention = retention
+        self._stop_event = threading.Event()
+        self._conn = None
+        self._data_version = None
+        self._versions = {}
+        self._last_id = 0
+        self._last_prune = 0.0
+
+    def _connect(self):
+        # Opened by the starting thread, then only used by the poller thread
+        self._conn = sqlite3.connect(self.db_path, timeout=5, check_same_thread=False)
+        self._take_baseline()
+
+    def _query(self, sql, params=None):
+        return self._conn.execute(sql, params or {}).fetchall()
+
+    def _take_baseline(self):
+        self._versions = dict(self._query('SELECT entity, version FROM entity_versions'))
+        self._last_id = self._query('SELECT COALESCE(MAX(id), 0) FROM change_log')[0][0]
+        self._has_new_commits()
+
+    def _has_new_commits(self):
+        # data_version only moves when another connection commits
+        data_version = self._query('PRAGMA data_version')[0][0]
+        if data_version == self._data_version:
+            return False
+        self._data_version = data_version
+        return True
+
+    def start(self):
+        # Take the baseline now so changes made before the first tick are not skipped
+        self._connect()
+        super().start()
+
+    def poll(self):
+        """Apply new changes; returns how many change rows were read."""
+        if self._conn is None:
+            self._connect()
+            return 0
+
+        if not self._has_new_commits():
+            return 0
+
+        # Most commits (logging, proofs text, ...) touch no cached entity
+        versions = dict(self._query('SELECT entity, version FROM entity_versions'))
+        if versions == self._versions:
+            return 0
+        self._versions = versions
+
+        rows = self._query(
+            'SELECT id, entity, entity_key FROM change_log WHERE id > :last_id ORDER BY id',
+            {'last_id': self._last_id}
+        )
+        if not rows:
+            self._check_id_reuse(versions)
+        for change_id, entity, key in rows:
+            self.cache.invalidate(entity, key)
+            if self.on_change:
+                self.on_change(entity, key)
+            self._last_id = change_id
+        return len(rows)
+
+    def _check_id_reuse(self, versions):
+        """Start over if change_log ids went backwards, dropping the whole cache.
+
+        A change_log created before AUTOINCREMENT reuses ids once it has been
+        emptied, and the changes behind the reused ids can no longer be told
+        apart from the ones already applied.
+        """
+        head = self._query('SELECT COALESCE(MAX(id), 0) FROM change_log')[0][0]
+        if head >= self._last_id:
+            return
+        logger.warning(f"change_log ids restarted ({head} < {self._last_id}), clearing the cache")
+        self._last_id = head
+        self.cache.clear()
+        if self.on_change:
+            for entity in versions:
+                self.on_change(entity, '*')
+
+    def prune(self):
+        """Delete change rows older than the retention window, always keeping the newest."""
+        cutoff = (datetime.utcnow() - self.retention).isoformat(' ')
+        with self._conn:
+            self._conn.execute(
+                'DELETE FROM change_log WHERE created_at < ? AND id < (SELECT MAX(id) FROM change_log)',
+                (cutoff,)
+            )
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.poll()
+                if time.monotonic() - self._last_prune > self.retention.total_seconds() / 4:
+                    self._last_prune = time.monotonic()
+                    self.prune()
+            except self.errors as e:
+                logger.warning(f"Change feed poll failed: {e}")
+
+    def stop(self):
+        self._stop_event.set()
+
+
+class EngineChangeFeedPoller(ChangeFeedPoller):
+    """ChangeFeedPoller for a database server reached through an SQLAlchemy engine.
+
+    Servers have no PRAGMA data_version, so every tick compares the
+    entity_versions rows, which is still one small query.
+    """
+
+    errors = (SQLAlchemyError,)
+
+    def __init__(self, engine, cache, on_change=None, interval=1.0, retention=timedelta(hours=1)):
+        super().__init__(None, cache, on_change, interval, retention)
+        self.engine = engine
+
+    def _connect(self):
+        # Autocommit, so each poll sees the latest committed rows
+        self._conn = self.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+        self._take_baseline()
+
+    def _query(self, sql, params=None):
+        return self._conn.execute(text(sql), params or {}).fetchall()
+
+    def _has_new_commits(self):
+        return True
+
+    def prune(self):
+        self._conn.execute(
+            text('DELETE FROM change_log WHERE created_at < :cutoff AND id < (SELECT MAX(id) FROM change_log)'),
+            {'cutoff': datetime.utcnow() - self.retention}
+        )
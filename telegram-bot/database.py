@@ -1,27 +1,246 @@
 """Database models and operations for the licensing system."""
 
 import os
+import re
+import json
+import time
+import tracemalloc
 import secrets
 import hashlib
+import sqlite3
+from contextlib import contextmanager, suppress
+from concurrent.futures import Future
+from dataclasses import dataclass, fields
+from functools import lru_cache, partial
 from datetime import datetime, timedelta
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, Float
+from typing import Optional
+from sqlalchemy import (create_engine, event, inspect, select, insert, update, delete, func, or_, and_, exists, bindparam,
+                        literal, literal_column, true, type_coerce, case, Column, Integer, BigInteger, String, Date,
+                        DateTime, Boolean, Float, Index,
+                        UniqueConstraint, MetaData, Table, Computed, TypeDecorator)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import make_url
+from sqlalchemy.schema import CreateSchema, CreateColumn
+from sqlalchemy.sql.expression import ColumnElement
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.exc import IntegrityError
+from cache import MISSING, EntityCache, ChangeFeedPoller, EngineChangeFeedPoller
+from instrumentation import bind_caller, instrument, trace_operations
+from license_guard import KeyHashFilter, AttemptLimiter
+from writer import GroupCommitWriter, write_operation, write_steps
+from license_tokens import TOKEN_PREFIX, is_license_token, issue_token, normalize_token, read_token
 
 Base = declarative_base()
 
+# How long a key filter miss is trusted before pulling keys issued by other processes
+KEY_FILTER_REFRESH_SECONDS = 10
+
+# How long the cached set of revoked signed tokens is trusted
+REVOCATION_REFRESH_SECONDS = 30
+
+# Group commit limits for the writer thread (see writer.py)
+WRITE_BATCH_SIZE = 64
+WRITE_BATCH_DELAY = 0.005
+
+# How long a connection waits for SQLite's write lock
+BUSY_TIMEOUT_SECONDS = 30
+
+# A checkpoint truncates the WAL back to this size instead of leaving it at its peak
+JOURNAL_SIZE_LIMIT = 64 * 1024 * 1024
+
+# Rows PRAGMA optimize samples per index, so closing stays quick on big tables
+OPTIMIZE_ANALYSIS_LIMIT = 400
+
+# Connection pool for a database server (DATABASE_URL)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+
+# Rows older than this move to monthly archive tables
+LOG_RETENTION_DAYS = int(os.getenv("LOG_RETENTION_DAYS", "90"))
+PROOF_RETENTION_DAYS = int(os.getenv("PROOF_RETENTION_DAYS", "180"))
+# Rows moved per archival transaction, so no single commit holds the write lock for long
+ARCHIVE_CHUNK_ROWS = int(os.getenv("ARCHIVE_CHUNK_ROWS", "5000"))
+
+# Conversion funnel stages in order, and the user_logs actions behind the
+# first two; proof and verified come from payment_proofs (see roll_up_funnel)
+FUNNEL_STAGES = ('intent', 'method', 'proof', 'verified')
+FUNNEL_LOG_STAGES = {'purchase_intent': 'intent', 'payment_method_selected': 'method'}
+FUNNEL_UNKNOWN = 'unknown'  # Plan or payment method of funnel rows that logged none
+
+# Reviews are rolled up once they are this old, so one still committing
+# while the rollup reads is not skipped past
+FUNNEL_REVIEW_LAG_SECONDS = 60
+
+# Schema name the analytics file is attached under (a real schema on PostgreSQL)
+ANALYTICS_SCHEMA = 'analytics'
+
+# last_active is written at most this often per user
+LAST_ACTIVE_FLUSH_SECONDS = 5 * 60
+
+# Largest batch generate_license_keys() accepts
+MAX_KEY_BATCH = 50000
+
+# max_channels granted by each plan
+PLAN_CHANNELS = {
+    'standard': 5,
+    'premium': 15,
+    'lifetime': 50
+}
+
+# Entity types recorded in the change feed (see cache.py)
+CHANGE_ENTITIES = ('license', 'license_key', 'credentials', 'proof')
+
+# Key filters, attempt limiters and the read cache are shared by every
+# Database opened on the same file or URL in this process (bot.py and its
+# panels each open one).
+_shared = {}
+
+# ==================== LOG DETAILS ====================
+# user_logs.details holds a flat JSON object. The keys below are validated
+# and exposed as generated columns (JSON1 json_extract on SQLite, ->> on
+# PostgreSQL) so funnel and attribution queries can filter and group on
+# them in SQL.
+
+LOG_DETAIL_FIELDS = {
+    'price': Float,      # Plan price shown to the user, in USD
+    'source': String,    # Bot that logged the action: user_bot, support_bot
+    'callback': String   # Callback data of the button that led here
+}
+
+LOG_DETAILS_MAX_LENGTH = 500
+
+_PRICE = re.compile(r'\d+(?:\.\d+)?')
+
+
+class JsonText(TypeDecorator):
+    """A JSON object stored as text; rows written before JSON read back as {'text': ...}."""
+    impl = String(LOG_DETAILS_MAX_LENGTH)
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None or isinstance(value, str):
+            return value
+        value = {key: item for key, item in value.items() if item is not None}
+        return json.dumps(value, separators=(',', ':'), sort_keys=True)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        try:
+            return json.loads(value)
+        except ValueError:
+            return {'text': value}
+
+
+class detail_field(ColumnElement):
+    """One key of user_logs.details, for the generated columns."""
+    inherit_cache = False
+
+    def __init__(self, field):
+        self.field = field
+        self.type = LOG_DETAIL_FIELDS[field]()
+
+
+@compiles(detail_field)
+def _detail_field_sqlite(element, compiler, **kw):
+    return f"json_extract(details, '$.{element.field}')"
+
+
+@compiles(detail_field, 'postgresql')
+def _detail_field_postgresql(element, compiler, **kw):
+    value = f"(details::jsonb ->> '{element.field}')"
+    return f"CAST({value} AS DOUBLE PRECISION)" if isinstance(element.type, Float) else value
+
+
+def log_details(details):
+    """Validate log details and return them as a dict (or None).
+
+    Accepts a dict of scalar values, or plain text, which is kept under
+    'text'. A price given as text ("$9.99/month") is reduced to its number.
+    Raises ValueError for nested values, wrongly typed fields or details
+    longer than LOG_DETAILS_MAX_LENGTH once encoded.
+    """
+    if details is None:
+        return None
+    if isinstance(details, str):
+        details = {'text': details}
+    if not isinstance(details, dict):
+        raise ValueError("Log details must be a dict")
+
+    details = {key: value for key, value in details.items() if value is not None}
+    for key, value in details.items():
+        if not isinstance(key, str) or not isinstance(value, (str, int, float, bool)):
+            raise ValueError(f"Log detail {key!r} must be a string, number or boolean")
+
+    price = details.get('price')
+    if isinstance(price, str):
+        match = _PRICE.search(price)
+        if not match:
+            raise ValueError(f"Log detail price {price!r} has no number")
+        details['price'] = float(match.group())
+    elif isinstance(price, bool):
+        raise ValueError("Log detail price must be a number")
+    for key in ('source', 'callback'):
+        if key in details and not isinstance(details[key], str):
+            raise ValueError(f"Log detail {key!r} must be a string")
+
+    if len(json.dumps(details, separators=(',', ':'))) > LOG_DETAILS_MAX_LENGTH:
+        raise ValueError(f"Log details exceed {LOG_DETAILS_MAX_LENGTH} characters")
+    return details or None
+
+
+def _legacy_details(text):
+    """Log details written before they were JSON, converted to a details dict."""
+    details = {'text': text}
+    match = re.search(r'Price: \$?(\d+(?:\.\d+)?)', text)
+    if match:
+        details['price'] = float(match.group(1))
+    return details
+
+
+def _convert_legacy_details(conn, table, chunk=10000):
+    """Rewrite the plain-text details of `table` (id, details) as JSON objects."""
+    raw = type_coerce(table.c.details, String)
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            select(table.c.id, raw).where(table.c.id > last_id, table.c.details.isnot(None))
+            .order_by(table.c.id).limit(chunk)
+        ).all()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        legacy = []
+        for log_id, text in rows:
+            try:
+                if isinstance(json.loads(text), dict):
+                    continue
+            except ValueError:
+                pass
+            legacy.append({'log_id': log_id, 'new_details': _legacy_details(text)})
+        if legacy:
+            conn.execute(
+                update(table).where(table.c.id == bindparam('log_id'))
+                .values(details=bindparam('new_details', type_=JsonText)),
+                legacy
+            )
+
+
 class License(Base):
     """License key model."""
     __tablename__ = 'licenses'
 
     id = Column(Integer, primary_key=True)
     license_key = Column(String(64), unique=True, nullable=False)
-    key_hash = Column(String(64), nullable=False)  # Hashed version for verification
+    key_hash = Column(String(64), nullable=False, index=True)  # Hashed version for verification
     status = Column(String(20), default='inactive')  # inactive, active, expired, revoked
     created_at = Column(DateTime, default=datetime.utcnow)
     activated_at = Column(DateTime, nullable=True)
     expires_at = Column(DateTime, nullable=True)
-    user_id = Column(Integer, nullable=True)
+    user_id = Column(BigInteger, nullable=True)
     username = Column(String(100), nullable=True)
     device_fingerprint = Column(String(128), nullable=True)
     plan_type = Column(String(20), default='standard')  # standard, premium, lifetime
@@ -30,13 +249,20 @@ class License(Base):
     used_activation_count = Column(Integer, default=0)
     max_activations = Column(Integer, default=1)  # How many times key can be used
 
+    __table_args__ = (
+        # Range scans for expiry reminders and bulk expiry filters
+        Index('ix_licenses_status_expires_at', 'status', 'expires_at'),
+        # A user's active license
+        Index('ix_licenses_user_id_status', 'user_id', 'status'),
+    )
+
 
 class User(Base):
     """User model for tracking registered users."""
     __tablename__ = 'users'
 
     id = Column(Integer, primary_key=True)
-    telegram_id = Column(Integer, unique=True, nullable=False)
+    telegram_id = Column(BigInteger, unique=True, nullable=False)
     username = Column(String(100), nullable=True)
     first_name = Column(String(100), nullable=True)
     license_key = Column(String(64), nullable=True)
@@ -50,7 +276,7 @@ class Payment(Base):
     __tablename__ = 'payments'
 
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, nullable=False)
+    user_id = Column(BigInteger, nullable=False)
     amount = Column(Float, nullable=False)
     currency = Column(String(10), default='USD')
     payment_method = Column(String(50), nullable=True)
@@ -64,16 +290,33 @@ class Payment(Base):
 class UserLog(Base):
     """User activity logs for tracking interactions and future subscriptions."""
     __tablename__ = 'user_logs'
+    __table_args__ = (
+        # A user's latest logs
+        Index('ix_user_logs_user_id_created_at', 'user_id', 'created_at'),
+        # Recent logs of one action, grouped by user without reading the table
+        Index('ix_user_logs_action_created_at_user_id', 'action', 'created_at', 'user_id'),
+        # Filters on the JSON details (see LOG_DETAIL_FIELDS)
+        Index('ix_user_logs_source_created_at', 'source', 'created_at'),
+        Index('ix_user_logs_callback', 'callback'),
+        Index('ix_user_logs_price', 'price'),
+        {'schema': ANALYTICS_SCHEMA}  # Lives in the analytics file
+    )
 
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, nullable=False)
+    user_id = Column(BigInteger, nullable=False)
     username = Column(String(100), nullable=True)
     first_name = Column(String(100), nullable=True)
     action = Column(String(50), nullable=False)  # purchase_intent, payment_method_selected, support_contacted, etc.
     plan_type = Column(String(20), nullable=True)  # standard, premium, lifetime
     payment_method = Column(String(50), nullable=True)  # btc, eth, usdt, paypal
-    details = Column(String(500), nullable=True)  # Additional JSON or text data
-    created_at = Column(DateTime, default=datetime.utcnow)
+    details = Column(JsonText, nullable=True)  # JSON object, see log_details()
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+    # Generated from details; never written directly. STORED because PostgreSQL
+    # (before 18) has no virtual generated columns; see _add_log_detail_columns
+    price = Column(Float, Computed(detail_field('price'), persisted=True))
+    source = Column(String(50), Computed(detail_field('source'), persisted=True))
+    callback = Column(String(64), Computed(detail_field('callback'), persisted=True))
 
 
 class PaymentCredential(Base):
@@ -81,7 +324,7 @@ class PaymentCredential(Base):
     __tablename__ = 'payment_credentials'
 
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, nullable=False, index=True)
+    user_id = Column(BigInteger, nullable=False, index=True)
     username = Column(String(100), nullable=True)
     first_name = Column(String(100), nullable=True)
 
@@ -112,7 +355,7 @@ class PaymentProof(Base):
     __tablename__ = 'payment_proofs'
 
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, nullable=False, index=True)
+    user_id = Column(BigInteger, nullable=False, index=True)
     username = Column(String(100), nullable=True)
     first_name = Column(String(100), nullable=True)
 
@@ -130,63 +373,1155 @@ class PaymentProof(Base):
 
     # Status
     status = Column(String(20), default='pending')  # pending, verified, rejected
-    verified_by = Column(Integer, nullable=True)  # Admin ID who verified
+    verified_by = Column(BigInteger, nullable=True)  # Admin ID who verified
     verified_at = Column(DateTime, nullable=True)
     notes = Column(String(500), nullable=True)  # Admin notes
 
     # Timestamps
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+    __table_args__ = (
+        # The admin review queue: pending proofs, newest first
+        Index('ix_payment_proofs_status_created_at', 'status', 'created_at'),
+        # Proofs verified since the last funnel rollup
+        Index('ix_payment_proofs_status_verified_at', 'status', 'verified_at'),
+    )
+
+
+class LicenseReminder(Base):
+    """Renewal reminders already sent, one per license expiry date."""
+    __tablename__ = 'license_reminders'
 
+    id = Column(Integer, primary_key=True)
+    license_id = Column(Integer, nullable=False)
+    user_id = Column(BigInteger, nullable=False)
+    expires_at = Column(DateTime, nullable=False)  # Expiry the reminder was about
+    sent_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        UniqueConstraint('license_id', 'expires_at', name='uq_license_reminders_license_expiry'),
+    )
+
+
+class MaintenanceRun(Base):
+    """Metrics from one maintenance pass over a database file."""
+    __tablename__ = 'maintenance_runs'
+
+    id = Column(Integer, primary_key=True)
+    db_file = Column(String(200), nullable=False)
+    started_at = Column(DateTime, default=datetime.utcnow)
+    duration_ms = Column(Integer, nullable=False)
+    size_before = Column(Integer, nullable=False)  # Bytes, database plus WAL
+    size_after = Column(Integer, nullable=False)
+    freelist_before = Column(Integer, nullable=True)  # Free pages
+    freelist_after = Column(Integer, nullable=True)
+    analyzed = Column(Boolean, default=False)
+    checkpoint_mode = Column(String(20), nullable=True)  # PASSIVE, TRUNCATE
+    checkpointed_pages = Column(Integer, nullable=True)
+    converted_to_incremental = Column(Boolean, default=False)
+
+
+class EntityVersion(Base):
+    """Current change feed version of each entity type."""
+    __tablename__ = 'entity_versions'
+
+    entity = Column(String(20), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+class ChangeLog(Base):
+    """Change feed: one row per write that affects cached reads."""
+    __tablename__ = 'change_log'
+    # Pollers read "id > last seen"; ids must not be handed out again once pruned
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    id = Column(Integer, primary_key=True)
+    entity = Column(String(20), nullable=False)  # license, license_key, credentials, proof
+    entity_key = Column(String(64), nullable=False)  # user id, or key hash for license_key
+    version = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+
+class LicenseEvent(Base):
+    """One license state transition, appended by every write that changes state."""
+    __tablename__ = 'license_events'
+
+    id = Column(Integer, primary_key=True)
+    license_id = Column(Integer, nullable=False, index=True)
+    event = Column(String(20), nullable=False)  # created, activated, expired, revoked, extended, plan_changed
+    from_plan = Column(String(20), nullable=True)  # NULL for created
+    from_status = Column(String(20), nullable=True)
+    to_plan = Column(String(20), nullable=False)
+    to_status = Column(String(20), nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)  # For expired: the expiry itself
+
+
+class LicenseSnapshot(Base):
+    """License counts per plan and status at one point in time."""
+    __tablename__ = 'license_snapshots'
+
+    id = Column(Integer, primary_key=True)
+    taken_at = Column(DateTime, nullable=False, index=True)
+    last_event_id = Column(Integer, nullable=False)  # license_events up to this id are counted
+    plan_type = Column(String(20), nullable=False)
+    status = Column(String(20), nullable=False)
+    count = Column(Integer, nullable=False)
+
+
+class FunnelDay(Base):
+    """Conversion funnel count for one day, stage, plan and payment method."""
+    __tablename__ = 'funnel_daily'
+    __table_args__ = (
+        # Also the upsert target of roll_up_funnel
+        UniqueConstraint('day', 'stage', 'plan_type', 'payment_method', name='uq_funnel_daily'),
+        {'schema': ANALYTICS_SCHEMA}  # Next to the user_logs it is rolled up from
+    )
+
+    id = Column(Integer, primary_key=True)
+    day = Column(Date, nullable=False)
+    stage = Column(String(20), nullable=False)  # See FUNNEL_STAGES
+    plan_type = Column(String(20), nullable=False)  # FUNNEL_UNKNOWN when not logged
+    payment_method = Column(String(50), nullable=False)
+    count = Column(Integer, nullable=False)
+
+
+class FunnelWatermark(Base):
+    """How far roll_up_funnel has read one of its sources."""
+    __tablename__ = 'funnel_watermarks'
+    __table_args__ = {'schema': ANALYTICS_SCHEMA}
+
+    source = Column(String(20), primary_key=True)  # logs, proofs, reviews
+    last_id = Column(Integer, nullable=False, default=0)  # logs, proofs: rows up to this id are counted
+    last_at = Column(DateTime, nullable=True)  # reviews: proofs verified up to this time are counted
+    updated_at = Column(DateTime, nullable=False)
+
+
+# ==================== READ SNAPSHOTS ====================
+# Database read APIs return these frozen, slotted records instead of live ORM
+# objects, so results can be cached and shared without touching the session.
+# __slots__ is spelled out because dataclass(slots=True) needs Python 3.10.
+
+@dataclass(frozen=True)
+class UserRecord:
+    """Read-only copy of a users row."""
+    __slots__ = ('id', 'telegram_id', 'username', 'first_name', 'license_key', 'registered_at',
+                 'last_active', 'is_premium')
+
+    id: int
+    telegram_id: int
+    username: Optional[str]
+    first_name: Optional[str]
+    license_key: Optional[str]
+    registered_at: Optional[datetime]
+    last_active: Optional[datetime]
+    is_premium: Optional[bool]
+
+
+@dataclass(frozen=True)
+class LicenseRecord:
+    """Read-only copy of a licenses row."""
+    __slots__ = ('id', 'license_key', 'key_hash', 'status', 'created_at', 'activated_at',
+                 'expires_at', 'user_id', 'username', 'device_fingerprint', 'plan_type',
+                 'max_channels', 'auto_post_enabled', 'used_activation_count',
+                 'max_activations')
+
+    id: int
+    license_key: str
+    key_hash: str
+    status: Optional[str]
+    created_at: Optional[datetime]
+    activated_at: Optional[datetime]
+    expires_at: Optional[datetime]
+    user_id: Optional[int]
+    username: Optional[str]
+    device_fingerprint: Optional[str]
+    plan_type: Optional[str]
+    max_channels: Optional[int]
+    auto_post_enabled: Optional[bool]
+    used_activation_count: Optional[int]
+    max_activations: Optional[int]
+
+    @property
+    def days_left(self):
+        """Whole days until expiry, or None for lifetime licenses."""
+        if not self.expires_at:
+            return None
+        return (self.expires_at - datetime.utcnow()).days
+
+
+@dataclass(frozen=True)
+class CredentialRecord:
+    """Read-only copy of a payment_credentials row."""
+    __slots__ = ('id', 'user_id', 'username', 'first_name', 'payment_method', 'btc_address',
+                 'eth_address', 'usdt_address', 'paypal_email', 'card_last_four',
+                 'preferred_method', 'is_default', 'created_at', 'updated_at', 'notes')
+
+    id: int
+    user_id: int
+    username: Optional[str]
+    first_name: Optional[str]
+    payment_method: str
+    btc_address: Optional[str]
+    eth_address: Optional[str]
+    usdt_address: Optional[str]
+    paypal_email: Optional[str]
+    card_last_four: Optional[str]
+    preferred_method: Optional[str]
+    is_default: Optional[bool]
+    created_at: Optional[datetime]
+    updated_at: Optional[datetime]
+    notes: Optional[str]
+
+
+@dataclass(frozen=True)
+class ProofRecord:
+    """Read-only copy of a payment_proofs row."""
+    __slots__ = ('id', 'user_id', 'username', 'first_name', 'plan_type', 'payment_method',
+                 'amount_sent', 'to_address', 'transaction_id', 'from_address',
+                 'screenshot_path', 'message_text', 'status', 'verified_by', 'verified_at',
+                 'notes', 'created_at', 'updated_at')
+
+    id: int
+    user_id: int
+    username: Optional[str]
+    first_name: Optional[str]
+    plan_type: Optional[str]
+    payment_method: str
+    amount_sent: Optional[str]
+    to_address: str
+    transaction_id: Optional[str]
+    from_address: Optional[str]
+    screenshot_path: Optional[str]
+    message_text: Optional[str]
+    status: Optional[str]
+    verified_by: Optional[int]
+    verified_at: Optional[datetime]
+    notes: Optional[str]
+    created_at: Optional[datetime]
+    updated_at: Optional[datetime]
+
+
+@dataclass(frozen=True)
+class LogRecord:
+    """Read-only copy of a user_logs row."""
+    __slots__ = ('id', 'user_id', 'username', 'first_name', 'action', 'plan_type',
+                 'payment_method', 'details', 'created_at')
+
+    id: int
+    user_id: int
+    username: Optional[str]
+    first_name: Optional[str]
+    action: str
+    plan_type: Optional[str]
+    payment_method: Optional[str]
+    details: Optional[dict]
+    created_at: Optional[datetime]
+
+
+@dataclass(frozen=True)
+class RetargetRecord:
+    """A user with recent purchase intent and no active license."""
+    __slots__ = ('user_id', 'username', 'first_name', 'last_intent_at', 'plan_type', 'payment_method')
+
+    user_id: int
+    username: Optional[str]
+    first_name: Optional[str]
+    last_intent_at: datetime
+    plan_type: Optional[str]  # Latest plan the user logged
+    payment_method: Optional[str]  # Latest payment method the user logged
+
+
+@dataclass(frozen=True)
+class UserAggregate:
+    """Everything the handlers render about one user, loaded in one pass."""
+    __slots__ = ('telegram_id', 'user', 'license', 'credentials', 'default_credential',
+                 'recent_proofs')
+
+    telegram_id: int
+    user: Optional[UserRecord]
+    license: Optional[LicenseRecord]
+    credentials: tuple
+    default_credential: Optional[CredentialRecord]
+    recent_proofs: tuple
+
+
+def _write_engine(url, connect_args, **kwargs):
+    """Engine for a writer thread.
+
+    It leaves transaction control to SQLAlchemy, because pysqlite's own
+    handling breaks SAVEPOINT. Each transaction starts with BEGIN IMMEDIATE,
+    so a batch takes the write lock up front instead of failing when it
+    upgrades from a read lock.
+    """
+    engine = create_engine(url, connect_args=connect_args, **kwargs)
+
+    @event.listens_for(engine, 'connect')
+    def _on_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+        # WAL lets the bots keep reading while a batch commits
+        dbapi_connection.execute('PRAGMA journal_mode=WAL')
+        # Per connection, and these are the ones whose commits checkpoint
+        dbapi_connection.execute(f'PRAGMA journal_size_limit={JOURNAL_SIZE_LIMIT}')
+
+    @event.listens_for(engine, 'begin')
+    def _on_begin(connection):
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
+
+    return engine
+
+
+def _optimize_on_close(engine):
+    """Run PRAGMA optimize on each pooled connection as it closes.
+
+    SQLite only analyzes tables that queries on the same connection would
+    have planned better with statistics, so on a fresh connection (as in
+    maintenance.py) it does nothing before 3.46. The bots' connections live
+    for the whole process and have seen every hot query.
+    """
+    @event.listens_for(engine, 'close')
+    def _on_close(dbapi_connection, connection_record):
+        # Raising here would leave the connection open; a busy file just skips it
+        with suppress(sqlite3.Error):
+            dbapi_connection.execute(f'PRAGMA analysis_limit={OPTIMIZE_ANALYSIS_LIMIT}')
+            dbapi_connection.execute('PRAGMA optimize')
+
+
+def _create_engines(db_path, analytics_path):
+    """Engines for reads, for licensing writes and for analytics writes.
+
+    Connections may be used from the writer and poller threads, hence
+    check_same_thread=False. The read engine ATTACHes the analytics file so
+    reads can join across both files. The writers open one file each: a
+    write transaction locks every attached database, so logging bursts and
+    license activations must not share a connection.
+    """
+    connect_args = {'check_same_thread': False, 'timeout': BUSY_TIMEOUT_SECONDS}
+    engine = create_engine(f'sqlite:///{db_path}', connect_args=connect_args)
+
+    @event.listens_for(engine, 'connect')
+    def _attach_analytics(dbapi_connection, connection_record):
+        # Only takes effect on new files; old ones need "maintenance.py --convert" offline
+        dbapi_connection.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        dbapi_connection.execute(f'ATTACH DATABASE ? AS {ANALYTICS_SCHEMA}', (analytics_path,))
+        dbapi_connection.execute(f'PRAGMA {ANALYTICS_SCHEMA}.auto_vacuum=INCREMENTAL')
+
+    if db_path == ':memory:':
+        return engine, None, None
+
+    write_engine = _write_engine(f'sqlite:///{db_path}', connect_args)
+    # Analytics tables live in the main schema of their own file
+    analytics_engine = _write_engine(
+        f'sqlite:///{analytics_path}', connect_args,
+        execution_options={'schema_translate_map': {ANALYTICS_SCHEMA: None}}
+    )
+    for file_engine in (engine, write_engine, analytics_engine):
+        _optimize_on_close(file_engine)
+    return engine, write_engine, analytics_engine
+
+
+def _server_url(url):
+    """Parse DATABASE_URL; plain postgres:// URLs get the psycopg 3 driver."""
+    url = make_url(url)
+    if url.drivername in ('postgres', 'postgresql'):
+        url = url.set(drivername='postgresql+psycopg')
+    if url.get_backend_name() != 'postgresql':
+        raise ValueError(f"Unsupported DATABASE_URL backend: {url.get_backend_name()}")
+    return url
+
+
+def _create_server_engine(url):
+    """Pooled engine for a PostgreSQL server, shared by reads and both writers.
+
+    The analytics tables go into their own schema instead of a second file.
+    """
+    engine = create_engine(
+        _server_url(url),
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_pre_ping=True  # Survive server restarts and idle timeouts
+    )
+    with engine.begin() as conn:
+        conn.execute(CreateSchema(ANALYTICS_SCHEMA, if_not_exists=True))
+    return engine
+
+
+# ==================== ARCHIVES ====================
+# Old user_logs and payment_proofs rows move to one table per month, e.g.
+# user_logs_2026_01, next to the hot table in the same database file.
+
+ARCHIVE_MONTH = re.compile(r'^\d{4}_\d{2}$')
+_archive_metadata = MetaData()
+
+
+def _stored_columns(table):
+    """Columns of `table` that hold data, leaving out generated ones."""
+    return [column for column in table.columns if column.computed is None]
+
+
+@lru_cache(maxsize=None)
+def _archive_table(model, month):
+    """Table object for one month's archive of `model`'s table."""
+    if not ARCHIVE_MONTH.match(month):
+        raise ValueError(f"Invalid archive month: {month}")
+    source = model.__table__
+    return Table(
+        f'{source.name}_{month}', _archive_metadata,
+        *[Column(column.name, column.type, primary_key=column.primary_key) for column in _stored_columns(source)],
+        schema=source.schema
+    )
+
+
+@lru_cache(maxsize=None)
+def _columns(record_cls, model):
+    """Table columns of `model` in the field order of `record_cls`."""
+    table = model.__table__
+    return tuple(table.c[field.name] for field in fields(record_cls))
+
+
+def _dialect_insert(dialect, table):
+    """INSERT for `table` with ON CONFLICT support for the named dialect."""
+    return (sqlite_insert if dialect == 'sqlite' else pg_insert)(table)
+
+
+# ==================== PREBUILT STATEMENTS ====================
+# The hot reads run these module-level Core statements with bound parameters.
+# Building a select() per call, and hashing it for SQLAlchemy's compiled
+# cache, cost more than SQLite spent answering the query (see benchmark.py).
+
+_licenses = License.__table__
+_users = User.__table__
+_credentials = PaymentCredential.__table__
+
+LICENSE_BY_HASH = (
+    select(*_columns(LicenseRecord, License))
+    .where(_licenses.c.key_hash == bindparam('key_hash'))
+    .limit(1)
+)
+
+ACTIVE_LICENSE_BY_USER = (
+    select(*_columns(LicenseRecord, License))
+    .where(_licenses.c.user_id == bindparam('user_id'), _licenses.c.status == 'active')
+    .limit(1)
+)
+
+USER_BY_TELEGRAM_ID = (
+    select(*_columns(UserRecord, User))
+    .where(_users.c.telegram_id == bindparam('telegram_id'))
+    .limit(1)
+)
+
+CREDENTIALS_BY_USER = (
+    select(*_columns(CredentialRecord, PaymentCredential))
+    .where(_credentials.c.user_id == bindparam('user_id'))
+    .order_by(_credentials.c.id)
+)
+
+RECENT_PROOFS_BY_USER = (
+    select(*_columns(ProofRecord, PaymentProof))
+    .where(PaymentProof.__table__.c.user_id == bindparam('user_id'))
+    .order_by(PaymentProof.__table__.c.created_at.desc())
+    .limit(bindparam('proof_limit'))
+)
+
+
+def _user_aggregate_select():
+    """One round trip for load_user_aggregate.
+
+    Each part is left-joined onto a single constant row, so a missing user,
+    license, credential or proof just leaves its columns NULL. The result
+    has credentials x proofs rows at most; the caller folds them back.
+    """
+    parts = (USER_BY_TELEGRAM_ID.subquery('u'), ACTIVE_LICENSE_BY_USER.subquery('l'),
+             CREDENTIALS_BY_USER.subquery('c'), RECENT_PROOFS_BY_USER.subquery('p'))
+    joined = select(literal_column('1').label('anchor')).subquery('anchor')
+    for part in parts:
+        joined = joined.outerjoin(part, true())
+    user, license, credentials, proofs = parts
+    return (
+        select(*user.c, *license.c, *credentials.c, *proofs.c)
+        .select_from(joined)
+        .order_by(credentials.c.id, proofs.c.created_at.desc())
+    )
+
+
+USER_AGGREGATE = _user_aggregate_select()
+
+
+@lru_cache(maxsize=None)
+def _user_upsert(dialect):
+    """INSERT ... ON CONFLICT DO UPDATE for users, built once per dialect.
+
+    The WHERE clause skips the update when no supplied name differs, in
+    which case nothing is returned.
+    """
+    stmt = _dialect_insert(dialect, _users).values(
+        telegram_id=bindparam('telegram_id'),
+        username=bindparam('username'),
+        first_name=bindparam('first_name'),
+        registered_at=bindparam('now'),
+        last_active=bindparam('now'),
+        is_premium=False
+    )
+    excluded = stmt.excluded
+    return stmt.on_conflict_do_update(
+        index_elements=[_users.c.telegram_id],
+        set_={
+            'username': func.coalesce(excluded.username, _users.c.username),
+            'first_name': func.coalesce(excluded.first_name, _users.c.first_name)
+        },
+        where=or_(
+            and_(excluded.username.isnot(None), excluded.username.is_distinct_from(_users.c.username)),
+            and_(excluded.first_name.isnot(None), excluded.first_name.is_distinct_from(_users.c.first_name))
+        )
+    ).returning(*_columns(UserRecord, User))
+
+
+@trace_operations
 class Database:
     """Database manager."""
 
-    def __init__(self, db_path='bot_database.db'):
-        self.engine = create_engine(f'sqlite:///{db_path}')
+    def __init__(self, db_path='bot_database.db', signing_key=None, analytics_path=None, url=None):
+        # DATABASE_URL selects a PostgreSQL server; a sqlite:/// URL just names the file
+        url = url or os.getenv("DATABASE_URL")
+        if url and make_url(url).get_backend_name() == 'sqlite':
+            db_path, url = make_url(url).database or ':memory:', None
+        self.url = url
+
+        if url:
+            self.engine = self.write_engine = self.analytics_engine = _create_server_engine(url)
+            db_path = analytics_path = None
+        else:
+            # High-churn analytics tables (user_logs) live in their own file
+            if analytics_path is None:
+                analytics_path = os.getenv("ANALYTICS_DB_PATH") or (
+                    ':memory:' if db_path == ':memory:' else os.path.splitext(db_path)[0] + '_analytics.db'
+                )
+            self.engine, self.write_engine, self.analytics_engine = _create_engines(db_path, analytics_path)
+        self.analytics_path = analytics_path
+        self.is_sqlite = self.engine.dialect.name == 'sqlite'
+        for engine in (self.engine, self.write_engine, self.analytics_engine):
+            if engine is not None:
+                instrument(engine)
+
         Base.metadata.create_all(self.engine)
-        Session = sessionmaker(bind=self.engine)
-        self.session = Session()
+        if self.is_sqlite:
+            self._move_logs_to_analytics()
+        self._add_log_detail_columns()
+        self._create_missing_indexes()
+        # Reads never commit, so on PostgreSQL the read session's transaction would
+        # stay open between them ("idle in transaction", holding back vacuum).
+        # There each read runs in autocommit instead; pysqlite does not open a
+        # transaction for reads at all.
+        # Streaming reads need a transaction for their server-side cursor; see _read_session
+        self._session_factory = sessionmaker(bind=self.engine, expire_on_commit=False)
+        read_bind = self.engine if self.is_sqlite else self.engine.execution_options(isolation_level='AUTOCOMMIT')
+        self.session = self._session_factory(bind=read_bind)
+
+        # Optional HMAC key for signed license tokens (see license_tokens.py)
+        signing_key = signing_key or os.getenv("LICENSE_SIGNING_KEY")
+        self.signing_key = signing_key.encode() if signing_key else None
+
+        self._ensure_entity_versions()
+
+        shared_key = url or db_path
+        if db_path == ':memory:' or shared_key not in _shared:
+            shared = {
+                'filter': self.load_key_filter(),
+                'limiter': AttemptLimiter(),
+                'revoked': set(),
+                'revoked_at': None,
+                'cache': EntityCache(),
+                'poller': None,
+                'last_active': {},
+                'last_active_flushed': time.monotonic(),
+                'writer': self._start_writer(self.write_engine),
+                'analytics_writer': self._start_writer(self.analytics_engine)
+            }
+            if db_path != ':memory:':
+                _shared[shared_key] = shared
+        else:
+            shared = _shared[shared_key]
+        self._shared = shared
+        self.db_path = db_path
+
+    @property
+    def writer(self):
+        return self._shared['writer']
+
+    @property
+    def analytics_writer(self):
+        return self._shared['analytics_writer']
+
+    def _start_writer(self, engine):
+        """Start a group-commit writer thread (not used for :memory:)."""
+        if engine is None:
+            return None
+        writer = GroupCommitWriter(
+            sessionmaker(bind=engine, expire_on_commit=False),
+            max_batch=WRITE_BATCH_SIZE,
+            max_delay=WRITE_BATCH_DELAY,
+            after_commit=self._invalidate_committed
+        )
+        writer.start()
+        return writer
+
+    def _submit(self, op, analytics=False):
+        """Queue a write operation; returns a concurrent.futures.Future."""
+        writer = self.analytics_writer if analytics else self.writer
+        if writer is not None:
+            return writer.submit(bind_caller(op))
+
+        future = Future()
+        try:
+            future.set_result(self._write(op, analytics))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def _write(self, op, analytics=False):
+        """Run `op(session)` in a group commit and return its result.
+
+        Operations on analytics tables go to the analytics file's writer.
+        In-memory databases have no writer threads (their connections would
+        see a different database), so the operation runs on self.session.
+        """
+        writer = self.analytics_writer if analytics else self.writer
+        if writer is not None:
+            return writer.submit(bind_caller(op)).result()
+
+        try:
+            result = op(self.session)
+        except Exception:
+            self.session.rollback()
+            self.session.info.pop('invalidations', None)
+            raise
+        self.session.commit()
+        self._invalidate_committed(self.session)
+        return result
+
+    @contextmanager
+    def _read_session(self):
+        """A short-lived session whose transaction ends with the block.
+
+        Used for reads made off the event loop's thread (self.session is
+        not thread-safe) and for streaming reads: on PostgreSQL, yield_per
+        opens a server-side cursor, which needs a transaction that the
+        autocommit self.session does not have. In-memory databases have a
+        single connection and no writer threads, so they keep self.session.
+        """
+        if self.write_engine is None:
+            yield self.session
+            return
+        with self._session_factory() as session:
+            yield session
+
+    # Dialect helpers (SQLite and PostgreSQL)
+    def _insert(self, model):
+        """INSERT for `model` with the dialect's ON CONFLICT support."""
+        return _dialect_insert(self.engine.dialect.name, model)
+
+    def _month_of(self, column):
+        """SQL expression giving the 'YYYY_MM' month of a datetime column."""
+        if self.is_sqlite:
+            return func.strftime('%Y_%m', column)
+        return func.to_char(column, 'YYYY_MM')
+
+    def _move_logs_to_analytics(self):
+        """One-off migration of user_logs from the main file to the analytics file."""
+        with self.engine.connect() as conn:
+            exists_in_main = conn.exec_driver_sql(
+                "SELECT 1 FROM main.sqlite_master WHERE type = 'table' AND name = 'user_logs'"
+            ).first()
+            if not exists_in_main:
+                return
+
+            # The analytics copy indexes the JSON details, so they must be JSON first
+            _convert_legacy_details(conn, Table(
+                'user_logs', MetaData(), Column('id', Integer, primary_key=True), Column('details', JsonText),
+                schema='main'
+            ))
+            columns = ', '.join(column.name for column in _stored_columns(UserLog.__table__))
+            conn.exec_driver_sql(
+                f"INSERT OR IGNORE INTO {ANALYTICS_SCHEMA}.user_logs ({columns}) "
+                f"SELECT {columns} FROM main.user_logs"
+            )
+            conn.exec_driver_sql("DROP TABLE main.user_logs")
+            conn.commit()
+
+    def _add_log_detail_columns(self):
+        """One-off migration of user_logs to JSON details with generated columns.
+
+        Details written as plain text are rewritten as JSON objects first
+        (see _legacy_details), since the generated columns and their indexes
+        only accept JSON. Then the generated columns are added. SQLite cannot
+        add a STORED generated column to an existing table, so there they are
+        added as VIRTUAL; they read and index the same, only computed on read.
+        """
+        table = UserLog.__table__
+        with self.engine.connect() as conn:
+            existing = {column['name'] for column in inspect(conn).get_columns(table.name, schema=table.schema)}
+            missing = [column for column in table.columns if column.name not in existing]
+            if not missing:
+                return
+
+            _convert_legacy_details(conn, table)
+            preparer = conn.dialect.identifier_preparer
+            for column in missing:
+                if self.is_sqlite and column.computed is not None:
+                    column = Column(column.name, column.type, Computed(column.computed.sqltext, persisted=False))
+                spec = CreateColumn(column).compile(dialect=conn.dialect)
+                conn.exec_driver_sql(f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {spec}")
+            conn.commit()
+
+    def _create_missing_indexes(self):
+        """Add indexes declared after a table was first created.
+
+        create_all() skips tables that already exist, so new indexes would
+        otherwise never reach an existing database file.
+        """
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(self.engine, checkfirst=True)
+
+    # Change feed
+    @property
+    def cache(self):
+        return self._shared['cache']
+
+    def _ensure_entity_versions(self):
+        """Create the entity_versions rows the change feed bumps."""
+        existing = set(self.session.execute(select(EntityVersion.entity)).scalars())
+        missing = [{'entity': entity, 'version': 0} for entity in CHANGE_ENTITIES if entity not in existing]
+        if missing:
+            try:
+                self.session.execute(insert(EntityVersion), missing)
+                self.session.commit()
+            except IntegrityError:
+                # Another process seeded them first
+                self.session.rollback()
+
+    @staticmethod
+    def _record_change(session, entity, key):
+        """Add a change feed row to the session's current transaction.
+
+        The local cache entry is dropped once the transaction commits; other
+        processes drop theirs when their ChangeFeedPoller sees the row.
+        """
+        key = str(key)
+        session.execute(
+            update(EntityVersion).where(EntityVersion.entity == entity)
+            .values(version=EntityVersion.version + 1)
+        )
+        session.execute(
+            insert(ChangeLog).values(
+                entity=entity,
+                entity_key=key,
+                version=select(EntityVersion.version)
+                .where(EntityVersion.entity == entity).scalar_subquery()
+            )
+        )
+        session.info.setdefault('invalidations', []).append((entity, key))
+
+    def _invalidate_committed(self, session):
+        """Drop the cache entries changed by a committed transaction."""
+        for entity, key in session.info.pop('invalidations', ()):
+            self.cache.invalidate(entity, key)
+
+    def _apply_remote_change(self, entity, key):
+        """Called by the poller for changes written by any connection."""
+        if entity == 'license_key':
+            if key == '*':
+                # A batch was inserted; pull it in on the next filter miss
+                self.key_filter.refreshed_at = 0.0
+            else:
+                self.key_filter.add(key)
+
+    def start_change_feed(self, interval=1.0):
+        """Start the background poller that keeps this process's cache fresh."""
+        if self.db_path == ':memory:' or self._shared['poller']:
+            return self._shared['poller']
+
+        if self.is_sqlite:
+            poller = ChangeFeedPoller(
+                self.db_path, self.cache, on_change=self._apply_remote_change, interval=interval
+            )
+        else:
+            poller = EngineChangeFeedPoller(
+                self.engine, self.cache, on_change=self._apply_remote_change, interval=interval
+            )
+        poller.start()
+        self._shared['poller'] = poller
+        return poller
+
+    def warm_up(self):
+        """Preload every known user and their active license into the cache.
+
+        One streaming LEFT JOIN of users against active licenses, so users
+        without a license get a cached "no license" entry as well. Each user
+        takes two cache entries; when they do not all fit, the most recently
+        active users are loaded and the rest are left out. Returns counts,
+        the resulting cache size and the time and memory the pass took.
+        """
+        started = time.perf_counter()
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        memory_before = tracemalloc.get_traced_memory()[0]
+
+        user_columns = _columns(UserRecord, User)
+        license_columns = _columns(LicenseRecord, License)
+        split = len(user_columns)
+        capacity = self.cache.max_entries // 2
+        users = licenses = 0
+        seen = set()
+        with self._read_session() as reader:
+            rows = reader.execute(
+                select(*user_columns, *license_columns)
+                .outerjoin(License, and_(License.user_id == User.telegram_id, License.status == 'active'))
+                .order_by(User.last_active.desc().nulls_last())
+                .execution_options(yield_per=5000)
+            )
+            for row in rows:
+                if users >= capacity:
+                    rows.close()
+                    break
+                user = UserRecord(*row[:split])
+                license_row = row[split:]
+                telegram_id = user.telegram_id
+                if telegram_id in seen:
+                    continue  # keep the first active license, as get_user_license does
+                seen.add(telegram_id)
+                users += 1
+                record = LicenseRecord(*license_row) if license_row[0] is not None else None
+                if record:
+                    licenses += 1
+                self.cache.set('user', str(telegram_id), user)
+                self.cache.set('license', str(telegram_id), record)
+
+        memory_used = tracemalloc.get_traced_memory()[0] - memory_before
+        if not tracing:
+            tracemalloc.stop()
+
+        return {
+            'users': users,
+            'licenses': licenses,
+            'cached': len(self.cache),
+            'seconds': time.perf_counter() - started,
+            'memory_kb': memory_used / 1024
+        }
+
+    # Key filter
+    @property
+    def key_filter(self):
+        return self._shared['filter']
+
+    @property
+    def activation_limiter(self):
+        return self._shared['limiter']
+
+    def load_key_filter(self):
+        """Build the key hash filter in one streaming pass over licenses."""
+        with self._read_session() as reader:
+            total = reader.execute(select(func.count(License.id))).scalar()
+            key_filter = KeyHashFilter(capacity=total * 2)
+
+            rows = reader.execute(
+                select(License.id, License.key_hash).execution_options(yield_per=5000)
+            )
+            for license_id, key_hash in rows:
+                key_filter.add(key_hash, license_id)
+
+        key_filter.refreshed_at = time.monotonic()
+        return key_filter
+
+    def refresh_key_filter(self):
+        """Add keys issued since the last refresh, rebuilding if the filter is full."""
+        key_filter = self.key_filter
+        if key_filter.is_saturated:
+            self._shared['filter'] = self.load_key_filter()
+            return
+
+        rows = self.session.execute(
+            select(License.id, License.key_hash).where(License.id > key_filter.max_id)
+        )
+        for license_id, key_hash in rows:
+            key_filter.add(key_hash, license_id)
+        key_filter.refreshed_at = time.monotonic()
+
+    def _key_may_exist(self, key_hash):
+        """Check the key filter; a miss never touches the licenses table."""
+        if key_hash in self.key_filter:
+            return True
+
+        # Keys generated by another bot process only show up after a refresh
+        if time.monotonic() - self.key_filter.refreshed_at < KEY_FILTER_REFRESH_SECONDS:
+            return False
+
+        self.refresh_key_filter()
+        return key_hash in self.key_filter
+
+    @staticmethod
+    def _key_hash(key):
+        """Storage hash of a key; signed tokens are normalised first."""
+        if is_license_token(key):
+            key = normalize_token(key)
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    # Signed tokens
+    def _revoked_tokens(self):
+        """Cached hashes of revoked signed tokens."""
+        loaded_at = self._shared['revoked_at']
+        if loaded_at is None or time.monotonic() - loaded_at >= REVOCATION_REFRESH_SECONDS:
+            self._shared['revoked'] = set(self.session.execute(
+                select(License.key_hash).where(
+                    License.status == 'revoked',
+                    License.license_key.like(TOKEN_PREFIX + '%')
+                )
+            ).scalars())
+            self._shared['revoked_at'] = time.monotonic()
+        return self._shared['revoked']
+
+    def check_license_token(self, key):
+        """Verify a signed license token in-process.
+
+        Returns (claims, message). The signature and expiry are checked
+        without the database; only the cached revocation set is consulted.
+        """
+        if not self.signing_key:
+            return None, "Invalid license key."
+
+        claims = read_token(self.signing_key, key)
+        if not claims:
+            return None, "Invalid license key."
+
+        if self._key_hash(key) in self._revoked_tokens():
+            return None, "This license has been revoked."
+
+        if claims.is_expired:
+            return None, "This license has expired."
+
+        return claims, "Valid license."
+
+    @write_steps
+    def _register_token(self, key, claims):
+        """Create the licenses row for a token issued outside this database."""
+        key = normalize_token(key)
+        key_hash = self._key_hash(key)
+        if self._key_may_exist(key_hash) and self._fetch_one(LicenseRecord, LICENSE_BY_HASH, key_hash=key_hash):
+            return
+
+        def op(session):
+            license = License(
+                license_key=key,
+                key_hash=key_hash,
+                plan_type=claims.plan_type,
+                expires_at=claims.expires_at,
+                max_channels=claims.max_channels,
+                max_activations=claims.max_activations
+            )
+            session.add(license)
+            session.flush()
+            self._record_created_licenses(session, [license.id], claims.plan_type)
+            self._record_change(session, 'license_key', key_hash)
+            return license.id
+
+        try:
+            license_id = yield op
+        except IntegrityError:
+            # Another process registered it first
+            return
+        self.key_filter.add(key_hash, license_id)
+
+    # Row helpers
+    def _first(self, record_cls, model, *criteria, order_by=None):
+        """Fetch the first matching row of `model` as a `record_cls`."""
+        stmt = select(*_columns(record_cls, model)).where(*criteria)
+        if order_by is not None:
+            stmt = stmt.order_by(*(order_by if isinstance(order_by, tuple) else (order_by,)))
+        row = self.session.execute(stmt.limit(1)).first()
+        return record_cls(*row) if row else None
+
+    def _all(self, record_cls, model, *criteria, order_by=None, limit=None):
+        """Fetch all matching rows of `model` as `record_cls` instances."""
+        stmt = select(*_columns(record_cls, model)).where(*criteria)
+        if order_by is not None:
+            stmt = stmt.order_by(*(order_by if isinstance(order_by, tuple) else (order_by,)))
+        if limit is not None:
+            stmt = stmt.limit(limit)
+        return [record_cls(*row) for row in self.session.execute(stmt)]
+
+    def _fetch_one(self, record_cls, stmt, **params):
+        """Run a prebuilt statement and return its first row as a `record_cls`."""
+        row = self.session.execute(stmt, params).first()
+        return record_cls(*row) if row else None
+
+    def _fetch_all(self, record_cls, stmt, **params):
+        """Run a prebuilt statement and return every row as a `record_cls`."""
+        return [record_cls(*row) for row in self.session.execute(stmt, params)]
+
+    def _cached(self, entity, key, load):
+        """Read through the shared cache; entries are dropped via the change feed."""
+        key = str(key)
+        value = self.cache.get(entity, key)
+        if value is MISSING:
+            # An invalidation landing during load() means the value may be stale; don't keep it
+            generation = self.cache.generation(entity)
+            value = load()
+            self.cache.set(entity, key, value, generation)
+        return value
+
+    @write_operation
+    def _expire_license(self, session, license_id, user_id=None):
+        """Mark a license as expired."""
+        self._record_license_events(
+            session, 'expired', [License.id == license_id, License.status != 'expired'],
+            to_status='expired', at=License.expires_at
+        )
+        session.execute(
+            update(License).where(License.id == license_id).values(status='expired')
+        )
+        if user_id is not None:
+            self._record_change(session, 'license', user_id)
+
+    # License history
+    @staticmethod
+    def _record_license_events(session, event, criteria, to_status=None, to_plan=None, at=None):
+        """Append a license_events row for every license matching `criteria`.
+
+        Call it just before the UPDATE it describes, in the same transaction,
+        so from_plan/from_status still hold the old values. The rows are
+        locked first (FOR UPDATE, a no-op on SQLite) so a concurrent writer
+        on a server cannot change them in between.
+        """
+        events = LicenseEvent.__table__
+        source = select(
+            License.id, literal(event), License.plan_type, License.status,
+            literal(to_plan) if to_plan else License.plan_type,
+            literal(to_status) if to_status else License.status,
+            at if at is not None else literal(datetime.utcnow(), DateTime)
+        ).where(*criteria).with_for_update()
+        session.execute(insert(events).from_select(
+            ['license_id', 'event', 'from_plan', 'from_status', 'to_plan', 'to_status', 'created_at'], source
+        ))
+
+    @staticmethod
+    def _record_created_licenses(session, license_ids, plan_type):
+        """license_events rows for freshly inserted (inactive) licenses."""
+        now = datetime.utcnow()
+        session.execute(insert(LicenseEvent), [
+            {'license_id': license_id, 'event': 'created', 'to_plan': plan_type, 'to_status': 'inactive',
+             'created_at': now}
+            for license_id in license_ids
+        ])
 
     # License operations
-    def generate_license_key(self, plan_type='standard', duration_days=30, max_activations=1):
-        """Generate a new license key."""
+    def _license_values(self, plan_type, duration_days, max_activations, signed):
+        """Resolve signing, expiry and plan limits for new keys."""
+        if signed is None:
+            signed = self.signing_key is not None
+        if signed and not self.signing_key:
+            raise ValueError("LICENSE_SIGNING_KEY is not set")
+
+        # Calculate expiration
+        expires_at = datetime.utcnow() + timedelta(days=duration_days) if duration_days else None
+
+        # Set max channels based on plan
+        max_channels = PLAN_CHANNELS.get(plan_type, 5)
+
+        return signed, {
+            'plan_type': plan_type,
+            'expires_at': expires_at,
+            'max_channels': max_channels,
+            'max_activations': max_activations
+        }
+
+    def _new_key(self, signed, values):
+        """Create one key string for the given plan values."""
+        if signed:
+            return issue_token(
+                self.signing_key, values['plan_type'], values['expires_at'],
+                values['max_channels'], values['max_activations']
+            )
+
         # Generate random key
         key = secrets.token_urlsafe(32)[:32].upper()
         # Format: XXXX-XXXX-XXXX-XXXX
-        formatted_key = '-'.join([key[i:i+4] for i in range(0, 16, 4)])
+        return '-'.join([key[i:i+4] for i in range(0, 16, 4)])
 
-        # Hash for storage
-        key_hash = hashlib.sha256(formatted_key.encode()).hexdigest()
+    @write_steps
+    def generate_license_key(self, plan_type='standard', duration_days=30, max_activations=1, signed=None):
+        """Generate a new license key.
 
-        # Calculate expiration
-        expires_at = datetime.utcnow() + timedelta(days=duration_days) if duration_days else None
+        When a signing key is configured (or signed=True) the key is a signed
+        token that carries its own plan, expiry and limits.
+        """
+        signed, values = self._license_values(plan_type, duration_days, max_activations, signed)
+        formatted_key = self._new_key(signed, values)
 
-        # Set max channels based on plan
-        max_channels = {
-            'standard': 5,
-            'premium': 15,
-            'lifetime': 50
-        }.get(plan_type, 5)
-
-        license = License(
-            license_key=formatted_key,
-            key_hash=key_hash,
-            plan_type=plan_type,
-            expires_at=expires_at,
-            max_channels=max_channels,
-            max_activations=max_activations
-        )
+        # Hash for storage
+        key_hash = self._key_hash(formatted_key)
 
-        self.session.add(license)
-        self.session.commit()
+        def op(session):
+            license = License(license_key=formatted_key, key_hash=key_hash, **values)
+            session.add(license)
+            session.flush()
+            self._record_created_licenses(session, [license.id], plan_type)
+            self._record_change(session, 'license_key', key_hash)
+            return license.id
+
+        self.key_filter.add(key_hash, (yield op))
 
         return formatted_key
 
+    @write_steps
+    def generate_license_keys(self, count, plan_type='standard', duration_days=30, max_activations=1,
+                              signed=None):
+        """Generate `count` keys in one transaction.
+
+        Collisions are checked in memory against the batch and the key
+        filter (a filter hit just draws a new key), and the rows go in as a
+        single executemany INSERT. Returns (key, expires_at) pairs.
+        """
+        if not 0 < count <= MAX_KEY_BATCH:
+            raise ValueError(f"count must be between 1 and {MAX_KEY_BATCH}")
+
+        signed, values = self._license_values(plan_type, duration_days, max_activations, signed)
+
+        rows = []
+        batch_hashes = set()
+        while len(rows) < count:
+            key = self._new_key(signed, values)
+            key_hash = self._key_hash(key)
+            if key_hash in batch_hashes or key_hash in self.key_filter:
+                continue
+            batch_hashes.add(key_hash)
+            rows.append({'license_key': key, 'key_hash': key_hash, **values})
+
+        def op(session):
+            license_ids = session.execute(insert(License).returning(License.id), rows).scalars().all()
+            self._record_created_licenses(session, license_ids, plan_type)
+            self._record_change(session, 'license_key', '*')
+
+        yield op
+
+        for key_hash in batch_hashes:
+            self.key_filter.add(key_hash)
+
+        return [(row['license_key'], values['expires_at']) for row in rows]
+
     def verify_license_key(self, key):
         """Verify if a license key is valid."""
-        key_hash = hashlib.sha256(key.encode()).hexdigest()
-        license = self.session.query(License).filter_by(key_hash=key_hash).first()
+        if is_license_token(key):
+            claims, message = self.check_license_token(key)
+            if not claims:
+                return None, message
+
+        key_hash = self._key_hash(key)
+        if not self._key_may_exist(key_hash):
+            return None, "Invalid license key."
+
+        license = self._fetch_one(LicenseRecord, LICENSE_BY_HASH, key_hash=key_hash)
 
         if not license:
             return None, "Invalid license key."
@@ -198,8 +1533,7 @@ class Database:
             return None, "This license has expired."
 
         if license.expires_at and license.expires_at < datetime.utcnow():
-            license.status = 'expired'
-            self.session.commit()
+            self._expire_license(license.id, license.user_id)
             return None, "This license has expired."
 
         if license.used_activation_count >= license.max_activations:
@@ -207,79 +1541,346 @@ class Database:
 
         return license, "Valid license."
 
+    @write_steps
     def activate_license(self, key, user_id, username, device_fingerprint=None):
-        """Activate a license for a user."""
-        license, message = self.verify_license_key(key)
+        """Activate a license for a user.
 
+        Activation is one conditional UPDATE: the status, owner, expiry and
+        activation-count checks live in the WHERE clause, so concurrent
+        /activate calls for the same key cannot both succeed.
+        """
+        if self.activation_limiter.is_blocked(user_id):
+            return False, "Too many failed attempts. Please try again later."
+
+        key_hash = self._key_hash(key)
+        if is_license_token(key):
+            claims, message = self.check_license_token(key)
+            if not claims:
+                self.activation_limiter.record_failure(user_id)
+                return False, message
+            yield from self._register_token.steps(key, claims)
+        elif not self._key_may_exist(key_hash):
+            self.activation_limiter.record_failure(user_id)
+            return False, "Invalid license key."
+
+        now = datetime.utcnow()
+
+        values = {
+            'status': 'active',
+            'user_id': user_id,
+            'username': username,
+            'activated_at': now,
+            'used_activation_count': License.used_activation_count + 1
+        }
+        if device_fingerprint:
+            values['device_fingerprint'] = device_fingerprint
+
+        def op(session):
+            activated = session.execute(
+                update(License).where(
+                    License.key_hash == key_hash,
+                    License.status.notin_(('revoked', 'expired')),
+                    or_(License.status != 'active', License.user_id == user_id),
+                    or_(License.expires_at.is_(None), License.expires_at >= now),
+                    License.used_activation_count < License.max_activations
+                ).values(**values).execution_options(synchronize_session=False)
+                .returning(License.id, License.plan_type, License.used_activation_count)
+            ).all()
+            if len(activated) == 1:
+                license_id, plan_type, activations = activated[0]
+                # Only activation sets 'active' and it counts up, so the first one was from 'inactive'
+                session.execute(insert(LicenseEvent).values(
+                    license_id=license_id, event='activated', from_plan=plan_type,
+                    from_status='inactive' if activations == 1 else 'active',
+                    to_plan=plan_type, to_status='active', created_at=now
+                ))
+                self._record_change(session, 'license', user_id)
+            return len(activated)
+
+        if (yield op) == 1:
+            self.activation_limiter.reset(user_id)
+            return True, "License activated successfully!"
+
+        # The swap lost; re-read the row only to explain why
+        self.activation_limiter.record_failure(user_id)
+        license, message = self.verify_license_key(key)
         if not license:
             return False, message
 
         if license.status == 'active' and license.user_id != user_id:
             return False, "This license is already activated on another account."
 
-        license.status = 'active'
-        license.user_id = user_id
-        license.username = username
-        license.activated_at = datetime.utcnow()
-        license.used_activation_count += 1
-        if device_fingerprint:
-            license.device_fingerprint = device_fingerprint
-
-        self.session.commit()
-        return True, "License activated successfully!"
+        return False, "This license could not be activated. Please try again."
 
     def get_user_license(self, user_id):
-        """Get active license for a user."""
-        return self.session.query(License).filter_by(
-            user_id=user_id,
-            status='active'
-        ).first()
+        """Get active license for a user (cached)."""
+        return self._cached('license', user_id, lambda: self._fetch_one(
+            LicenseRecord, ACTIVE_LICENSE_BY_USER, user_id=user_id
+        ))
 
+    @write_steps
     def revoke_license(self, key):
         """Revoke a license key."""
-        key_hash = hashlib.sha256(key.encode()).hexdigest()
-        license = self.session.query(License).filter_by(key_hash=key_hash).first()
+        key_hash = self._key_hash(key)
 
-        if license:
-            license.status = 'revoked'
-            self.session.commit()
-            return True
-        return False
+        def op(session):
+            self._record_license_events(
+                session, 'revoked', [License.key_hash == key_hash, License.status != 'revoked'], to_status='revoked'
+            )
+            owners = session.execute(
+                update(License).where(License.key_hash == key_hash).values(status='revoked')
+                .returning(License.user_id)
+            ).scalars().all()
+            for owner in owners:
+                if owner is not None:
+                    self._record_change(session, 'license', owner)
+            return owners
+
+        owners = yield op
+        if owners and is_license_token(key):
+            self._shared['revoked'].add(key_hash)
+        return len(owners) > 0
 
     def get_all_licenses(self, status=None):
         """Get all licenses, optionally filtered by status."""
-        query = self.session.query(License)
-        if status:
-            query = query.filter_by(status=status)
-        return query.all()
+        criteria = [License.status == status] if status else []
+        return self._all(LicenseRecord, License, *criteria, order_by=License.id)
 
     def get_license_by_key(self, key):
         """Get license by key (exact match)."""
-        key_hash = hashlib.sha256(key.encode()).hexdigest()
-        return self.session.query(License).filter_by(key_hash=key_hash).first()
+        key_hash = self._key_hash(key)
+        if not self._key_may_exist(key_hash):
+            return None
+        return self._fetch_one(LicenseRecord, LICENSE_BY_HASH, key_hash=key_hash)
+
+    # Bulk license operations
+    @staticmethod
+    def _license_criteria(plan=None, status=None, expires_after=None, expires_before=None,
+                          created_after=None, created_before=None):
+        """WHERE clauses for the bulk license filters."""
+        criteria = []
+        if plan:
+            criteria.append(License.plan_type == plan)
+        if status:
+            criteria.append(License.status == status)
+        if expires_after:
+            criteria.append(License.expires_at >= expires_after)
+        if expires_before:
+            criteria.append(License.expires_at < expires_before)
+        if created_after:
+            criteria.append(License.created_at >= created_after)
+        if created_before:
+            criteria.append(License.created_at < created_before)
+        if not criteria:
+            raise ValueError("At least one license filter is required")
+        return criteria
+
+    @write_operation
+    def _bulk_update(self, session, criteria, values, event, at=None):
+        """Run one UPDATE over the matching licenses and return the row count."""
+        self._record_license_events(
+            session, event, criteria, to_status=values.get('status'), to_plan=values.get('plan_type'), at=at
+        )
+        result = session.execute(
+            update(License).where(*criteria).values(**values)
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount:
+            self._record_change(session, 'license', '*')
+        return result.rowcount
+
+    def count_licenses(self, **filters):
+        """Count licenses matching the bulk filters (dry-run preview)."""
+        return self.session.execute(
+            select(func.count(License.id)).where(*self._license_criteria(**filters))
+        ).scalar()
+
+    @write_steps
+    def extend_licenses(self, days, **filters):
+        """Push expiry back by `days` for matching licenses; lifetime keys are skipped."""
+        criteria = self._license_criteria(**filters) + [License.expires_at.isnot(None)]
+        if self.is_sqlite:
+            expires_at = func.datetime(License.expires_at, f'{int(days):+d} days')
+        else:
+            expires_at = License.expires_at + timedelta(days=int(days))
+        return (yield self._bulk_update.operation(criteria, {'expires_at': expires_at}, 'extended'))
+
+    @write_steps
+    def revoke_licenses(self, **filters):
+        """Revoke every matching license."""
+        criteria = self._license_criteria(**filters) + [License.status != 'revoked']
+        count = yield self._bulk_update.operation(criteria, {'status': 'revoked'}, 'revoked')
+        if count:
+            # Reload the revoked token set on the next token check
+            self._shared['revoked_at'] = None
+        return count
+
+    @write_steps
+    def change_license_plan(self, plan_type, **filters):
+        """Move matching licenses to another plan and its channel limit."""
+        if plan_type not in PLAN_CHANNELS:
+            raise ValueError(f"Unknown plan: {plan_type}")
+        return (yield self._bulk_update.operation(self._license_criteria(**filters), {
+            'plan_type': plan_type,
+            'max_channels': PLAN_CHANNELS[plan_type]
+        }, 'plan_changed'))
+
+    @write_steps
+    def expire_licenses(self):
+        """Mark every license past its expiry as expired.
+
+        Otherwise that only happens lazily when the license is next checked.
+        The events are dated at the expiry itself, so history queries see
+        the license expire on time. Returns the number of licenses expired.
+        """
+        return (yield self._bulk_update.operation(
+            [License.status.in_(('inactive', 'active')), License.expires_at < datetime.utcnow()],
+            {'status': 'expired'}, 'expired', at=License.expires_at
+        ))
+
+    # Expiry reminders
+    @staticmethod
+    def _reminder_criteria(days):
+        """Active, owned licenses expiring within `days` and not reminded for that expiry."""
+        now = datetime.utcnow()
+        already_sent = exists().where(
+            LicenseReminder.license_id == License.id,
+            LicenseReminder.expires_at == License.expires_at
+        )
+        return [
+            License.status == 'active',
+            License.expires_at >= now,
+            License.expires_at < now + timedelta(days=days),
+            License.user_id.isnot(None),
+            ~already_sent
+        ]
+
+    def get_licenses_needing_reminder(self, days=3, after_id=0, limit=50):
+        """Active licenses expiring within `days` that were not reminded yet.
+
+        Walks the (status, expires_at) index and skips licenses that already
+        have a reminder for their current expiry date. Pages by license id.
+        """
+        return self._all(
+            LicenseRecord, License,
+            *self._reminder_criteria(days),
+            License.id > after_id,
+            order_by=License.id, limit=limit
+        )
+
+    @write_operation
+    def claim_license_reminders(self, session, days=3, limit=50):
+        """Claim up to `limit` licenses that are due a reminder.
+
+        The reminder rows are written before anything is sent, so bots on
+        several hosts never remind the same license twice. On PostgreSQL,
+        candidates another bot is claiming are skipped (FOR UPDATE SKIP
+        LOCKED); on SQLite the writer lock already serialises claims. ON
+        CONFLICT DO NOTHING drops anything claimed in between. Returns the
+        claimed licenses.
+        """
+        candidates = [LicenseRecord(*row) for row in session.execute(
+            select(*_columns(LicenseRecord, License))
+            .where(*self._reminder_criteria(days))
+            .order_by(License.id).limit(limit)
+            .with_for_update(of=License, skip_locked=True)
+        )]
+        if not candidates:
+            return []
+
+        reminders = LicenseReminder.__table__
+        claimed = set(session.execute(
+            self._insert(reminders).on_conflict_do_nothing(
+                index_elements=['license_id', 'expires_at']
+            ).returning(reminders.c.license_id),
+            [
+                {'license_id': lic.id, 'user_id': lic.user_id, 'expires_at': lic.expires_at}
+                for lic in candidates
+            ]
+        ).scalars())
+        return [lic for lic in candidates if lic.id in claimed]
+
+    @write_operation
+    def release_license_reminders(self, session, licenses):
+        """Give back claims for reminders that could not be delivered."""
+        if not licenses:
+            return 0
+        # OR of equalities, so SQLite probes the unique index once per license
+        return session.execute(
+            delete(LicenseReminder).where(or_(*(
+                and_(LicenseReminder.license_id == lic.id, LicenseReminder.expires_at == lic.expires_at)
+                for lic in licenses
+            )))
+        ).rowcount
 
     # User operations
+    @write_steps
     def get_or_create_user(self, telegram_id, username=None, first_name=None):
-        """Get existing user or create new one."""
-        user = self.session.query(User).filter_by(telegram_id=telegram_id).first()
-
-        if not user:
-            user = User(
-                telegram_id=telegram_id,
-                username=username,
-                first_name=first_name
-            )
-            self.session.add(user)
-            self.session.commit()
-        else:
-            user.last_active = datetime.utcnow()
-            if username:
-                user.username = username
-            if first_name:
-                user.first_name = first_name
-            self.session.commit()
+        """Get existing user or create new one.
 
-        return user
+        A user whose cached name fields are unchanged costs no query at all.
+        Otherwise a single INSERT ... ON CONFLICT DO UPDATE creates the row or
+        updates it, and its WHERE clause skips the write when nothing differs.
+        last_active is only queued here; see touch_user().
+        """
+        username = username or None
+        first_name = first_name or None
+
+        cached = self.cache.get('user', str(telegram_id))
+        if (cached is not MISSING and cached is not None
+                and username in (None, cached.username)
+                and first_name in (None, cached.first_name)):
+            yield from self.touch_user.steps(telegram_id)
+            return cached
+
+        params = {
+            'telegram_id': telegram_id,
+            'username': username,
+            'first_name': first_name,
+            'now': datetime.utcnow()
+        }
+        stmt = _user_upsert(self.engine.dialect.name)
+        row = yield lambda session: session.execute(stmt, params).first()
+        if row is None:
+            # Nothing changed, so the upsert skipped the row and returned nothing
+            record = self.get_user(telegram_id)
+        else:
+            record = UserRecord(*row)
+
+        # Users are not in the change feed: a stale entry only means the next
+        # /start goes through the upsert again.
+        self.cache.set('user', str(telegram_id), record)
+        yield from self.touch_user.steps(telegram_id)
+        return record
+
+    def get_user(self, telegram_id):
+        """The users row of a Telegram id, or None; one indexed read."""
+        return self._fetch_one(UserRecord, USER_BY_TELEGRAM_ID, telegram_id=telegram_id)
+
+    @write_steps
+    def touch_user(self, telegram_id):
+        """Queue a last_active update; queued updates are flushed together
+        at most once every LAST_ACTIVE_FLUSH_SECONDS."""
+        self._shared['last_active'][telegram_id] = datetime.utcnow()
+        if time.monotonic() - self._shared['last_active_flushed'] >= LAST_ACTIVE_FLUSH_SECONDS:
+            yield from self.flush_last_active.steps()
+
+    @write_steps
+    def flush_last_active(self):
+        """Write all queued last_active values in one executemany UPDATE."""
+        pending, self._shared['last_active'] = self._shared['last_active'], {}
+        self._shared['last_active_flushed'] = time.monotonic()
+        if not pending:
+            return 0
+
+        # Core UPDATE on the table: the ORM form would want primary keys per row
+        users = User.__table__
+        yield lambda session: session.execute(
+            update(users).where(users.c.telegram_id == bindparam('tid'))
+            .values(last_active=bindparam('seen_at')),
+            [{'tid': tid, 'seen_at': seen_at} for tid, seen_at in pending.items()]
+        )
+        return len(pending)
 
     def has_active_license(self, user_id):
         """Check if user has an active license."""
@@ -288,8 +1889,7 @@ class Database:
             return False
 
         if license.expires_at and license.expires_at < datetime.utcnow():
-            license.status = 'expired'
-            self.session.commit()
+            self._expire_license(license.id, user_id)
             return False
 
         return True
@@ -300,23 +1900,20 @@ class Database:
         if not license:
             return None
 
-        days_left = None
-        if license.expires_at:
-            days_left = (license.expires_at - datetime.utcnow()).days
-
         return {
             'key': license.license_key[:12] + '****',  # Masked
             'plan': license.plan_type,
             'status': license.status,
             'activated_at': license.activated_at,
             'expires_at': license.expires_at,
-            'days_left': days_left,
+            'days_left': license.days_left,
             'max_channels': license.max_channels,
             'auto_post': license.auto_post_enabled
         }
 
     # Payment operations
-    def create_payment_record(self, user_id, amount, currency='USD', payment_method=None, notes=None):
+    @write_operation
+    def create_payment_record(self, session, user_id, amount, currency='USD', payment_method=None, notes=None):
         """Create a payment record."""
         payment = Payment(
             user_id=user_id,
@@ -325,24 +1922,30 @@ class Database:
             payment_method=payment_method,
             notes=notes
         )
-        self.session.add(payment)
-        self.session.commit()
+        session.add(payment)
+        session.flush()
         return payment.id
 
-    def verify_payment(self, payment_id, transaction_id):
+    @write_operation
+    def verify_payment(self, session, payment_id, transaction_id):
         """Mark payment as verified."""
-        payment = self.session.query(Payment).filter_by(id=payment_id).first()
+        payment = session.query(Payment).filter_by(id=payment_id).first()
         if payment:
             payment.status = 'completed'
             payment.transaction_id = transaction_id
             payment.verified_at = datetime.utcnow()
-            self.session.commit()
             return True
         return False
 
     # User logging operations
-    def log_user_action(self, user_id, username=None, first_name=None, action=None, plan_type=None, payment_method=None, details=None):
-        """Log a user action for tracking and future subscriptions."""
+    @write_operation(analytics=True)
+    def log_user_action(self, session, user_id, username=None, first_name=None, action=None, plan_type=None, payment_method=None, details=None):
+        """Log a user action for tracking and future subscriptions.
+
+        `details` is a dict such as {'price': ..., 'source': ..., 'callback': ...};
+        see log_details() for what is accepted.
+        """
+        details = log_details(details)
         log_entry = UserLog(
             user_id=user_id,
             username=username,
@@ -352,48 +1955,112 @@ class Database:
             payment_method=payment_method,
             details=details
         )
-        self.session.add(log_entry)
-        self.session.commit()
+        session.add(log_entry)
+        session.flush()
         return log_entry.id
 
     def get_user_logs(self, user_id, action=None, limit=100):
         """Get user activity logs, optionally filtered by action."""
-        query = self.session.query(UserLog).filter_by(user_id=user_id)
+        criteria = [UserLog.user_id == user_id]
         if action:
-            query = query.filter_by(action=action)
-        return query.order_by(UserLog.created_at.desc()).limit(limit).all()
+            criteria.append(UserLog.action == action)
+        return self._all(
+            LogRecord, UserLog, *criteria,
+            order_by=UserLog.created_at.desc(), limit=limit
+        )
 
-    def get_users_with_purchase_intent(self, days=30):
-        """Get users who showed purchase intent but haven't bought yet."""
-        since = datetime.utcnow() - timedelta(days=days)
-        # Get users with purchase_intent logs but no active license
-        subquery = self.session.query(UserLog.user_id).filter(
-            UserLog.action == 'purchase_intent',
-            UserLog.created_at >= since
-        ).subquery()
+    def get_users_with_purchase_intent(self, days=30, after=None, limit=100):
+        """Users who showed purchase intent in the last `days` days but hold no active license.
 
-        users_with_license = self.session.query(License.user_id).filter(
-            License.status == 'active'
-        ).subquery()
+        One RetargetRecord per user, latest intent first. The intents are
+        grouped by user on the (action, created_at, user_id) index, users
+        with an active license are dropped by an anti-join, and names, plan
+        and payment method are looked up for the returned page only. Pass
+        the last record of a page as `after` to get the next one.
+        """
+        return [RetargetRecord(*row) for row in self.session.execute(self._purchase_intent_select(days, after, limit))]
 
-        potential_customers = self.session.query(UserLog).filter(
-            UserLog.user_id.in_(subquery),
-            ~UserLog.user_id.in_(users_with_license)
-        ).order_by(UserLog.created_at.desc()).all()
+    def export_users_with_purchase_intent(self, days=30):
+        """Every record get_users_with_purchase_intent() would page through, in one query.
+
+        Paging re-aggregates the whole window for every page; this groups
+        it once. Safe to run in a worker thread.
+        """
+        with self._read_session() as reader:
+            return [RetargetRecord(*row) for row in reader.execute(self._purchase_intent_select(days))]
+
+    @staticmethod
+    def _purchase_intent_select(days, after=None, limit=None):
+        """The retargeting query: a page of it, or all of it without `limit`."""
+        since = datetime.utcnow() - timedelta(days=days)
+        last_intent_at = func.max(UserLog.created_at)
+        has_license = exists().where(License.user_id == UserLog.user_id, License.status == 'active')
+        page = (
+            select(UserLog.user_id, last_intent_at.label('last_intent_at'))
+            .where(UserLog.action == 'purchase_intent', UserLog.created_at >= since)
+            .group_by(UserLog.user_id)
+            .having(~has_license)
+        )
+        if after is not None:
+            page = page.having(or_(
+                last_intent_at < after.last_intent_at,
+                and_(last_intent_at == after.last_intent_at, UserLog.user_id < after.user_id)
+            ))
+        if limit is not None:
+            page = page.order_by(last_intent_at.desc(), UserLog.user_id.desc()).limit(limit)
+        intents = page.subquery('intents')
+
+        def latest(column, *criteria):
+            # The user's most recent non-null value, via ix_user_logs_user_id_created_at
+            return (
+                select(column)
+                .where(UserLog.user_id == intents.c.user_id, column.isnot(None), *criteria)
+                .order_by(UserLog.created_at.desc())
+                .limit(1).scalar_subquery()
+            )
 
-        return potential_customers
+        return select(
+            intents.c.user_id,
+            latest(UserLog.username),
+            latest(UserLog.first_name),
+            intents.c.last_intent_at,
+            latest(UserLog.plan_type),
+            latest(UserLog.payment_method)
+        ).order_by(intents.c.last_intent_at.desc(), intents.c.user_id.desc())
 
     def get_user_payment_preferences(self, user_id):
         """Get user's preferred payment methods from logs."""
-        logs = self.session.query(UserLog).filter(
-            UserLog.user_id == user_id,
-            UserLog.payment_method.isnot(None)
-        ).order_by(UserLog.created_at.desc()).all()
+        methods = self.session.execute(
+            select(UserLog.payment_method).where(
+                UserLog.user_id == user_id,
+                UserLog.payment_method.isnot(None)
+            ).order_by(UserLog.created_at.desc())
+        ).scalars()
 
-        return [log.payment_method for log in logs if log.payment_method]
+        return [method for method in methods if method]
+
+    def get_log_attribution(self, days=30, action=None):
+        """(source, action, count, total price) per bot and action, busiest first.
+
+        Grouped in SQL on the generated columns of user_logs.details.
+        """
+        since = datetime.utcnow() - timedelta(days=days)
+        criteria = [UserLog.created_at >= since]
+        if action:
+            criteria.append(UserLog.action == action)
+        count = func.count()
+        rows = self.session.execute(
+            select(UserLog.source, UserLog.action, count, func.sum(UserLog.price))
+            .where(*criteria)
+            .group_by(UserLog.source, UserLog.action)
+            .order_by(count.desc())
+        ).all()
+        return [(source or 'unknown', logged_action, total, price or 0.0)
+                for source, logged_action, total, price in rows]
 
     # Payment credentials operations
-    def save_payment_credential(self, user_id, payment_method, **kwargs):
+    @write_operation
+    def save_payment_credential(self, session, user_id, payment_method, **kwargs):
         """Save or update user payment credential.
 
         Args:
@@ -402,7 +2069,7 @@ class Database:
             **kwargs: btc_address, eth_address, usdt_address, paypal_email, card_last_four, notes
         """
         # Check if credential already exists for this user and method
-        credential = self.session.query(PaymentCredential).filter_by(
+        credential = session.query(PaymentCredential).filter_by(
             user_id=user_id,
             payment_method=payment_method
         ).first()
@@ -440,69 +2107,74 @@ class Database:
                 is_default=kwargs.get('is_default', False),
                 notes=kwargs.get('notes')
             )
-            self.session.add(credential)
+            session.add(credential)
+            session.flush()
 
-        self.session.commit()
+        self._record_change(session, 'credentials', user_id)
         return credential.id
 
+    def _user_credentials(self, user_id):
+        """Cached tuple of a user's credentials in saved order."""
+        return self._cached('credentials', user_id, lambda: tuple(self._fetch_all(
+            CredentialRecord, CREDENTIALS_BY_USER, user_id=user_id
+        )))
+
     def get_user_payment_credentials(self, user_id):
         """Get all saved payment credentials for a user."""
-        return self.session.query(PaymentCredential).filter_by(user_id=user_id).all()
+        return list(self._user_credentials(user_id))
 
     def get_default_payment_method(self, user_id):
         """Get user's default payment method."""
-        credential = self.session.query(PaymentCredential).filter_by(
-            user_id=user_id,
-            is_default=True
-        ).first()
-
-        if not credential:
-            # Return first saved method if no default
-            credential = self.session.query(PaymentCredential).filter_by(
-                user_id=user_id
-            ).first()
-
-        return credential
+        # Flagged default first, otherwise the first saved method
+        credentials = self._user_credentials(user_id)
+        default = next((cred for cred in credentials if cred.is_default), None)
+        if default is None and credentials:
+            default = credentials[0]
+        return default
 
     def get_payment_credential_by_method(self, user_id, payment_method):
         """Get specific payment credential by method."""
-        return self.session.query(PaymentCredential).filter_by(
+        return next(
+            (cred for cred in self._user_credentials(user_id) if cred.payment_method == payment_method),
+            None
+        )
+
+    @write_operation
+    def delete_payment_credential(self, session, credential_id):
+        """Delete a payment credential."""
+        owners = session.execute(
+            delete(PaymentCredential).where(PaymentCredential.id == credential_id)
+            .returning(PaymentCredential.user_id)
+        ).scalars().all()
+        for owner in owners:
+            self._record_change(session, 'credentials', owner)
+        return len(owners) > 0
+
+    @write_operation
+    def set_default_payment_method(self, session, user_id, payment_method):
+        """Set a payment method as default for user."""
+        credential = session.query(PaymentCredential).filter_by(
             user_id=user_id,
             payment_method=payment_method
         ).first()
+        if not credential:
+            return False
 
-    def delete_payment_credential(self, credential_id):
-        """Delete a payment credential."""
-        credential = self.session.query(PaymentCredential).filter_by(id=credential_id).first()
-        if credential:
-            self.session.delete(credential)
-            self.session.commit()
-            return True
-        return False
-
-    def set_default_payment_method(self, user_id, payment_method):
-        """Set a payment method as default for user."""
         # Clear existing default
-        self.session.query(PaymentCredential).filter_by(
+        session.query(PaymentCredential).filter_by(
             user_id=user_id,
             is_default=True
         ).update({'is_default': False})
 
         # Set new default
-        credential = self.session.query(PaymentCredential).filter_by(
-            user_id=user_id,
-            payment_method=payment_method
-        ).first()
-
-        if credential:
-            credential.is_default = True
-            credential.preferred_method = payment_method
-            self.session.commit()
-            return True
-        return False
+        credential.is_default = True
+        credential.preferred_method = payment_method
+        self._record_change(session, 'credentials', user_id)
+        return True
 
     # Payment proof operations
-    def save_payment_proof(self, user_id, username, first_name, payment_method, to_address,
+    @write_operation
+    def save_payment_proof(self, session, user_id, username, first_name, payment_method, to_address,
                            plan_type=None, amount_sent=None, transaction_id=None,
                            from_address=None, screenshot_path=None, message_text=None):
         """Save a payment proof submission.
@@ -534,50 +2206,58 @@ class Database:
             message_text=message_text,
             status='pending'
         )
-        self.session.add(proof)
-        self.session.commit()
+        session.add(proof)
+        session.flush()
+        self._record_change(session, 'proof', user_id)
         return proof.id
 
     def get_payment_proof(self, proof_id):
         """Get a payment proof by ID."""
-        return self.session.query(PaymentProof).filter_by(id=proof_id).first()
+        return self._first(ProofRecord, PaymentProof, PaymentProof.id == proof_id)
 
     def get_user_payment_proofs(self, user_id, status=None):
         """Get all payment proofs for a user, optionally filtered by status."""
-        query = self.session.query(PaymentProof).filter_by(user_id=user_id)
+        criteria = [PaymentProof.user_id == user_id]
         if status:
-            query = query.filter_by(status=status)
-        return query.order_by(PaymentProof.created_at.desc()).all()
+            criteria.append(PaymentProof.status == status)
+        return self._all(
+            ProofRecord, PaymentProof, *criteria,
+            order_by=PaymentProof.created_at.desc()
+        )
 
     def get_pending_payment_proofs(self):
         """Get all pending payment proofs for admin review."""
-        return self.session.query(PaymentProof).filter_by(status='pending').order_by(
-            PaymentProof.created_at.desc()
-        ).all()
+        return self._all(
+            ProofRecord, PaymentProof,
+            PaymentProof.status == 'pending',
+            order_by=PaymentProof.created_at.desc()
+        )
 
-    def verify_payment_proof(self, proof_id, admin_id, notes=None):
+    @write_operation
+    def verify_payment_proof(self, session, proof_id, admin_id, notes=None):
         """Mark a payment proof as verified."""
-        proof = self.session.query(PaymentProof).filter_by(id=proof_id).first()
+        proof = session.query(PaymentProof).filter_by(id=proof_id).first()
         if proof:
             proof.status = 'verified'
             proof.verified_by = admin_id
             proof.verified_at = datetime.utcnow()
             if notes:
                 proof.notes = notes
-            self.session.commit()
+            self._record_change(session, 'proof', proof.user_id)
             return True
         return False
 
-    def reject_payment_proof(self, proof_id, admin_id, notes=None):
+    @write_operation
+    def reject_payment_proof(self, session, proof_id, admin_id, notes=None):
         """Reject a payment proof."""
-        proof = self.session.query(PaymentProof).filter_by(id=proof_id).first()
+        proof = session.query(PaymentProof).filter_by(id=proof_id).first()
         if proof:
             proof.status = 'rejected'
             proof.verified_by = admin_id
             proof.verified_at = datetime.utcnow()
             if notes:
                 proof.notes = notes
-            self.session.commit()
+            self._record_change(session, 'proof', proof.user_id)
             return True
         return False
 
@@ -606,6 +2286,374 @@ class Database:
             'rejected': rejected
         }
 
+    # Conversion funnel
+    @staticmethod
+    def _funnel_day(column):
+        """UTC calendar day of a timestamp column."""
+        return type_coerce(func.date(column), Date)
+
+    @staticmethod
+    def _funnel_watermarks(session):
+        """{source: (last_id, last_at)} for the sources rolled up so far."""
+        rows = session.execute(select(FunnelWatermark.source, FunnelWatermark.last_id, FunnelWatermark.last_at))
+        return {source: (last_id, last_at) for source, last_id, last_at in rows}
+
+    def _funnel_counts(self, session, stage, model, at, *criteria):
+        """funnel_daily rows for `stage`: rows of `model` matching `criteria`, grouped in SQL."""
+        day = self._funnel_day(at)
+        plan = func.coalesce(model.plan_type, FUNNEL_UNKNOWN)
+        method = func.coalesce(model.payment_method, FUNNEL_UNKNOWN)
+        rows = session.execute(
+            select(day, stage, plan, method, func.count()).where(*criteria).group_by(day, stage, plan, method)
+        )
+        return [
+            {'day': row_day, 'stage': row_stage, 'plan_type': plan_type, 'payment_method': payment_method,
+             'count': count}
+            for row_day, row_stage, plan_type, payment_method, count in rows
+        ]
+
+    def roll_up_funnel(self):
+        """Add what was logged and paid since the last run to funnel_daily.
+
+        Each source is only read past its watermark: new user_logs ids
+        (intent, method), new payment_proofs ids (proof) and proofs verified
+        since the last run (verified). Proofs live in the main file, which
+        the analytics writer cannot read, so they are grouped here and only
+        applied if no other run moved their watermarks in between. Logs
+        archived before they were rolled up are not counted, so the nightly
+        archival rolls up first. Safe to run in a worker thread. Returns the
+        rows counted per stage.
+        """
+        with self._read_session() as reader:
+            marks = self._funnel_watermarks(reader)
+            last_proof_id = marks.get('proofs', (0, None))[0]
+            reviewed_after = marks.get('reviews', (0, None))[1]
+            reviewed_until = datetime.utcnow() - timedelta(seconds=FUNNEL_REVIEW_LAG_SECONDS)
+            proof_head = reader.execute(select(func.max(PaymentProof.id))).scalar() or last_proof_id
+
+            proof_rows = self._funnel_counts(
+                reader, literal('proof'), PaymentProof, PaymentProof.created_at,
+                PaymentProof.id > last_proof_id, PaymentProof.id <= proof_head
+            )
+            review_criteria = [PaymentProof.status == 'verified', PaymentProof.verified_at <= reviewed_until]
+            if reviewed_after is not None:
+                review_criteria.append(PaymentProof.verified_at > reviewed_after)
+            proof_rows += self._funnel_counts(
+                reader, literal('verified'), PaymentProof, PaymentProof.verified_at, *review_criteria
+            )
+
+        def op(session):
+            current = self._funnel_watermarks(session)
+            log_mark = current.get('logs', (0, None))[0]
+            log_head = session.execute(select(func.max(UserLog.id))).scalar() or log_mark
+            rows = self._funnel_counts(
+                session, case(FUNNEL_LOG_STAGES, value=UserLog.action), UserLog, UserLog.created_at,
+                UserLog.id > log_mark, UserLog.id <= log_head, UserLog.action.in_(list(FUNNEL_LOG_STAGES))
+            )
+            now = datetime.utcnow()
+            session.merge(FunnelWatermark(source='logs', last_id=log_head, updated_at=now))
+            if all(current.get(source) == marks.get(source) for source in ('proofs', 'reviews')):
+                rows += proof_rows
+                session.merge(FunnelWatermark(source='proofs', last_id=proof_head, updated_at=now))
+                session.merge(FunnelWatermark(source='reviews', last_id=0, last_at=reviewed_until, updated_at=now))
+
+            if rows:
+                upsert = self._insert(FunnelDay)
+                session.execute(upsert.on_conflict_do_update(
+                    index_elements=['day', 'stage', 'plan_type', 'payment_method'],
+                    set_={'count': FunnelDay.count + upsert.excluded['count']}
+                ), rows)
+            counted = dict.fromkeys(FUNNEL_STAGES, 0)
+            for row in rows:
+                counted[row['stage']] += row['count']
+            return counted
+
+        return self._write(op, analytics=True)
+
+    def get_funnel(self, days=30):
+        """Funnel counts of the last `days` days (today included) from funnel_daily.
+
+        Returns (stage, plan_type, payment_method, count) rows, summed over
+        the period. Nothing is counted live; see roll_up_funnel().
+        """
+        since = (datetime.utcnow() - timedelta(days=days - 1)).date()
+        total = func.sum(FunnelDay.count)
+        return [tuple(row) for row in self.session.execute(
+            select(FunnelDay.stage, FunnelDay.plan_type, FunnelDay.payment_method, total)
+            .where(FunnelDay.day >= since)
+            .group_by(FunnelDay.stage, FunnelDay.plan_type, FunnelDay.payment_method)
+            .order_by(total.desc())
+        )]
+
+    def funnel_rolled_up_at(self):
+        """When roll_up_funnel last ran, or None."""
+        return self.session.execute(select(func.max(FunnelWatermark.updated_at))).scalar()
+
+    # Archival
+    _ARCHIVES = {
+        'logs': (UserLog, LogRecord),
+        'proofs': (PaymentProof, ProofRecord)
+    }
+
+    def archive_old_rows(self, log_days=None, proof_days=None):
+        """Move old user_logs and reviewed payment_proofs into monthly archives.
+
+        Rows are moved in id-ordered chunks of ARCHIVE_CHUNK_ROWS within a
+        month, each in its own transaction (INSERT into the archive, DELETE
+        from the hot table), so an interrupted run leaves no row in both
+        places and other writers wait at most one chunk. Pending proofs are
+        never archived. Safe to run in a worker thread. Returns the number
+        of rows moved per kind.
+        """
+        now = datetime.utcnow()
+        log_cutoff = now - timedelta(days=log_days or LOG_RETENTION_DAYS)
+        proof_cutoff = now - timedelta(days=proof_days or PROOF_RETENTION_DAYS)
+        return {
+            'logs': self._archive_model(UserLog, [UserLog.created_at < log_cutoff], analytics=True),
+            'proofs': self._archive_model(PaymentProof, [
+                PaymentProof.created_at < proof_cutoff,
+                PaymentProof.status != 'pending'
+            ])
+        }
+
+    def _archive_model(self, model, criteria, analytics=False):
+        """Move rows of `model` matching `criteria` month by month, chunk by chunk."""
+        source = model.__table__
+        month_of = self._month_of(source.c.created_at)
+        with self._read_session() as reader:
+            months = reader.execute(
+                select(month_of).where(*criteria).distinct().order_by(month_of)
+            ).scalars().all()
+
+        moved = 0
+        for month in months:
+            archive = _archive_table(model, month)
+            month_criteria = criteria + [month_of == month]
+
+            def op(session, archive=archive, month_criteria=month_criteria, after=0):
+                """Move the next chunk past id `after`; returns (rows moved, last id) or (0, None)."""
+                chunk_ids = (
+                    select(source.c.id).where(*month_criteria, source.c.id > after)
+                    .order_by(source.c.id).limit(ARCHIVE_CHUNK_ROWS).subquery()
+                )
+                last_id = session.execute(select(func.max(chunk_ids.c.id))).scalar()
+                if last_id is None:
+                    return 0, None
+
+                chunk_criteria = month_criteria + [source.c.id > after, source.c.id <= last_id]
+                archive.create(session.connection(), checkfirst=True)
+                columns = _stored_columns(source)
+                session.execute(
+                    archive.insert().from_select(
+                        [column.name for column in columns],
+                        select(*columns).where(*chunk_criteria)
+                    )
+                )
+                return session.execute(delete(source).where(*chunk_criteria)).rowcount, last_id
+
+            after = 0
+            while after is not None:
+                count, after = self._write(partial(op, after=after), analytics)
+                moved += count
+        return moved
+
+    def list_archives(self, kind):
+        """Archived months of 'logs' or 'proofs' with their row counts, newest first."""
+        model, _ = self._ARCHIVES[kind]
+        prefix = model.__table__.name + '_'
+        names = inspect(self.engine).get_table_names(schema=model.__table__.schema)
+
+        months = sorted(
+            (name[len(prefix):] for name in names
+             if name.startswith(prefix) and ARCHIVE_MONTH.match(name[len(prefix):])),
+            reverse=True
+        )
+        return [
+            (month, self.session.execute(select(func.count()).select_from(_archive_table(model, month))).scalar())
+            for month in months
+        ]
+
+    def query_archive(self, kind, month, user_id=None, limit=50):
+        """Rows from one month's archive as LogRecord or ProofRecord, newest first."""
+        model, record_cls = self._ARCHIVES[kind]
+        archive = _archive_table(model, month)
+        if month not in {archived for archived, _ in self.list_archives(kind)}:
+            return []
+
+        stmt = select(*(archive.c[field.name] for field in fields(record_cls)))
+        if user_id is not None:
+            stmt = stmt.where(archive.c.user_id == user_id)
+        stmt = stmt.order_by(archive.c.created_at.desc()).limit(limit)
+        return [record_cls(*row) for row in self.session.execute(stmt)]
+
+    # License history (see take_license_snapshot)
+    @staticmethod
+    def _replay_license_events(session, counts, *criteria, sign=1):
+        """Apply the matching license_events to {(plan, status): count}.
+
+        sign=-1 undoes them, for walking back from a later snapshot.
+        """
+        for plan, status, direction in ((LicenseEvent.to_plan, LicenseEvent.to_status, sign),
+                                        (LicenseEvent.from_plan, LicenseEvent.from_status, -sign)):
+            rows = session.execute(
+                select(plan, status, func.count()).where(*criteria, status.isnot(None)).group_by(plan, status)
+            )
+            for plan_type, state, count in rows:
+                counts[(plan_type, state)] = counts.get((plan_type, state), 0) + direction * count
+        return {key: count for key, count in counts.items() if count}
+
+    @staticmethod
+    def _snapshot_counts(session, *criteria, newest=True):
+        """(taken_at, last_event_id, counts) of the newest/oldest snapshot matching `criteria`, or None."""
+        order = LicenseSnapshot.taken_at.desc() if newest else LicenseSnapshot.taken_at.asc()
+        head = session.execute(
+            select(LicenseSnapshot.taken_at, LicenseSnapshot.last_event_id)
+            .where(*criteria).order_by(order).limit(1)
+        ).first()
+        if not head:
+            return None
+        rows = session.execute(
+            select(LicenseSnapshot.plan_type, LicenseSnapshot.status, LicenseSnapshot.count)
+            .where(LicenseSnapshot.taken_at == head.taken_at)
+        )
+        return head.taken_at, head.last_event_id, {(plan, status): count for plan, status, count in rows}
+
+    @staticmethod
+    def _live_license_counts(session):
+        """(last_event_id, counts) straight from the licenses table; one scan."""
+        last_event_id = session.execute(select(func.max(LicenseEvent.id))).scalar() or 0
+        rows = session.execute(
+            select(License.plan_type, License.status, func.count()).group_by(License.plan_type, License.status)
+        )
+        return last_event_id, {(plan, status): count for plan, status, count in rows}
+
+    @write_operation
+    def take_license_snapshot(self, session):
+        """Store the current license count per plan and status.
+
+        Builds on the previous snapshot plus the events recorded since, so
+        only the very first snapshot scans licenses. Run expire_licenses()
+        first so licenses past their expiry count as expired. Returns
+        {(plan, status): count}.
+        """
+        previous = self._snapshot_counts(session)
+        if previous:
+            _, last_event_id, counts = previous
+            head = session.execute(select(func.max(LicenseEvent.id))).scalar() or 0
+            counts = self._replay_license_events(
+                session, counts, LicenseEvent.id > last_event_id, LicenseEvent.id <= head
+            )
+        else:
+            head, counts = self._live_license_counts(session)
+
+        now = datetime.utcnow()
+        if counts:
+            session.execute(insert(LicenseSnapshot), [
+                {'taken_at': now, 'last_event_id': head, 'plan_type': plan, 'status': status, 'count': count}
+                for (plan, status), count in counts.items()
+            ])
+        return counts
+
+    def license_counts_at(self, when):
+        """License count per (plan, status) as of `when`.
+
+        Starts from the nearest snapshot at or before `when` and replays the
+        events after it. Before the first snapshot it walks back from the
+        oldest snapshot (or the live table when there is none) instead.
+        """
+        session = self.session
+        earlier = self._snapshot_counts(session, LicenseSnapshot.taken_at <= when)
+        if earlier:
+            _, last_event_id, counts = earlier
+            return self._replay_license_events(
+                session, counts, LicenseEvent.id > last_event_id, LicenseEvent.created_at <= when
+            )
+
+        later = self._snapshot_counts(session, LicenseSnapshot.taken_at > when, newest=False)
+        last_event_id, counts = later[1:] if later else self._live_license_counts(session)
+        # "+ 0" keeps SQLite off the primary key, which would walk every event up to
+        # last_event_id; the created_at index finds the events after `when` directly
+        return self._replay_license_events(
+            session, counts, LicenseEvent.id + 0 <= last_event_id, LicenseEvent.created_at > when, sign=-1
+        )
+
+    def license_trend(self, days=30, status='active', plan=None):
+        """Daily license counts with `status` for the last `days` days.
+
+        Returns (date, {plan: count}) pairs, oldest first, each counted at
+        the end of that day (UTC); today is counted as of now.
+        """
+        now = datetime.utcnow()
+        today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+
+        trend = []
+        for offset in range(days - 1, -1, -1):
+            day = today - timedelta(days=offset)
+            counts = self.license_counts_at(min(day + timedelta(days=1), now))
+            trend.append((day.date(), {
+                plan_type: count for (plan_type, state), count in sorted(counts.items())
+                if state == status and plan in (None, plan_type)
+            }))
+        return trend
+
+    # Maintenance metrics
+    @write_operation
+    def record_maintenance_run(self, session, **metrics):
+        """Store the metrics returned by maintenance.run_maintenance()."""
+        run = MaintenanceRun(**metrics)
+        session.add(run)
+        session.flush()
+        return run.id
+
+    def last_analyze_at(self, db_file):
+        """When ANALYZE last ran on a database file, or None."""
+        return self.session.execute(
+            select(func.max(MaintenanceRun.started_at)).where(
+                MaintenanceRun.db_file == db_file,
+                MaintenanceRun.analyzed.is_(True)
+            )
+        ).scalar()
+
+    # Aggregate reads
+    def load_user_aggregate(self, telegram_id, proof_limit=5):
+        """Load user, active license, saved credentials and latest proofs in one query.
+
+        The joined rows are folded back by id and the default credential is
+        derived from the credential rows in memory. The license and
+        credentials were just read, so their cache entries are refreshed too.
+        """
+        generations = {entity: self.cache.generation(entity) for entity in ('license', 'credentials')}
+        rows = self.session.execute(USER_AGGREGATE, {
+            'telegram_id': telegram_id, 'user_id': telegram_id, 'proof_limit': proof_limit
+        }).all()
+        # Each record's columns start with its id; NULL means the outer join found nothing
+        parts, start = [], 0
+        for record_cls in (UserRecord, LicenseRecord, CredentialRecord, ProofRecord):
+            end = start + len(fields(record_cls))
+            parts.append((record_cls, start, end, {}))
+            start = end
+        for row in rows:
+            for record_cls, start, end, found in parts:
+                if row[start] is not None and row[start] not in found:
+                    found[row[start]] = record_cls(*row[start:end])
+        user, license, credentials, proofs = (tuple(found.values()) for *_, found in parts)
+        default = next((cred for cred in credentials if cred.is_default), credentials[0] if credentials else None)
+        self.cache.set('license', str(telegram_id), license[0] if license else None, generations['license'])
+        self.cache.set('credentials', str(telegram_id), credentials, generations['credentials'])
+        return UserAggregate(
+            telegram_id=telegram_id,
+            user=user[0] if user else None,
+            license=license[0] if license else None,
+            credentials=credentials,
+            default_credential=default,
+            recent_proofs=proofs
+        )
+
     def close(self):
         """Close database connection."""
+        self.flush_last_active()
         self.session.close()
+        if self.is_sqlite and self.write_engine is not None:
+            # Closes the pooled connections, which runs PRAGMA optimize on each
+            for engine in (self.engine, self.write_engine, self.analytics_engine):
+                engine.dispose()
@@ -0,0 +1,236 @@
+"""SQL instrumentation for the bot databases.
+
+instrument() hooks an engine's cursor events. Every statement is timed and
+attributed to the public Database method that issued it and to the
+Telegram update being handled. Statements slower than SLOW_QUERY_MS go to
+the 'slow_queries' logger together with their query plan. An update that
+issues more than N_PLUS_ONE_THRESHOLD statements is flagged as a likely
+N+1 pattern.
+
+The method comes from a context variable that the outermost public
+Database method sets on entry (see trace_operations()), so attributing a
+statement costs no stack walk. Each bot registers track_update() as a
+group -1 TypeHandler so every update opens a fresh scope. Writes run on
+the writer threads, so Database passes its operations through
+bind_caller(), which carries the caller's method and scope across.
+"""
+
+import contextvars
+import functools
+import logging
+import os
+import re
+import threading
+import time
+import types
+import weakref
+from collections import Counter, deque
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+slow_logger = logging.getLogger('slow_queries')
+
+SQL_INSTRUMENTATION = os.getenv("SQL_INSTRUMENTATION", "1") == "1"
+
+# Statements slower than this are logged with their plan
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+
+# More statements than this for one update is reported as N+1
+N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD", "20"))
+
+_EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+_operation = contextvars.ContextVar('db_operation', default=None)
+_scope = contextvars.ContextVar('update_scope', default=None)
+
+_instrumented = weakref.WeakSet()
+
+
+class UpdateScope:
+    """Statements issued while handling one Telegram update."""
+    __slots__ = ('label', 'count', 'statements', 'flagged')
+
+    def __init__(self, label):
+        self.label = label
+        self.count = 0
+        self.statements = Counter()
+        self.flagged = False
+
+
+class SqlStats:
+    """Per-process statement totals, keyed by Database method."""
+
+    def __init__(self, slow_keep=50):
+        self._lock = threading.Lock()
+        self.operations = {}  # method -> [count, total_ms, max_ms]
+        self.handlers = Counter()  # update label -> statements
+        self.n_plus_one = Counter()  # update label -> times flagged
+        self.slow = deque(maxlen=slow_keep)  # (at, ms, method, label, statement)
+
+    def record(self, operation, label, elapsed_ms):
+        with self._lock:
+            totals = self.operations.setdefault(operation, [0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += elapsed_ms
+            totals[2] = max(totals[2], elapsed_ms)
+            if label:
+                self.handlers[label] += 1
+
+    def top_operations(self, limit=10):
+        """(method, count, total_ms, max_ms) rows, most total time first."""
+        with self._lock:
+            rows = [(name, *totals) for name, totals in self.operations.items()]
+        return sorted(rows, key=lambda row: row[2], reverse=True)[:limit]
+
+    def reset(self):
+        with self._lock:
+            self.operations.clear()
+            self.handlers.clear()
+            self.n_plus_one.clear()
+            self.slow.clear()
+
+
+stats = SqlStats()
+
+
+def enter_operation(name):
+    """Attribute statements to method `name` unless an outer public method already is.
+
+    Returns a token for exit_operation(), or None when nothing was set.
+    """
+    if not SQL_INSTRUMENTATION or name.startswith('_') or _operation.get() is not None:
+        return None
+    return _operation.set(name)
+
+
+def exit_operation(token):
+    if token is not None:
+        _operation.reset(token)
+
+
+def traced(method):
+    """Wrap a method so the statements it issues are attributed to it."""
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        token = enter_operation(name)
+        try:
+            return method(*args, **kwargs)
+        finally:
+            exit_operation(token)
+    return wrapper
+
+
+def trace_operations(cls):
+    """Class decorator: trace every public plain method of `cls`.
+
+    Write descriptors (writer.py) enter the operation themselves.
+    """
+    for name, value in list(vars(cls).items()):
+        if not name.startswith('_') and isinstance(value, types.FunctionType):
+            setattr(cls, name, traced(value))
+    return cls
+
+
+def bind_caller(op):
+    """Wrap a write operation so it keeps the caller's method and update scope.
+
+    The writer thread runs it inside a copy of the submitting context.
+    """
+    if not SQL_INSTRUMENTATION:
+        return op
+
+    context = contextvars.copy_context()
+    return lambda session: context.run(op, session)
+
+
+def update_label(update):
+    """Short name for an update: the command, the callback data or 'message'."""
+    query = getattr(update, 'callback_query', None)
+    if query is not None:
+        # Ids in callback data would give every button press its own label
+        return 'callback:' + re.sub(r'\d+', '#', query.data or '')
+
+    message = getattr(update, 'effective_message', None)
+    text = getattr(message, 'text', None) or ''
+    if text.startswith('/'):
+        return text.split()[0].split('@')[0]
+    return 'message'
+
+
+async def track_update(update, context):
+    """Group -1 handler: count the statements of each update separately."""
+    _scope.set(UpdateScope(update_label(update)))
+
+
+def instrument(engine):
+    """Attach timing, slow-query and N+1 hooks to an engine (once)."""
+    if not SQL_INSTRUMENTATION or engine in _instrumented:
+        return
+    _instrumented.add(engine)
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        context._sql_started = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        elapsed_ms = (time.perf_counter() - context._sql_started) * 1000
+        operation = _operation.get() or '-'
+        scope = _scope.get()
+        label = scope.label if scope else None
+        stats.record(operation, label, elapsed_ms)
+
+        if scope is not None:
+            _count(scope, operation, statement)
+
+        if elapsed_ms >= SLOW_QUERY_MS:
+            plan = _explain(conn.engine, statement, parameters, executemany)
+            stats.slow.append((time.time(), elapsed_ms, operation, label, statement))
+            slow_logger.warning(
+                f"{elapsed_ms:.1f} ms in {operation} ({label or 'no update'}): "
+                f"{' '.join(statement.split())}\n{plan}"
+            )
+
+
+def _count(scope, operation, statement):
+    scope.count += 1
+    scope.statements[statement] += 1
+    if scope.count > N_PLUS_ONE_THRESHOLD and not scope.flagged:
+        scope.flagged = True
+        stats.n_plus_one[scope.label] += 1
+        repeated, times = scope.statements.most_common(1)[0]
+        logger.warning(
+            f"Possible N+1: {scope.label} issued over {N_PLUS_ONE_THRESHOLD} statements "
+            f"(latest from {operation}); most repeated x{times}: {' '.join(repeated.split())[:200]}"
+        )
+
+
+def _explain(engine, statement, parameters, executemany):
+    """Query plan of a statement, read on a separate pooled connection.
+
+    The statement's own connection may be inside a writer's group commit,
+    where a failing EXPLAIN would abort the batch on PostgreSQL. The raw
+    connection fires no cursor events, so the EXPLAIN is not timed itself.
+    """
+    if not statement.lstrip().upper().startswith(_EXPLAINABLE):
+        return '(no plan)'
+    if executemany and isinstance(parameters, (tuple, list)) and parameters \
+            and isinstance(parameters[0], (tuple, list, dict)):
+        parameters = parameters[0]  # Plain executemany; "insertmanyvalues" batches are already flat
+    prefix = 'EXPLAIN QUERY PLAN ' if engine.dialect.name == 'sqlite' else 'EXPLAIN '
+    try:
+        connection = engine.raw_connection()
+        try:
+            explain_cursor = connection.cursor()
+            try:
+                explain_cursor.execute(prefix + statement, parameters)
+                return '\n'.join('  ' + ' | '.join(str(value) for value in row) for row in explain_cursor.fetchall())
+            finally:
+                explain_cursor.close()
+        finally:
+            # Back to the pool, which rolls back whatever the EXPLAIN began
+            connection.close()
+    except Exception as e:
+        return f'(plan unavailable: {e})'
@@ -0,0 +1,111 @@
+"""In-memory guards in front of license key lookups.
+
+KeyHashFilter is a Bloom filter over licenses.key_hash, so keys that were
+never issued are rejected without a database query. AttemptLimiter keeps a
+decaying failure score per user, so scripted key guessing is cut off early.
+"""
+
+import math
+import threading
+import time
+
+
+class KeyHashFilter:
+    """Bloom filter of known license key hashes.
+
+    A miss means the key was definitely never issued. A hit only means it
+    may exist, so the database still has the final word. Keys are added
+    from the event loop and from the change-feed poller thread, so add()
+    holds a lock: a lost bit would reject a real key.
+    """
+
+    def __init__(self, capacity=10000, error_rate=0.001):
+        capacity = max(int(capacity), 1000)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+        self.max_id = 0
+        self.refreshed_at = 0.0
+        self._lock = threading.Lock()
+
+    def _positions(self, key_hash):
+        # key_hash is already a SHA-256 hex digest, so its halves are
+        # independent enough for double hashing.
+        h1 = int(key_hash[:16], 16)
+        h2 = int(key_hash[16:32], 16) | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+    def add(self, key_hash, license_id=None):
+        """Record a key hash (and the license id it came from)."""
+        positions = list(self._positions(key_hash))
+        with self._lock:
+            for pos in positions:
+                self.bits[pos >> 3] |= 1 << (pos & 7)
+            self.count += 1
+            if license_id and license_id > self.max_id:
+                self.max_id = license_id
+
+    def __contains__(self, key_hash):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key_hash))
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def is_saturated(self):
+        """True once more keys were added than the filter was sized for."""
+        return self.count > self.capacity
+
+
+class AttemptLimiter:
+    """Per-user failed attempt counter with exponential decay.
+
+    Each failure adds 1 to the user's score and the score halves every
+    `half_life` seconds. Users at or above `max_failures` are blocked until
+    their score decays below it again.
+    """
+
+    def __init__(self, max_failures=5, half_life=600):
+        self.max_failures = max_failures
+        self.half_life = half_life
+        self._scores = {}
+        self._lock = threading.Lock()
+
+    def _decayed(self, user_id, now):
+        entry = self._scores.get(user_id)
+        if not entry:
+            return 0.0
+        score, updated_at = entry
+        return score * 0.5 ** ((now - updated_at) / self.half_life)
+
+    def is_blocked(self, user_id):
+        """Check whether a user has too many recent failures."""
+        with self._lock:
+            return self._decayed(user_id, time.monotonic()) >= self.max_failures
+
+    def record_failure(self, user_id):
+        """Count a failed attempt for a user."""
+        now = time.monotonic()
+        with self._lock:
+            self._scores[user_id] = (self._decayed(user_id, now) + 1, now)
+            if len(self._scores) > 10000:
+                self._prune(now)
+
+    def reset(self, user_id):
+        """Forget a user's failures after a successful attempt."""
+        with self._lock:
+            self._scores.pop(user_id, None)
+
+    def clear(self):
+        """Forget every user's failures."""
+        with self._lock:
+            self._scores = {}
+
+    def _prune(self, now):
+        self._scores = {
+            user_id: entry for user_id, entry in self._scores.items()
+            if self._decayed(user_id, now) >= 0.05
+        }
@@ -0,0 +1,132 @@
+"""Signed license tokens that can be verified without the database.
+
+A token carries its plan, expiry and limits in a 15-byte payload followed by
+a truncated HMAC-SHA256 tag, base32 encoded so it survives the bots'
+upper-casing of keys:
+
+    PS1-XXXXXXXX-XXXXXXXX-XXXXXXXX-XXXXXXXX-XXXXXXXX
+"""
+
+import base64
+import hashlib
+import hmac
+import secrets
+import struct
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Optional
+
+TOKEN_PREFIX = 'PS1-'
+TOKEN_VERSION = 1
+
+# version, plan, expires (unix seconds, 0 = lifetime), max_channels, max_activations, nonce
+_PAYLOAD = struct.Struct('>BBIHB6s')
+_TAG_SIZE = 10
+
+PLAN_CODES = {'standard': 1, 'premium': 2, 'lifetime': 3}
+PLAN_NAMES = {code: plan for plan, code in PLAN_CODES.items()}
+
+# Largest values the payload fields can hold
+MAX_TOKEN_EXPIRES = 2**32 - 1
+MAX_TOKEN_CHANNELS = 2**16 - 1
+MAX_TOKEN_ACTIVATIONS = 2**8 - 1
+
+_EPOCH = datetime(1970, 1, 1)
+
+# Prefix without its dash plus the base32 body
+_TOKEN_LENGTH = len(TOKEN_PREFIX) - 1 + (_PAYLOAD.size + _TAG_SIZE) * 8 // 5
+
+
+@dataclass(frozen=True)
+class TokenClaims:
+    """What a verified token says about its license."""
+    __slots__ = ('plan_type', 'expires_at', 'max_channels', 'max_activations', 'nonce')
+
+    plan_type: str
+    expires_at: Optional[datetime]
+    max_channels: int
+    max_activations: int
+    nonce: str
+
+    @property
+    def is_expired(self):
+        return self.expires_at is not None and self.expires_at < datetime.utcnow()
+
+
+def _compact(key):
+    return key.upper().replace('-', '')
+
+
+def is_license_token(key):
+    """Check whether a key uses the signed token format (dashes optional)."""
+    compact = _compact(key or '')
+    return compact.startswith(TOKEN_PREFIX[:-1]) and len(compact) == _TOKEN_LENGTH
+
+
+def _format(body):
+    return TOKEN_PREFIX + '-'.join(body[i:i+8] for i in range(0, len(body), 8))
+
+
+def normalize_token(token):
+    """Canonical upper-case, dash-grouped form of a token."""
+    return _format(_compact(token)[len(TOKEN_PREFIX) - 1:])
+
+
+def _tag(secret, payload):
+    return hmac.new(secret, payload, hashlib.sha256).digest()[:_TAG_SIZE]
+
+
+def issue_token(secret, plan_type, expires_at=None, max_channels=5, max_activations=1):
+    """Create a signed token for the given plan and limits.
+
+    Raises ValueError for an unknown plan or a limit the payload cannot hold.
+    """
+    if plan_type not in PLAN_CODES:
+        raise ValueError(f"Unknown plan for a signed token: {plan_type}")
+    expires = int((expires_at - _EPOCH).total_seconds()) if expires_at else 0
+    if not 0 <= expires <= MAX_TOKEN_EXPIRES:
+        raise ValueError(f"Token expiry out of range: {expires_at}")
+    if not 0 <= max_channels <= MAX_TOKEN_CHANNELS:
+        raise ValueError(f"Signed tokens allow at most {MAX_TOKEN_CHANNELS} channels")
+    if not 1 <= max_activations <= MAX_TOKEN_ACTIVATIONS:
+        raise ValueError(f"Signed tokens allow 1-{MAX_TOKEN_ACTIVATIONS} activations")
+    payload = _PAYLOAD.pack(
+        TOKEN_VERSION,
+        PLAN_CODES[plan_type],
+        expires,
+        max_channels,
+        max_activations,
+        secrets.token_bytes(6)
+    )
+    return _format(base64.b32encode(payload + _tag(secret, payload)).decode())
+
+
+def read_token(secret, token):
+    """Verify a token's signature and return its claims, or None if invalid."""
+    if not is_license_token(token):
+        return None
+
+    body = _compact(token)[len(TOKEN_PREFIX) - 1:]
+    try:
+        raw = base64.b32decode(body)
+    except ValueError:
+        return None
+
+    if len(raw) != _PAYLOAD.size + _TAG_SIZE:
+        return None
+
+    payload, tag = raw[:_PAYLOAD.size], raw[_PAYLOAD.size:]
+    if not hmac.compare_digest(tag, _tag(secret, payload)):
+        return None
+
+    version, plan_code, expires, max_channels, max_activations, nonce = _PAYLOAD.unpack(payload)
+    if version != TOKEN_VERSION or plan_code not in PLAN_NAMES:
+        return None
+
+    return TokenClaims(
+        plan_type=PLAN_NAMES[plan_code],
+        expires_at=_EPOCH + timedelta(seconds=expires) if expires else None,
+        max_channels=max_channels,
+        max_activations=max_activations,
+        nonce=nonce.hex()
+    )
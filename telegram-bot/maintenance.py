@@ -0,0 +1,131 @@
+"""Routine SQLite upkeep for the bot databases.
+
+    python maintenance.py bot_database.db [--analyze]
+    python maintenance.py --convert bot_database.db bot_database_analytics.db
+
+Run from a low-traffic window: checkpoints and truncates an oversized WAL,
+and hands free pages back to the file system with incremental_vacuum.
+Planner statistics are refreshed by the bots themselves, which run PRAGMA
+optimize on their connections as they close (database._optimize_on_close);
+--analyze adds a full ANALYZE here.
+
+Files created before auto_vacuum=INCREMENTAL was enabled cannot use
+incremental_vacuum until a full VACUUM rewrites them. That holds an
+exclusive lock for as long as the whole file takes to copy, well past
+the bots' busy timeout, so it never happens in the scheduled job: stop
+the bots and run --convert once instead.
+"""
+
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+# WAL files above this size are checkpointed with TRUNCATE
+WAL_SIZE_LIMIT = 64 * 1024 * 1024
+
+# Free pages released per maintenance run (0 = all)
+VACUUM_PAGES = 0
+
+# SQLite's auto_vacuum value for INCREMENTAL
+AUTO_VACUUM_INCREMENTAL = 2
+
+# From 3.46, PRAGMA optimize=0x10002 checks every table, so it also works on
+# a fresh connection; older versions only act on what the connection queried
+OPTIMIZE_ALL_TABLES = 0x10002
+OPTIMIZE_ALL_TABLES_SINCE = (3, 46, 0)
+
+
+def _file_size(db_path):
+    """Size of the database plus its WAL, in bytes."""
+    return sum(
+        os.path.getsize(path) for path in (db_path, db_path + '-wal') if os.path.exists(path)
+    )
+
+
+def run_maintenance(db_path, analyze=False, wal_size_limit=WAL_SIZE_LIMIT, vacuum_pages=VACUUM_PAGES,
+                    convert=False):
+    """Run optional ANALYZE, incremental vacuum and a WAL checkpoint.
+
+    On SQLite 3.46 and later PRAGMA optimize also runs, across all tables.
+
+    A file created before auto_vacuum was enabled is only switched to
+    incremental mode (one full VACUUM) with convert=True, which must run
+    with the bots stopped; otherwise its vacuum step is skipped with a
+    warning. Returns a dict of metrics.
+    """
+    started = time.perf_counter()
+    size_before = _file_size(db_path)
+
+    # isolation_level=None: VACUUM and the checkpoint cannot run inside a transaction
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    try:
+        freelist_before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+
+        if sqlite3.sqlite_version_info >= OPTIMIZE_ALL_TABLES_SINCE:
+            conn.execute(f'PRAGMA optimize={OPTIMIZE_ALL_TABLES}')
+        if analyze:
+            conn.execute('ANALYZE')
+
+        converted = False
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+            if convert:
+                conn.execute(f'PRAGMA auto_vacuum={AUTO_VACUUM_INCREMENTAL}')
+                conn.execute('VACUUM')
+                converted = True
+            else:
+                logger.warning(
+                    f"{os.path.basename(db_path)} is not in incremental auto_vacuum mode; "
+                    f"stop the bots and run: python maintenance.py --convert {db_path}"
+                )
+        else:
+            # executescript steps the pragma to completion; execute() would free one page
+            conn.executescript(f'PRAGMA incremental_vacuum({vacuum_pages});')
+
+        # Checkpoint last so the vacuumed pages reach the main file
+        wal_size = os.path.getsize(db_path + '-wal') if os.path.exists(db_path + '-wal') else 0
+        mode = 'TRUNCATE' if wal_size > wal_size_limit else 'PASSIVE'
+        busy, wal_pages, checkpointed = conn.execute(f'PRAGMA wal_checkpoint({mode})').fetchone()
+
+        freelist_after = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    finally:
+        conn.close()
+
+    return {
+        'db_file': os.path.basename(db_path),
+        'duration_ms': int((time.perf_counter() - started) * 1000),
+        'size_before': size_before,
+        'size_after': _file_size(db_path),
+        'freelist_before': freelist_before,
+        'freelist_after': freelist_after,
+        'analyzed': analyze,
+        'checkpoint_mode': mode,
+        'checkpointed_pages': max(checkpointed, 0),
+        'converted_to_incremental': converted
+    }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Routine upkeep of the bot's SQLite files.")
+    parser.add_argument('files', nargs='+', help="database files to maintain")
+    parser.add_argument('--analyze', action='store_true', help="also run a full ANALYZE")
+    parser.add_argument('--convert', action='store_true',
+                        help="switch files to incremental auto_vacuum with a full VACUUM; this locks "
+                             "each file for the whole rewrite, so only run it with the bots stopped")
+    args = parser.parse_args(argv)
+    logging.basicConfig(format='%(levelname)s %(message)s', level=logging.INFO)
+
+    for path in args.files:
+        metrics = run_maintenance(path, analyze=args.analyze, convert=args.convert)
+        print(f"{metrics['db_file']}: {metrics['size_before'] / 1024:.0f} KB -> "
+              f"{metrics['size_after'] / 1024:.0f} KB in {metrics['duration_ms']} ms"
+              f"{' (converted to incremental)' if metrics['converted_to_incremental'] else ''}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
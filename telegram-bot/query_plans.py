@@ -0,0 +1,264 @@
+"""EXPLAIN QUERY PLAN regression check for every public Database method.
+
+    python query_plans.py            # compare against query_plans.json
+    python query_plans.py --update   # accept the current plans as the baseline
+
+Seeds an in-memory database with synthetic.py data, runs ANALYZE as the
+nightly maintenance does, calls each public Database method and records
+the SQLite query plan of every statement it sends. The check fails and
+prints a diff when a plan differs from the baseline. Hot-path methods fail
+on any full table scan even if the baseline has one. Methods that are
+neither covered nor listed in NO_SQL also fail, so new methods cannot
+slip past.
+"""
+
+import difflib
+import json
+import logging
+import os
+import re
+import sys
+from datetime import datetime, timedelta
+from sqlalchemy import event, select
+from database import Database, PaymentCredential, LOG_RETENTION_DAYS
+from synthetic import FIRST_USER_ID, populate
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'query_plans.json')
+
+# Public members that never send SQL of their own
+NO_SQL = {'writer', 'analytics_writer', 'cache', 'key_filter', 'activation_limiter', 'start_change_feed',
+          'touch_user', 'close'}
+
+# Tables small enough that a scan is fine anywhere
+SMALL_TABLES = {'entity_versions', 'analytics.funnel_watermarks'}
+
+# "SCAN <table>", but not "SCAN CONSTANT ROW(S)" from a constant SELECT or VALUES list
+_SCAN = re.compile(r'^SCAN (?!CONSTANT ROWS?$)(\S+)')
+
+# Subqueries SQLite evaluates on their own; scanning their result is not a table scan
+_SUBQUERY = re.compile(r'^(?:MATERIALIZE|CO-ROUTINE) (\S+)$')
+
+# Multi-row VALUES lists vary in length with the data; keep the first row only
+_VALUES_ROWS = re.compile(r'(\([?, ]+\))(?:, \([?, ]+\))+')
+_CONSTANT_ROWS = re.compile(r'^SCAN \d+ CONSTANT ROWS$')
+
+# Archive tables are named after the month they hold (see archive_old_rows)
+_ARCHIVE_MONTH = re.compile(r'_\d{4}_\d{2}\b')
+
+# Which equally narrow index a full covering scan picks depends on index
+# creation order, which SQLAlchemy does not fix; the scan is what matters
+_COVERING_SCAN = re.compile(r'^(SCAN \S+ USING COVERING INDEX) \S+$')
+
+SEED_USERS = 3000
+SEED_LOGS_PER_USER = 8
+SEED_NOW = datetime.utcnow()
+
+
+def sample_arguments(db, users=SEED_USERS):
+    """Keys and ids from the populated data that CASES call the methods with."""
+    license = db.get_all_licenses('active')[0]
+    return {
+        'user': license.user_id,
+        'other_user': FIRST_USER_ID + users - 1,
+        'key': license.license_key,
+        'new_key': db.generate_license_key('standard'),
+        'token': db.generate_license_key('premium', signed=True),
+        'proof': db.get_pending_payment_proofs()[0].id,
+        'credential': db.session.execute(select(PaymentCredential.id).limit(1)).scalar(),
+        'reminded': db.claim_license_reminders(3, limit=2),
+        'month': (SEED_NOW - timedelta(days=LOG_RETENTION_DAYS + 20)).strftime('%Y_%m'),
+    }
+
+
+# method -> (call, hot path)
+CASES = {
+    'warm_up': (lambda db, f: db.warm_up(), False),
+    'load_key_filter': (lambda db, f: db.load_key_filter(), False),
+    'refresh_key_filter': (lambda db, f: db.refresh_key_filter(), True),
+    'check_license_token': (lambda db, f: db.check_license_token(f['token']), True),
+    'generate_license_key': (lambda db, f: db.generate_license_key('premium'), True),
+    'generate_license_keys': (lambda db, f: db.generate_license_keys(5), False),
+    'verify_license_key': (lambda db, f: db.verify_license_key(f['key']), True),
+    'activate_license': (lambda db, f: db.activate_license(f['new_key'], f['other_user'], 'plan'), True),
+    'get_user_license': (lambda db, f: db.get_user_license(f['user']), True),
+    'revoke_license': (lambda db, f: db.revoke_license(f['new_key']), True),
+    'get_all_licenses': (lambda db, f: db.get_all_licenses('active'), False),
+    'get_license_by_key': (lambda db, f: db.get_license_by_key(f['key']), True),
+    'count_licenses': (lambda db, f: db.count_licenses(plan='premium', status='active'), False),
+    'extend_licenses': (lambda db, f: db.extend_licenses(1, plan='premium', status='active'), False),
+    'revoke_licenses': (lambda db, f: db.revoke_licenses(created_before=SEED_NOW - timedelta(days=360)), False),
+    'change_license_plan': (lambda db, f: db.change_license_plan('premium', plan='standard', status='expired'),
+                            False),
+    'expire_licenses': (lambda db, f: db.expire_licenses(), False),
+    'take_license_snapshot': (lambda db, f: db.take_license_snapshot(), False),
+    'license_counts_at': (lambda db, f: db.license_counts_at(SEED_NOW - timedelta(days=7)), False),
+    'license_trend': (lambda db, f: db.license_trend(days=2), False),
+    'get_licenses_needing_reminder': (lambda db, f: db.get_licenses_needing_reminder(3), True),
+    'claim_license_reminders': (lambda db, f: db.claim_license_reminders(3), True),
+    'release_license_reminders': (lambda db, f: db.release_license_reminders(f['reminded']), True),
+    'get_user': (lambda db, f: db.get_user(f['user']), True),
+    'get_or_create_user': (lambda db, f: db.get_or_create_user(f['user'], 'renamed', 'Renamed'), True),
+    'flush_last_active': (lambda db, f: (db.touch_user(f['user']), db.flush_last_active()), True),
+    'has_active_license': (lambda db, f: db.has_active_license(f['user']), True),
+    'get_license_info': (lambda db, f: db.get_license_info(f['user']), True),
+    'create_payment_record': (lambda db, f: db.create_payment_record(f['user'], 9.99), True),
+    'verify_payment': (lambda db, f: db.verify_payment(1, 'tx-plan'), True),
+    'log_user_action': (lambda db, f: db.log_user_action(
+        f['user'], action='plan_selected', details={'price': 9.99, 'source': 'plan', 'callback': 'buy_plan'}), True),
+    'get_user_logs': (lambda db, f: db.get_user_logs(f['user']), True),
+    'get_users_with_purchase_intent': (lambda db, f: db.get_users_with_purchase_intent(), False),
+    'export_users_with_purchase_intent': (lambda db, f: db.export_users_with_purchase_intent(), False),
+    'get_user_payment_preferences': (lambda db, f: db.get_user_payment_preferences(f['user']), True),
+    'get_log_attribution': (lambda db, f: db.get_log_attribution(), False),
+    'roll_up_funnel': (lambda db, f: db.roll_up_funnel(), False),
+    'get_funnel': (lambda db, f: db.get_funnel(), True),
+    'funnel_rolled_up_at': (lambda db, f: db.funnel_rolled_up_at(), False),
+    'save_payment_credential': (lambda db, f: db.save_payment_credential(f['user'], 'eth', eth_address='0x1'),
+                                True),
+    'get_user_payment_credentials': (lambda db, f: db.get_user_payment_credentials(f['user']), True),
+    'get_default_payment_method': (lambda db, f: db.get_default_payment_method(f['user']), True),
+    'get_payment_credential_by_method': (lambda db, f: db.get_payment_credential_by_method(f['user'], 'eth'),
+                                         True),
+    'delete_payment_credential': (lambda db, f: db.delete_payment_credential(f['credential']), True),
+    'set_default_payment_method': (lambda db, f: db.set_default_payment_method(f['user'], 'eth'), True),
+    'save_payment_proof': (lambda db, f: db.save_payment_proof(f['user'], 'plan', 'Plan', 'btc', 'bc1q'), True),
+    'get_payment_proof': (lambda db, f: db.get_payment_proof(f['proof']), True),
+    'get_user_payment_proofs': (lambda db, f: db.get_user_payment_proofs(f['user']), True),
+    'get_pending_payment_proofs': (lambda db, f: db.get_pending_payment_proofs(), True),
+    'verify_payment_proof': (lambda db, f: db.verify_payment_proof(f['proof'], 1), True),
+    'reject_payment_proof': (lambda db, f: db.reject_payment_proof(f['proof'], 1), True),
+    'get_payment_stats': (lambda db, f: db.get_payment_stats(), False),
+    'archive_old_rows': (lambda db, f: db.archive_old_rows(), False),
+    'list_archives': (lambda db, f: db.list_archives('logs'), False),
+    'query_archive': (lambda db, f: db.query_archive('logs', f['month'], user_id=f['user']), False),
+    'record_maintenance_run': (lambda db, f: db.record_maintenance_run(
+        db_file='plan.db', duration_ms=1, size_before=1, size_after=1), False),
+    'last_analyze_at': (lambda db, f: db.last_analyze_at('plan.db'), False),
+    'load_user_aggregate': (lambda db, f: db.load_user_aggregate(f['user']), True),
+}
+
+# method -> untimed step before each call, for cases whose arguments one call uses up;
+# a key activates once, so every activate_license call gets a newly generated one
+SETUP = {
+    'activate_license': lambda db, f: f.update(new_key=db.generate_license_key('standard')),
+}
+
+
+def _normalize_step(detail):
+    """A plan line with the parts that vary between runs replaced."""
+    detail = _CONSTANT_ROWS.sub('SCAN CONSTANT ROWS', detail)
+    detail = _COVERING_SCAN.sub(r'\1 ...', detail)
+    return _ARCHIVE_MONTH.sub('_YYYY_MM', detail)
+
+
+class PlanRecorder:
+    """Collects (statement, plan) pairs sent on one engine."""
+
+    def __init__(self, engine):
+        self.statements = None
+        event.listen(engine, 'before_cursor_execute', self._capture)
+
+    def _capture(self, conn, cursor, statement, parameters, context, executemany):
+        if self.statements is None or not statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE',
+                                                                                  'INSERT', 'WITH')):
+            return
+        if executemany and parameters and isinstance(parameters[0], (tuple, list, dict)):
+            parameters = parameters[0]  # Plain executemany; "insertmanyvalues" batches are already flat
+        rows = cursor.connection.execute('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+        plan = [_normalize_step(detail) for _, _, _, detail in rows]
+        sql = _ARCHIVE_MONTH.sub('_YYYY_MM', _VALUES_ROWS.sub(r'\1, ...', ' '.join(statement.split())))
+        # The same statement per archive month is recorded once; how many months exist depends on the date
+        if plan and {'sql': sql, 'plan': plan} not in self.statements:
+            self.statements.append({'sql': sql, 'plan': plan})
+
+    def record(self, call):
+        self.statements = []
+        try:
+            call()
+            return self.statements
+        finally:
+            self.statements = None
+
+
+def collect_plans():
+    """Run every case and return {method: [{'sql', 'plan'}, ...]}."""
+    db = Database(':memory:', signing_key='query-plan-check')
+    populate(db, SEED_USERS, logs_per_user=SEED_LOGS_PER_USER, now=SEED_NOW)
+    arguments = sample_arguments(db)
+    recorder = PlanRecorder(db.engine)
+
+    plans = {}
+    for name, (call, _) in CASES.items():
+        db.cache.clear()
+        db._shared['revoked_at'] = None
+        db.activation_limiter.clear()
+        if name in SETUP:
+            SETUP[name](db, arguments)
+        plans[name] = recorder.record(lambda: call(db, arguments))
+    db.close()
+    return plans
+
+
+def _lines(statements):
+    lines = []
+    for statement in statements:
+        lines.append(statement['sql'])
+        lines.extend('    ' + step for step in statement['plan'])
+    return lines
+
+
+def find_problems(plans, baseline):
+    """Readable failure messages; empty when everything matches."""
+    problems = []
+
+    public = {name for name in vars(Database) if not name.startswith('_')}
+    uncovered = sorted(public - set(CASES) - NO_SQL)
+    if uncovered:
+        problems.append(f"No query plan case for: {', '.join(uncovered)}")
+
+    for name, statements in plans.items():
+        hot = CASES[name][1]
+        if hot:
+            for statement in statements:
+                subqueries = {match.group(1) for match in map(_SUBQUERY.match, statement['plan']) if match}
+                scans = [step for step in statement['plan']
+                         if _SCAN.match(step) and _SCAN.match(step).group(1) not in SMALL_TABLES | subqueries]
+                if scans:
+                    problems.append(f"{name}: full scan on a hot path ({'; '.join(scans)})\n    {statement['sql']}")
+
+        if name not in baseline:
+            problems.append(f"{name}: not in the baseline (run with --update)")
+            continue
+        expected, actual = _lines(baseline[name]), _lines(statements)
+        if expected != actual:
+            diff = difflib.unified_diff(expected, actual, f'{name} (baseline)', f'{name} (current)', lineterm='')
+            problems.append('\n'.join(diff))
+    return problems
+
+
+def main(argv):
+    # Bulk seeding trips the slow query log; the plans are what is checked here
+    logging.getLogger('slow_queries').setLevel(logging.ERROR)
+    plans = collect_plans()
+    if '--update' in argv:
+        with open(BASELINE, 'w') as f:
+            json.dump(plans, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"Wrote plans for {len(plans)} methods to {BASELINE}")
+        return 0
+
+    try:
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        baseline = {}
+
+    problems = find_problems(plans, baseline)
+    for problem in problems:
+        print(problem, end='\n\n')
+    print(f"{len(plans)} methods checked, {len(problems)} problems")
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
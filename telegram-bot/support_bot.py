@@ -9,9 +9,10 @@ import logging
 import re
 from datetime import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, ContextTypes, filters, ConversationHandler
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, ContextTypes, filters, ConversationHandler, TypeHandler
 from dotenv import load_dotenv
-from database import Database
+from database import Database, LAST_ACTIVE_FLUSH_SECONDS
+from instrumentation import track_update
 
 # Load environment variables FIRST
 load_dotenv()
@@ -41,6 +42,9 @@ SUPPORT_BOT_USERNAME = os.getenv("SUPPORT_BOT_USERNAME", "uppport_bot")
 # Remove @ if present for URL building, add it back for display
 SUPPORT_BOT_HANDLE = SUPPORT_BOT_USERNAME.lstrip('@')
 
+# Tags this bot's user_logs rows (the 'source' detail)
+LOG_SOURCE = 'support_bot'
+
 # Conversation states for payment setup and proof submission
 WAITING_FOR_BTC_ADDRESS = 1
 WAITING_FOR_ETH_ADDRESS = 2
@@ -59,7 +63,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.info(f"Start command from user: {user.id} ({user.username or 'N/A'})")
 
     # Register user in database
-    db.get_or_create_user(user.id, user.username, user.first_name)
+    await db.get_or_create_user.submit(user.id, user.username, user.first_name)
 
     welcome_text = (
         f"👋 Hello, {user.first_name}!\n\n"
@@ -332,7 +336,6 @@ async def handle_payment_methods(update: Update, context: ContextTypes.DEFAULT_T
 
     # Get user's saved payment methods
     credentials = db.get_user_payment_credentials(user.id)
-    default_method = db.get_default_payment_method(user.id)
 
     text = (
         "💳 *Payment Methods*\n\n"
@@ -498,7 +501,7 @@ async def handle_set_default_callback(update: Update, context: ContextTypes.DEFA
     user = query.from_user
     method = query.data.replace('set_default_', '')
 
-    success = db.set_default_payment_method(user.id, method)
+    success = await db.set_default_payment_method.submit(user.id, method)
 
     if success:
         await query.answer(f"✅ {method.upper()} set as default!")
@@ -515,11 +518,12 @@ async def handle_buy_license(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user = query.from_user
 
     # Log purchase intent
-    db.log_user_action(
+    await db.log_user_action.submit(
         user_id=user.id,
         username=user.username,
         first_name=user.first_name,
-        action='purchase_intent'
+        action='purchase_intent',
+        details={'source': LOG_SOURCE, 'callback': query.data}
     )
 
     # Notify admin
@@ -580,13 +584,13 @@ async def handle_buy_plan(update: Update, context: ContextTypes.DEFAULT_TYPE, pl
     plan_emoji = {'standard': '💎', 'premium': '👑', 'lifetime': '🔥'}
 
     # Log plan selection
-    db.log_user_action(
+    await db.log_user_action.submit(
         user_id=user.id,
         username=user.username,
         first_name=user.first_name,
         action='plan_selected',
         plan_type=plan,
-        details=f"Price: {prices.get(plan)}"
+        details={'price': prices.get(plan), 'source': LOG_SOURCE, 'callback': query.data}
     )
 
     # Check for saved payment methods
@@ -631,14 +635,14 @@ async def handle_payment_selection(update: Update, context: ContextTypes.DEFAULT
     }
 
     # Log payment method selection
-    db.log_user_action(
+    await db.log_user_action.submit(
         user_id=user.id,
         username=user.username,
         first_name=user.first_name,
         action='payment_method_selected',
         plan_type=plan,
         payment_method=method,
-        details=f"Price: {prices.get(plan)}"
+        details={'price': prices.get(plan), 'source': LOG_SOURCE, 'callback': data}
     )
 
     # Show payment instructions based on method
@@ -751,7 +755,7 @@ async def forward_to_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         if method in ['btc', 'eth', 'usdt']:
             # Validate crypto address (basic check for length)
             if len(text) >= 26:  # Most crypto addresses are at least 26 chars
-                db.save_payment_credential(
+                await db.save_payment_credential.submit(
                     user_id=user.id,
                     payment_method=method,
                     username=user.username,
@@ -775,7 +779,7 @@ async def forward_to_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         elif method == 'paypal':
             # Basic email validation
             if '@' in text and '.' in text:
-                db.save_payment_credential(
+                await db.save_payment_credential.submit(
                     user_id=user.id,
                     payment_method='paypal',
                     username=user.username,
@@ -1017,7 +1021,7 @@ async def handle_proof_submission(update: Update, context: ContextTypes.DEFAULT_
         screenshot_file_id = message.photo[-1].file_id
 
     # Save proof to database
-    proof_id = db.save_payment_proof(
+    proof_id = await db.save_payment_proof.submit(
         user_id=user.id,
         username=user.username,
         first_name=user.first_name,
@@ -1114,7 +1118,7 @@ async def verify_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text("❌ Proof ID must be a number.")
         return
 
-    success = db.verify_payment_proof(proof_id, user.id, notes)
+    success = await db.verify_payment_proof.submit(proof_id, user.id, notes)
 
     if success:
         # Get proof details to notify user
@@ -1161,7 +1165,7 @@ async def reject_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text("❌ Proof ID must be a number.")
         return
 
-    success = db.reject_payment_proof(proof_id, user.id, notes)
+    success = await db.reject_payment_proof.submit(proof_id, user.id, notes)
 
     if success:
         # Notify user
@@ -1209,7 +1213,6 @@ async def paymentmethods_command(update: Update, context: ContextTypes.DEFAULT_T
         ]
     else:
         text = "💳 *Your Saved Payment Methods*\n\n"
-        default = db.get_default_payment_method(user.id)
 
         for i, cred in enumerate(credentials, 1):
             default_mark = " ⭐ DEFAULT" if cred.is_default else ""
@@ -1290,6 +1293,16 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 
 # ==================== MAIN ====================
 
+async def flush_last_active(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Repeating job: write queued last_active values even when no new update arrives."""
+    await db.flush_last_active.submit()
+
+
+async def post_shutdown(application: Application) -> None:
+    """Write the last queued last_active values before the process exits."""
+    db.close()
+
+
 def main() -> None:
     """Start the support bot."""
     token = os.getenv("SUPPORT_BOT_TOKEN")
@@ -1300,7 +1313,10 @@ def main() -> None:
     logger.info(f"Starting Support Bot with admin ID: {ADMIN_ID}")
     logger.info(f"Support bot handle: @{SUPPORT_BOT_HANDLE}")
 
-    application = Application.builder().token(token).build()
+    application = Application.builder().token(token).post_shutdown(post_shutdown).build()
+
+    # Opens a fresh SQL statement scope for every update (see instrumentation.py)
+    application.add_handler(TypeHandler(Update, track_update), group=-1)
 
     # Command handlers
     application.add_handler(CommandHandler("start", start))
@@ -1327,6 +1343,24 @@ def main() -> None:
     # Error handler
     application.add_error_handler(error_handler)
 
+    # Queued last_active values are otherwise only written by a later update
+    # (needs python-telegram-bot[job-queue])
+    if application.job_queue:
+        application.job_queue.run_repeating(flush_last_active, interval=LAST_ACTIVE_FLUSH_SECONDS,
+                                            first=LAST_ACTIVE_FLUSH_SECONDS)
+    else:
+        logger.warning("JobQueue not available, last_active is only flushed on later updates and at shutdown")
+
+    # Drop cached license/credential reads when another bot changes them
+    db.start_change_feed()
+
+    # Fill the license cache before the first burst of /start traffic
+    stats = db.warm_up()
+    logger.info(
+        f"Warm-up cached {stats['licenses']} active licenses for {stats['users']} users "
+        f"({stats['cached']} cache entries) in {stats['seconds']:.2f}s using {stats['memory_kb']:.0f} KB"
+    )
+
     logger.info("Support Bot started!")
     application.run_polling()
 
@@ -0,0 +1,354 @@
+"""Synthetic, production-shaped data for benchmarks and plan checks.
+
+    python synthetic.py bot_bench.db 100000    # users; licenses and logs scale with them
+
+populate() fills a Database with users, licenses (with the license_events
+that lead to their state), payment credentials, payment proofs and
+user_logs drawn from the distributions below. The
+defaults give 2 licenses and 100 log rows per user, so 100k users means
+200k licenses and 10M user_logs. Output is reproducible for a given seed
+and `now`. Rows go in as chunked Core inserts straight through the
+engines, bypassing the writer threads, so only use it on a scratch
+database.
+"""
+
+import hashlib
+import random
+import string
+import sys
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import insert
+from database import (Database, License, LicenseEvent, User, UserLog, PaymentCredential, PaymentProof, PLAN_CHANNELS,
+                      LOG_RETENTION_DAYS)
+
+LICENSES_PER_USER = 2.0
+LOGS_PER_USER = 100
+
+# Users inserted (with their licenses, logs, ...) per transaction
+CHUNK_USERS = 2000
+
+# Telegram ids start above 2**31, like real ones
+FIRST_USER_ID = 5_000_000_000
+
+# How far back registrations go; recent sign-ups are more common
+HISTORY_DAYS = 730
+
+PLAN_WEIGHTS = {'standard': 70, 'premium': 25, 'lifetime': 5}
+PLAN_DAYS = {'standard': 30, 'premium': 30, 'lifetime': None}
+PLAN_PRICES = {'standard': '$9.99', 'premium': '$19.99', 'lifetime': '$49.99'}
+
+# Share of users who ever bought a license, and the chance each bought
+# license is renewed once more
+BUYER_SHARE = 0.55
+RENEWAL_RATE = 0.7
+
+# What happens to a bought license besides running out
+REVOKED_SHARE = 0.03
+
+PAYMENT_METHOD_WEIGHTS = {'usdt': 35, 'btc': 30, 'eth': 20, 'paypal': 10, 'card': 5}
+CREDENTIAL_SHARE = 0.35
+SECOND_CREDENTIAL_SHARE = 0.2
+
+PROOF_STATUS_WEIGHTS = {'verified': 80, 'rejected': 12, 'pending': 8}
+
+# The purchase funnel the bots log: each step reached with this share of
+# the sessions that reached the previous one
+FUNNEL = [('purchase_intent', 1.0), ('plan_selected', 0.6), ('payment_method_selected', 0.45)]
+
+# Which bot a funnel session starts in, and the callback data of each step
+LOG_SOURCE_WEIGHTS = {'support_bot': 75, 'user_bot': 25}
+LOG_CALLBACKS = {'purchase_intent': 'buy_license', 'plan_selected': 'buy_plan_{plan}',
+                 'payment_method_selected': 'pay_{method}_{plan}'}
+
+# Pareto shape for logs per user; most users log little, a few log a lot.
+# The busiest users are capped at LOG_ACTIVITY_CAP times the mean.
+LOG_ACTIVITY_SHAPE = 1.5
+LOG_ACTIVITY_CAP = 50
+
+USERNAME_SHARE = 0.7
+FIRST_NAMES = ('Alex', 'Maria', 'Ivan', 'Li', 'Sara', 'Omar', 'Anna', 'John', 'Yuki', 'Priya', 'Lucas', None)
+
+_KEY_ALPHABET = string.ascii_uppercase + string.digits
+
+
+def _chooser(weights):
+    """Fast weighted choice over a {value: weight} mapping."""
+    values, cumulative, total = list(weights), [], 0
+    for weight in weights.values():
+        total += weight
+        cumulative.append(total)
+    return lambda rng: rng.choices(values, cum_weights=cumulative)[0]
+
+
+_plan = _chooser(PLAN_WEIGHTS)
+_payment_method = _chooser(PAYMENT_METHOD_WEIGHTS)
+_proof_status = _chooser(PROOF_STATUS_WEIGHTS)
+_log_source = _chooser(LOG_SOURCE_WEIGHTS)
+
+
+def _license_key(rng):
+    """A key in the XXXX-XXXX-XXXX-XXXX format, with its storage hash."""
+    key = '-'.join(''.join(rng.choices(_KEY_ALPHABET, k=4)) for _ in range(4))
+    return key, hashlib.sha256(key.encode()).hexdigest()
+
+
+_ADDRESS_FIELD = {'btc': 'btc_address', 'eth': 'eth_address', 'usdt': 'usdt_address', 'paypal': 'paypal_email',
+                  'card': 'card_last_four'}
+
+
+def _address(rng, method):
+    """Credential columns for `method`; every row carries all of them for executemany."""
+    if method == 'btc':
+        value = 'bc1q' + ''.join(rng.choices(string.ascii_lowercase + string.digits, k=38))
+    elif method == 'eth':
+        value = '0x' + '%040x' % rng.getrandbits(160)
+    elif method == 'usdt':
+        value = 'T' + ''.join(rng.choices(string.ascii_letters + string.digits, k=33))
+    elif method == 'paypal':
+        value = f'buyer{rng.getrandbits(24)}@example.com'
+    else:
+        value = f'{rng.randrange(10000):04d}'
+    fields = dict.fromkeys(_ADDRESS_FIELD.values())
+    fields[_ADDRESS_FIELD[method]] = value
+    return fields
+
+
+class _Generator:
+    """Rows for one chunk of users at a time."""
+
+    def __init__(self, rng, now, licenses_per_user, logs_per_user):
+        self.rng = rng
+        self.now = now
+        self.licenses_per_user = licenses_per_user
+        self.logs_per_user = logs_per_user
+        self.keys = set()
+        # Pareto(a) has mean a/(a-1); scale it to the requested mean
+        self.log_scale = logs_per_user * (LOG_ACTIVITY_SHAPE - 1) / LOG_ACTIVITY_SHAPE
+
+    def new_key(self):
+        while True:
+            key, key_hash = _license_key(self.rng)
+            if key not in self.keys:
+                self.keys.add(key)
+                return key, key_hash
+
+    def registered_at(self):
+        # sqrt skews towards recent sign-ups
+        return self.now - timedelta(seconds=HISTORY_DAYS * 86400 * (1 - self.rng.random() ** 0.5))
+
+    def chunk(self, user_ids):
+        rows = {'users': [], 'licenses': [], 'logs': [], 'credentials': [], 'proofs': []}
+        for user_id in user_ids:
+            self._user(user_id, rows)
+        return rows
+
+    def _user(self, user_id, rows):
+        rng, now = self.rng, self.now
+        registered = self.registered_at()
+        username = f'user{user_id - FIRST_USER_ID}' if rng.random() < USERNAME_SHARE else None
+        first_name = rng.choice(FIRST_NAMES)
+        plan = _plan(rng)
+        method = _payment_method(rng)
+        rows['users'].append({
+            'telegram_id': user_id, 'username': username, 'first_name': first_name,
+            'registered_at': registered,
+            'last_active': registered + (now - registered) * rng.random() ** 0.3
+        })
+
+        if rng.random() < BUYER_SHARE:
+            self._licenses(user_id, username, plan, registered, rows)
+            if rng.random() < 0.5:
+                rows['proofs'].append(self._proof(user_id, username, first_name, plan, method, registered))
+
+        if rng.random() < CREDENTIAL_SHARE:
+            methods = [method]
+            if rng.random() < SECOND_CREDENTIAL_SHARE:
+                methods.append(_payment_method(rng))
+            for position, each in enumerate(dict.fromkeys(methods)):
+                created = registered + (now - registered) * rng.random()
+                rows['credentials'].append({
+                    'user_id': user_id, 'username': username, 'first_name': first_name,
+                    'payment_method': each, 'preferred_method': method, 'is_default': position == 0,
+                    'created_at': created, 'updated_at': created, **_address(rng, each)
+                })
+
+        self._logs(user_id, username, first_name, plan, method, registered, rows)
+
+    def _licenses(self, user_id, username, plan, registered, rows):
+        rng, now = self.rng, self.now
+        days = PLAN_DAYS[plan]
+        activated = registered + timedelta(hours=rng.expovariate(1 / 48))
+        while activated < now:
+            key, key_hash = self.new_key()
+            expires = activated + timedelta(days=days) if days else None
+            if rng.random() < REVOKED_SHARE:
+                status = 'revoked'
+            elif expires is None or expires > now:
+                status = 'active'
+            else:
+                status = 'expired'
+            rows['licenses'].append({
+                'license_key': key, 'key_hash': key_hash, 'status': status,
+                'created_at': activated - timedelta(minutes=rng.randint(1, 600)), 'activated_at': activated,
+                'expires_at': expires, 'user_id': user_id, 'username': username, 'plan_type': plan,
+                'max_channels': PLAN_CHANNELS[plan], 'used_activation_count': 1, 'max_activations': 1
+            })
+            if expires is None or status == 'revoked' or rng.random() >= RENEWAL_RATE:
+                break
+            activated = expires + timedelta(hours=rng.expovariate(1 / 24))
+
+    def stock(self, count):
+        """Unsold keys: generated by admins, never activated."""
+        rng, now = self.rng, self.now
+        rows = []
+        for _ in range(count):
+            key, key_hash = self.new_key()
+            plan = _plan(rng)
+            created = now - timedelta(seconds=rng.randint(0, HISTORY_DAYS * 86400))
+            days = PLAN_DAYS[plan]
+            rows.append({
+                'license_key': key, 'key_hash': key_hash, 'status': 'inactive', 'created_at': created,
+                'expires_at': created + timedelta(days=days) if days else None, 'plan_type': plan,
+                'max_channels': PLAN_CHANNELS[plan], 'used_activation_count': 0, 'max_activations': 1
+            })
+        return rows
+
+    def _proof(self, user_id, username, first_name, plan, method, registered):
+        rng = self.rng
+        status = _proof_status(rng)
+        created = registered + (self.now - registered) * rng.random()
+        return {
+            'user_id': user_id, 'username': username, 'first_name': first_name, 'plan_type': plan,
+            'payment_method': method, 'amount_sent': PLAN_PRICES[plan],
+            'to_address': _address(rng, method)[_ADDRESS_FIELD[method]],
+            'transaction_id': '%064x' % rng.getrandbits(256), 'status': status,
+            'verified_by': 1 if status != 'pending' else None,
+            'verified_at': created + timedelta(hours=rng.expovariate(1 / 6)) if status != 'pending' else None,
+            'created_at': created, 'updated_at': created
+        }
+
+    def _logs(self, user_id, username, first_name, plan, method, registered, rows):
+        rng, now = self.rng, self.now
+        count = int(min(rng.paretovariate(LOG_ACTIVITY_SHAPE) * self.log_scale, LOG_ACTIVITY_CAP * self.logs_per_user))
+        # The live table holds about LOG_RETENTION_DAYS; archive_old_rows moves the rest
+        window_start = max(registered, now - timedelta(days=LOG_RETENTION_DAYS + 30))
+        window = (now - window_start).total_seconds()
+        logs = rows['logs']
+        while count > 0:
+            at = window_start + timedelta(seconds=window * rng.random() ** 0.7)
+            source = _log_source(rng)
+            for action, share in FUNNEL:
+                if count <= 0 or rng.random() >= share:
+                    break
+                logs.append({
+                    'user_id': user_id, 'username': username, 'first_name': first_name, 'action': action,
+                    'plan_type': plan if action != 'purchase_intent' else None,
+                    'payment_method': method if action == 'payment_method_selected' else None,
+                    'details': {
+                        'price': float(PLAN_PRICES[plan].lstrip('$')) if action != 'purchase_intent' else None,
+                        'source': source,
+                        'callback': LOG_CALLBACKS[action].format(plan=plan, method=method)
+                    },
+                    'created_at': at
+                })
+                at += timedelta(seconds=rng.randint(5, 300))
+                count -= 1
+
+
+    def license_events(self, licenses, license_ids):
+        """The license_events history that leads to each generated license's state."""
+        rng, now = self.rng, self.now
+        events = []
+        for license_id, row in zip(license_ids, licenses):
+            plan, status = row['plan_type'], row['status']
+
+            def add(event, from_status, to_status, at):
+                events.append({'license_id': license_id, 'event': event, 'from_plan': plan if from_status else None,
+                               'from_status': from_status, 'to_plan': plan, 'to_status': to_status,
+                               'created_at': at})
+
+            add('created', None, 'inactive', row['created_at'])
+            if status == 'inactive':
+                continue
+            add('activated', 'inactive', 'active', row['activated_at'])
+            if status == 'expired':
+                add('expired', 'active', 'expired', row['expires_at'])
+            elif status == 'revoked':
+                end = min(row['expires_at'] or now, now)
+                add('revoked', 'active', 'revoked', row['activated_at'] + (end - row['activated_at']) * rng.random())
+        return events
+
+
+def _insert(engine, model, rows):
+    if rows:
+        with engine.begin() as conn:
+            conn.execute(insert(model), rows)
+
+
+def _insert_licenses(engine, generator, rows):
+    """Insert licenses together with their license_events history."""
+    if rows:
+        with engine.begin() as conn:
+            license_ids = conn.execute(
+                insert(License).returning(License.id, sort_by_parameter_order=True), rows
+            ).scalars().all()
+            conn.execute(insert(LicenseEvent), generator.license_events(rows, license_ids))
+
+
+def populate(db, users, licenses_per_user=LICENSES_PER_USER, logs_per_user=LOGS_PER_USER, seed=42, now=None,
+             analyze=True, progress=None):
+    """Fill `db` with `users` synthetic users and everything that hangs off them.
+
+    Unsold keys top the licenses up to users * licenses_per_user. Runs
+    ANALYZE afterwards (as the nightly maintenance does) unless told not
+    to, and reloads the key filter. Returns {table: rows inserted}.
+    `progress(done_users, users)` is called after every chunk.
+    """
+    generator = _Generator(random.Random(seed), now or datetime.utcnow(), licenses_per_user, logs_per_user)
+    licensing = db.write_engine or db.engine
+    analytics = db.analytics_engine or db.engine
+    counts = dict.fromkeys(('users', 'licenses', 'logs', 'credentials', 'proofs'), 0)
+
+    for start in range(0, users, CHUNK_USERS):
+        user_ids = range(FIRST_USER_ID + start, FIRST_USER_ID + min(start + CHUNK_USERS, users))
+        rows = generator.chunk(user_ids)
+        _insert(licensing, User, rows['users'])
+        _insert_licenses(licensing, generator, rows['licenses'])
+        _insert(licensing, PaymentCredential, rows['credentials'])
+        _insert(licensing, PaymentProof, rows['proofs'])
+        _insert(analytics, UserLog, rows['logs'])
+        for table, table_rows in rows.items():
+            counts[table] += len(table_rows)
+        if progress:
+            progress(start + len(user_ids), users)
+
+    stock = max(0, int(users * licenses_per_user) - counts['licenses'])
+    for start in range(0, stock, CHUNK_USERS * 10):
+        _insert_licenses(licensing, generator, generator.stock(min(CHUNK_USERS * 10, stock - start)))
+    counts['licenses'] += stock
+
+    if analyze:
+        with db.engine.connect() as conn:
+            conn.exec_driver_sql('ANALYZE')
+            conn.commit()
+    db._shared['filter'] = db.load_key_filter()
+    db.cache.clear()
+    return counts
+
+
+def main(argv):
+    if len(argv) < 2:
+        print(__doc__.strip().splitlines()[2])
+        return 2
+    db = Database(argv[0])
+    started = time.perf_counter()
+    counts = populate(db, int(argv[1]), progress=lambda done, total: print(f"\r{done}/{total} users", end=''))
+    db.close()
+    print(f"\n{', '.join(f'{rows} {table}' for table, rows in counts.items())} "
+          f"in {time.perf_counter() - started:.1f} s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -10,9 +10,10 @@ import random
 import asyncio
 from datetime import datetime, timedelta
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, TypeHandler
 from dotenv import load_dotenv
-from database import Database
+from database import Database, LAST_ACTIVE_FLUSH_SECONDS
+from instrumentation import track_update
 
 # Load environment variables
 load_dotenv()
@@ -33,6 +34,9 @@ GITHUB_PROFILE_LINK = os.getenv("GITHUB_PROFILE_LINK", "https://github.com/your_
 SUPPORT_BOT = os.getenv("SUPPORT_BOT_USERNAME", "uppport_bot")
 USER_BOT_NAME = "ven_userbot"
 
+# Tags this bot's user_logs rows (the 'source' detail)
+LOG_SOURCE = 'user_bot'
+
 # Admin ID for notifications
 ADMIN_ID_STR = os.getenv("ADMIN_IDS", "0")
 try:
@@ -108,7 +112,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
 
     # Register user
-    db.get_or_create_user(user.id, user.username, user.first_name)
+    await db.get_or_create_user.submit(user.id, user.username, user.first_name)
 
     # Check license
     has_license = db.has_active_license(user.id)
@@ -240,7 +244,7 @@ async def activate_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     if '-' not in key and len(key) == 16:
         key = '-'.join([key[i:i+4] for i in range(0, 16, 4)])
 
-    success, message = db.activate_license(key, user.id, user.username)
+    success, message = await db.activate_license.submit(key, user.id, user.username)
 
     if success:
         await update.message.reply_text(
@@ -379,13 +383,13 @@ async def log_and_notify_purchase_request(bot, user, plan: str, price: str):
     """Log user action and notify admin when user requests to purchase a license."""
     # Log to database
     try:
-        db.log_user_action(
+        await db.log_user_action.submit(
             user_id=user.id,
             username=user.username,
             first_name=user.first_name,
             action='purchase_intent',
             plan_type=plan,
-            details=f"Price: {price}"
+            details={'price': price, 'source': LOG_SOURCE}
         )
         logger.info(f"Logged purchase intent for user {user.id}, plan: {plan}")
     except Exception as e:
@@ -436,13 +440,13 @@ async def handle_buy(update: Update, context: ContextTypes.DEFAULT_TYPE, data: s
     await notify_admin_purchase_request(context.bot, user, plan.title(), prices.get(plan, 'Unknown'))
 
     # Log the purchase intent
-    db.log_user_action(
+    await db.log_user_action.submit(
         user_id=user.id,
         username=user.username,
         first_name=user.first_name,
         action='purchase_intent',
         plan_type=plan,
-        details=f"User clicked buy from user bot. Price: {prices.get(plan)}"
+        details={'price': prices.get(plan), 'source': LOG_SOURCE, 'callback': data}
     )
 
     # Create pre-filled message for support bot
@@ -860,6 +864,16 @@ async def handle_what_is(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
 
 
+async def flush_last_active(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Repeating job: write queued last_active values even when no new update arrives."""
+    await db.flush_last_active.submit()
+
+
+async def post_shutdown(application: Application) -> None:
+    """Write the last queued last_active values before the process exits."""
+    db.close()
+
+
 def main() -> None:
     """Start the user bot."""
     token = os.getenv("USER_BOT_TOKEN")
@@ -868,7 +882,10 @@ def main() -> None:
         logger.error("Add: USER_BOT_TOKEN=8028150882:AAGgsNu8RQWHut4ZYT4v0YgaxyDg5FMxbs")
         return
 
-    application = Application.builder().token(token).build()
+    application = Application.builder().token(token).post_shutdown(post_shutdown).build()
+
+    # Opens a fresh SQL statement scope for every update (see instrumentation.py)
+    application.add_handler(TypeHandler(Update, track_update), group=-1)
 
     # Command handlers
     application.add_handler(CommandHandler("start", start))
@@ -881,6 +898,24 @@ def main() -> None:
     # Callback handler
     application.add_handler(CallbackQueryHandler(button_handler))
 
+    # Queued last_active values are otherwise only written by a later update
+    # (needs python-telegram-bot[job-queue])
+    if application.job_queue:
+        application.job_queue.run_repeating(flush_last_active, interval=LAST_ACTIVE_FLUSH_SECONDS,
+                                            first=LAST_ACTIVE_FLUSH_SECONDS)
+    else:
+        logger.warning("JobQueue not available, last_active is only flushed on later updates and at shutdown")
+
+    # Drop cached license/credential reads when another bot changes them
+    db.start_change_feed()
+
+    # Fill the license cache before the first burst of /start traffic
+    stats = db.warm_up()
+    logger.info(
+        f"Warm-up cached {stats['licenses']} active licenses for {stats['users']} users "
+        f"({stats['cached']} cache entries) in {stats['seconds']:.2f}s using {stats['memory_kb']:.0f} KB"
+    )
+
     logger.info("User Panel Bot started!")
     application.run_polling()
 
@@ -0,0 +1,248 @@
+"""Group-commit writer for database mutations.
+
+SQLite allows one writer at a time and every commit pays for an fsync. The
+bots used to commit once per mutation, so bursts of /start, logging and
+proof submissions queued up behind the write lock. GroupCommitWriter runs
+mutations on one thread and commits them in batches: up to `max_batch`
+operations, or whatever arrived within `max_delay` seconds of the first.
+An operation that finds the queue empty is committed at once.
+
+Each operation runs inside its own SAVEPOINT, so one failing operation is
+rolled back and reported to its caller without sinking the rest of the
+batch.
+"""
+
+import asyncio
+import functools
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from instrumentation import enter_operation, exit_operation
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class GroupCommitWriter(threading.Thread):
+    """Background thread that applies write operations in group commits.
+
+    An operation is a callable taking a Session; its return value (or
+    exception) resolves the Future handed back by submit().
+    """
+
+    def __init__(self, session_factory, max_batch=64, max_delay=0.005, after_commit=None):
+        super().__init__(name='db-writer', daemon=True)
+        self.session_factory = session_factory
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.after_commit = after_commit
+        self._queue = queue.Queue()
+        self.batches = 0
+        self.operations = 0
+
+    def submit(self, op):
+        """Queue an operation and return a Future for its result."""
+        future = Future()
+        self._queue.put((op, future))
+        return future
+
+    def run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+
+            batch = [item]
+            stopping = False
+            # A lone operation has nothing to share its commit with, so it
+            # goes straight through; waiting only pays off when others queue.
+            delay = 0 if self._queue.empty() else self.max_delay
+            deadline = time.monotonic() + delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self._apply(batch)
+            if stopping:
+                return
+
+    def _apply(self, batch):
+        """Run one batch in a single transaction and resolve its futures."""
+        session = self.session_factory()
+        outcomes = []
+        try:
+            for op, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    with session.begin_nested():
+                        outcomes.append((future, True, op(session)))
+                except Exception as e:
+                    outcomes.append((future, False, e))
+            session.commit()
+        except Exception as e:
+            logger.error(f"Group commit of {len(batch)} operations failed: {e}")
+            session.rollback()
+            session.close()
+            for future, ok, _ in outcomes:
+                future.set_exception(e)
+            return
+
+        try:
+            if self.after_commit:
+                self.after_commit(session)
+        except Exception as e:
+            logger.error(f"after_commit hook failed: {e}")
+        finally:
+            session.close()
+
+        self.batches += 1
+        self.operations += len(outcomes)
+        for future, ok, value in outcomes:
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def stop(self, timeout=5):
+        """Finish queued operations and stop the thread."""
+        self._queue.put(_STOP)
+        self.join(timeout)
+
+
+def write_operation(method=None, *, analytics=False):
+    """Mark a Database method whose whole body is one write.
+
+    The method takes the writer's session after `self`. Calling it waits
+    for the group commit that contains it; `await db.method.submit(...)`
+    waits without blocking the event loop. Use
+    @write_operation(analytics=True) for writes to the analytics file.
+    """
+    if method is None:
+        return lambda method: _WriteMethod(method, analytics)
+    return _WriteMethod(method, analytics)
+
+
+class _WriteMethod:
+    def __init__(self, method, analytics=False):
+        self.method = method
+        self.analytics = analytics
+        functools.update_wrapper(self, method)
+
+    def __get__(self, db, owner=None):
+        if db is None:
+            return self
+        return _BoundWrite(db, self.method, self.analytics)
+
+
+class _BoundWrite:
+    __slots__ = ('db', 'method', 'analytics')
+
+    def __init__(self, db, method, analytics):
+        self.db = db
+        self.method = method
+        self.analytics = analytics
+
+    def _op(self, args, kwargs):
+        return lambda session: self.method(self.db, session, *args, **kwargs)
+
+    def operation(self, *args, **kwargs):
+        """The write as a callable taking a session, for @write_steps methods to yield."""
+        return self._op(args, kwargs)
+
+    def __call__(self, *args, **kwargs):
+        token = enter_operation(self.method.__name__)
+        try:
+            return self.db._write(self._op(args, kwargs), self.analytics)
+        finally:
+            exit_operation(token)
+
+    def submit(self, *args, **kwargs):
+        """Queue the write and return an awaitable for its result."""
+        token = enter_operation(self.method.__name__)
+        try:
+            return asyncio.wrap_future(self.db._submit(self._op(args, kwargs), self.analytics))
+        finally:
+            exit_operation(token)
+
+
+def write_steps(method=None, *, analytics=False):
+    """Mark a Database method that does its own work around its writes.
+
+    The method is a generator: it yields each write operation (a callable
+    taking a session), receives its result back from the yield, and
+    returns the method's result. Calling it waits for each write in turn;
+    `await db.method.submit(...)` runs the same code on the event loop and
+    awaits each write without blocking it. Exceptions from a write are
+    raised at the yield.
+    """
+    if method is None:
+        return lambda method: _StepsMethod(method, analytics)
+    return _StepsMethod(method, analytics)
+
+
+class _StepsMethod(_WriteMethod):
+    def __get__(self, db, owner=None):
+        if db is None:
+            return self
+        return _BoundSteps(db, self.method, self.analytics)
+
+
+class _BoundSteps:
+    __slots__ = ('db', 'method', 'analytics')
+
+    def __init__(self, db, method, analytics):
+        self.db = db
+        self.method = method
+        self.analytics = analytics
+
+    def steps(self, *args, **kwargs):
+        """The method's generator, for another @write_steps method to `yield from`."""
+        return self.method(self.db, *args, **kwargs)
+
+    def __call__(self, *args, **kwargs):
+        token = enter_operation(self.method.__name__)
+        steps = self.steps(*args, **kwargs)
+        try:
+            op = next(steps)
+            while True:
+                try:
+                    result = self.db._write(op, self.analytics)
+                except Exception as e:
+                    op = steps.throw(e)
+                else:
+                    op = steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            exit_operation(token)
+
+    async def submit(self, *args, **kwargs):
+        """Run the method, awaiting each of its writes."""
+        token = enter_operation(self.method.__name__)
+        steps = self.steps(*args, **kwargs)
+        try:
+            op = next(steps)
+            while True:
+                try:
+                    result = await asyncio.wrap_future(self.db._submit(op, self.analytics))
+                except Exception as e:
+                    op = steps.throw(e)
+                else:
+                    op = steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            exit_operation(token)